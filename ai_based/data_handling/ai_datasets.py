@@ -12,6 +12,7 @@ from datetime import datetime
 from copy import deepcopy
 from pathlib import Path
 import multiprocessing as mp
+import weakref
 
 import numba
 import numba.typed
@@ -22,10 +23,10 @@ import torch
 import pandas as pd
 from tqdm import tqdm
 
-from util.datasets.sliding_window import GroundTruthClass, SlidingWindowDataset
+from util.datasets.sliding_window import GroundTruthClass, SlidingWindowDataset, SlidingWindowRecord, SignalMask
 from util.mathutil import normalize_robust, PeakType
-from util.filter import apply_butterworth_lowpass_filter
-from util.mathutil import get_peaks
+from util.datasets.peak_index import LowpassPrefilter
+from util.mathutil import get_peak_arrays
 
 
 SlidingWindowTimestamps = NamedTuple("SlidingWindowTimestamps", dataset_index=int, center_point=pd.Timedelta, features=pd.TimedeltaIndex, ground_truth=pd.TimedeltaIndex)
@@ -33,6 +34,10 @@ SlidingWindowTimestamps = NamedTuple("SlidingWindowTimestamps", dataset_index=in
 FEATURE_SIGNAL_NAMES = ("SaO2", "ABD", "CHEST", "AIRFLOW")  # The signals that end up in the outputted feature map
 NORMALIZE_SIGNAL_NAMES = ("ABD", "CHEST", "AIRFLOW")  # Signals that we wish to normalize at window level
 
+# Prepared records that are alive within this process, keyed by (dataset folder, downsample frequency). Several
+# AiDatasets (e.g. with different window geometries) thereby share their records instead of loading them once more.
+_prepared_records: "weakref.WeakValueDictionary[Tuple[Path, float], SlidingWindowRecord]" = weakref.WeakValueDictionary()
+
 
 class BaseAiDataset(torch.utils.data.Dataset, ABC):
     def __init__(self, config):
@@ -61,31 +66,36 @@ class AiDataset(BaseAiDataset):
     - applies preprocessing steps (normalizing etc.) to the features before outputting
     """
     @staticmethod
-    def _load_prepare_dataset(dataset_folder: Path, sliding_window_dataset_config: SlidingWindowDataset.Config) -> SlidingWindowDataset:
+    def _load_prepare_dataset(dataset_folder: Path, sliding_window_dataset_config: SlidingWindowDataset.Config,
+                              precompute_normalization: bool = False) -> SlidingWindowDataset:
         ds_ = SlidingWindowDataset(config=sliding_window_dataset_config, dataset_folder=dataset_folder, allow_caching=True)
         assert all([s in ds_.signals for s in FEATURE_SIGNAL_NAMES]), \
             f"{SlidingWindowDataset.__name__} '{dataset_folder.name}' does not provide all necessary " \
             f"signal names {FEATURE_SIGNAL_NAMES}; at least one out of them is missing!"
-        # Reduce signal complexity by determining hull curve of our alternating signals. Therefore we use "get_peak"
-        for signal_name in ("ABD", "CHEST", "AIRFLOW"):
-            # Pre-filter our signal with, to provide a bit more stable peak-detection
-            prefiltered_signal_array = apply_butterworth_lowpass_filter(data=ds_.signals[signal_name].values, f_cutoff=0.1, f_sample=1, filter_order=5)
-            filter_kernel_width = int(sliding_window_dataset_config.downsample_frequency_hz * 0.7)
-            peaks_list = get_peaks(waveform=prefiltered_signal_array, filter_kernel_width=filter_kernel_width)
+        # Reduce signal complexity by determining hull curve of our alternating signals. Therefore we use "get_peak".
+        # Signals are pre-filtered, to provide a bit more stable peak-detection. Peaks are taken from the record's peak
+        # index, i.e. they are only detected once per record & filter configuration.
+        peak_signal_names = ("ABD", "CHEST", "AIRFLOW")
+        filter_kernel_width = int(sliding_window_dataset_config.downsample_frequency_hz * 0.7)
+        peaks_list = ds_.get_peak_arrays(signal_names=peak_signal_names, filter_kernel_width=filter_kernel_width,
+                                         prefilter=LowpassPrefilter(f_cutoff=0.1, f_sample=1, filter_order=5))
+        for signal_name, peaks in zip(peak_signal_names, peaks_list):
             # Create an empty NaN-array and fill in the absolute magnitudes at each peak's center point
-            peakified_signal_array = np.zeros(shape=prefiltered_signal_array.shape, dtype=np.float)
-            if len(peaks_list) <= 2:
+            peakified_signal_array = np.zeros(shape=(len(ds_.signals),), dtype=np.float64)
+            if len(peaks.starts) <= 2:
                 pass  # This covers the -very unlikely yet present- case that the signal has no peaks (e.g. 07-0709)
             else:
                 peakified_signal_array[:] = np.nan
-                for p in peaks_list:
-                    peakified_signal_array[p.center] = np.abs(p.extreme_value)
+                peakified_signal_array[peaks.centers] = np.abs(peaks.extreme_values)
             # Now, let's interpolate the NaNs in between the points
             peakified_signal_series = pd.Series(data=peakified_signal_array, index=ds_.signals.index, dtype=np.float32)
             peakified_signal_series = peakified_signal_series.interpolate(method="linear").bfill().ffill()
-            ds_.signals[signal_name] = peakified_signal_series
+            ds_.set_signal(signal_name, peakified_signal_series.values)
         assert not np.any(np.isnan(ds_.signals.values)), f"Oops, there's a NaN value in dataset '{dataset_folder.name}'"
         assert not np.any(np.isinf(ds_.signals.values)), f"Oops, there's a inf value in dataset '{dataset_folder.name}'"
+        if precompute_normalization:
+            for signal_name in NORMALIZE_SIGNAL_NAMES:
+                ds_.get_robust_scales(signal_name)  # Kept by the record, which is handed back to the parent process
         return ds_
 
     @dataclass
@@ -93,6 +103,8 @@ class AiDataset(BaseAiDataset):
         sliding_window_dataset_config: SlidingWindowDataset.Config
         dataset_folders: List[Path]
         noise_mean_std: Optional[Tuple[float, float]]
+        skip_masked: SignalMask = SignalMask(0)  # Windows whose ground truth range overlaps these masks are left out
+        precompute_normalization: bool = False  # Normalization statistics of all windows are computed once, upfront
 
     def __init__(self, config: Config, progress_message: str = "Loading and pre-processing dataset", n_processes: int = None):
         """
@@ -114,17 +126,35 @@ class AiDataset(BaseAiDataset):
 
         # Let's load the underlying SlidingWindowDatasets and check if all signals are provided
         # self._load_prepare_dataset(dataset_folder=self.config.dataset_folders[0], sliding_window_dataset_config=config.sliding_window_dataset_config)
-        get_peaks(waveform=np.array([-1, 0, 1, 0]), filter_kernel_width=2)  # Pre-JIT get_peaks to improve performance
+        get_peak_arrays(waveform=np.array([-1, 0, 1, 0]), filter_kernel_width=2)  # Pre-JIT get_peak_arrays to improve performance
+        # Records that were already prepared within this process (e.g. by another AiDataset) are not loaded once more
+        sliding_window_dataset_config = config.sliding_window_dataset_config
+        record_keys = [(f.resolve(), sliding_window_dataset_config.downsample_frequency_hz) for f in self.config.dataset_folders]
+        records: Dict[Tuple[Path, float], Optional[SlidingWindowRecord]] = {k: _prepared_records.get(k) for k in record_keys}
+        folders_to_load = list({k: f for k, f in zip(record_keys, self.config.dataset_folders) if records[k] is None}.values())
         with mp.Pool(processes=n_processes) as pool:
-            load_fn_ = functools.partial(self._load_prepare_dataset, sliding_window_dataset_config=config.sliding_window_dataset_config)
-            loading_results = list(tqdm(pool.imap(load_fn_, self.config.dataset_folders), desc=progress_message,
-                                        total=len(self.config.dataset_folders)))
-            self._sliding_window_datasets: List[SlidingWindowDataset] = loading_results
+            load_fn_ = functools.partial(self._load_prepare_dataset, sliding_window_dataset_config=sliding_window_dataset_config,
+                                         precompute_normalization=config.precompute_normalization)
+            loading_results = list(tqdm(pool.imap(load_fn_, folders_to_load), desc=progress_message,
+                                        total=len(folders_to_load)))
+        for ds in loading_results:
+            key_ = (ds.dataset_folder.resolve(), sliding_window_dataset_config.downsample_frequency_hz)
+            records[key_] = _prepared_records[key_] = ds.record
+        self._sliding_window_datasets: List[SlidingWindowDataset] = \
+            [SlidingWindowDataset(config=sliding_window_dataset_config, record=records[k]) for k in record_keys]
+
+        # Windows of masked segments (e.g. wake, disconnected sensors) are left out, if desired. In that case, we keep
+        # the remaining window indexes of each SlidingWindowDataset; None means that all windows are used.
+        self._unmasked_window_indexes: List[Optional[np.ndarray]] = [None] * len(self._sliding_window_datasets)
+        if config.skip_masked:
+            self._unmasked_window_indexes = [np.flatnonzero(~ds.get_window_mask(flags=config.skip_masked))
+                                             for ds in self._sliding_window_datasets]
 
         # Now, let's take a look at the dataset lengths. Here, for speed-up reasons in conjunction with
         # our function '_resolve_index_helper', we make use of Numba lists
         self._sliding_window_datasets_lengths = numba.typed.List()
-        [self._sliding_window_datasets_lengths.append(len(ds)) for ds in self._sliding_window_datasets]
+        [self._sliding_window_datasets_lengths.append(len(ds) if indexes_ is None else len(indexes_))
+         for ds, indexes_ in zip(self._sliding_window_datasets, self._unmasked_window_indexes)]
         self._len = sum(self._sliding_window_datasets_lengths)
 
         # Pre-JIT our '_resolve_index_helper' function, for performance improvement
@@ -161,26 +191,35 @@ class AiDataset(BaseAiDataset):
     def _resolve_index(self, idx: int) -> Tuple[int, int]:
         """Resolves a given index to sliding-window-dataset & dataset-internal index."""
         assert 0 <= idx < len(self), "Index out of bounds"
-        return self._resolve_index_helper(idx=idx, sliding_window_dataset_lengths=self._sliding_window_datasets_lengths)
+        dataset_index, dataset_internal_index = \
+            self._resolve_index_helper(idx=idx, sliding_window_dataset_lengths=self._sliding_window_datasets_lengths)
+        if self._unmasked_window_indexes[dataset_index] is not None:
+            dataset_internal_index = int(self._unmasked_window_indexes[dataset_index][dataset_internal_index])
+        return dataset_index, dataset_internal_index
 
     def __getitem__(self, idx: int):
         assert -len(self) <= idx < len(self), "Index out of bounds"
         if idx < 0:
             idx = idx + len(self)
         dataset_index, dataset_internal_index = self._resolve_index(idx)
-        window_data = self._sliding_window_datasets[dataset_index][dataset_internal_index]
+        sliding_window_dataset = self._sliding_window_datasets[dataset_index]
+        window_arrays = sliding_window_dataset.get_window_arrays(dataset_internal_index)
 
-        features = np.zeros(shape=(len(FEATURE_SIGNAL_NAMES), len(window_data.signals)), dtype=np.float)
+        features = np.empty(shape=(len(FEATURE_SIGNAL_NAMES), window_arrays.features.shape[1]), dtype=np.float32)
         for i, signal_name in enumerate(FEATURE_SIGNAL_NAMES):
-            raw_signal_data = window_data.signals[signal_name].values
-            data = raw_signal_data if signal_name not in NORMALIZE_SIGNAL_NAMES else normalize_robust(raw_signal_data, center=False, scale=True)
+            raw_signal_data = window_arrays.features[sliding_window_dataset.signal_names.index(signal_name)]
+            if signal_name not in NORMALIZE_SIGNAL_NAMES:
+                data = raw_signal_data
+            elif self.config.precompute_normalization:
+                # Same result as normalize_robust, but with statistics that were computed for all windows at once
+                data = raw_signal_data.astype(np.float64) / sliding_window_dataset.get_robust_scales(signal_name)[dataset_internal_index]
+            else:
+                data = normalize_robust(raw_signal_data, center=False, scale=True)
             features[i, :] = data
 
-        gt = np.array([gt.value for gt in window_data.ground_truth], dtype=np.int)
-
         # Convert samples into tensors
-        features_tensor = torch.from_numpy(features).type(torch.float32)
-        gt_tensor = torch.tensor(gt, dtype=torch.long)
+        features_tensor = torch.from_numpy(features)
+        gt_tensor = torch.from_numpy(window_arrays.ground_truth.astype(np.int64))
 
         # Add noise
         if self.config.noise_mean_std is not None:
@@ -258,3 +297,74 @@ def test_performance(ai_dataset_provider):
     print()
     print(f"Total duration per whole dataset cycle: {duration_seconds/n_cycles:.1f}s")
     print(f"Duration per index read: {duration_seconds/n_cycles/len(ai_dataset)*1000:.2f}ms")
+
+
+def test_shared_records(tmp_path):
+    from util.datasets.physionet.reader import _write_test_record
+
+    dataset_folders = [_write_test_record(dataset_folder=tmp_path / f"tr00-000{i}", duration_seconds=900, seed=i) for i in range(2)]
+    configs = [AiDataset.Config(sliding_window_dataset_config=SlidingWindowDataset.Config(
+                   downsample_frequency_hz=5, time_window_size=pd.Timedelta(window_size), time_window_stride=stride,
+                   ground_truth_vector_width=gt_width),
+               dataset_folders=dataset_folders, noise_mean_std=None)
+               for window_size, stride, gt_width in (("2 minutes", 5, 11), ("5 minutes", 11, 1))]
+    ai_datasets = [AiDataset(config=c, n_processes=1) for c in configs]
+    for ds_a, ds_b in zip(*[d._sliding_window_datasets for d in ai_datasets]):
+        assert ds_a.record is ds_b.record
+    features, gt, _ = ai_datasets[1][len(ai_datasets[1]) - 1]
+    assert features.shape == (len(FEATURE_SIGNAL_NAMES), configs[1].sliding_window_dataset_config.time_window_size__index_steps)
+    assert gt.shape == (1,)
+
+
+def test_skip_masked(tmp_path):
+    from util.datasets.physionet.reader import _write_test_record
+
+    dataset_folders = [_write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=900)]
+    config = AiDataset.Config(sliding_window_dataset_config=SlidingWindowDataset.Config(
+                                  downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                  time_window_stride=5, ground_truth_vector_width=11),
+                              dataset_folders=dataset_folders, noise_mean_std=None, skip_masked=SignalMask.Wake)
+    ai_dataset = AiDataset(config=config, n_processes=1)
+    sliding_window_dataset = ai_dataset._sliding_window_datasets[0]
+    is_masked_window = sliding_window_dataset.get_window_mask(flags=SignalMask.Wake)
+    assert len(ai_dataset) == np.sum(~is_masked_window) < len(sliding_window_dataset)
+    for idx in (0, len(ai_dataset) // 2, len(ai_dataset) - 1):
+        dataset_index, dataset_internal_index = ai_dataset._resolve_index(idx)
+        assert not is_masked_window[dataset_internal_index]
+        features, _, _ = ai_dataset[idx]
+        expected_features = sliding_window_dataset.get_window_arrays(dataset_internal_index).features
+        assert np.array_equal(features[0].numpy(), expected_features[sliding_window_dataset.signal_names.index("SaO2")])
+
+
+def test_precompute_normalization(tmp_path):
+    from util.datasets.physionet.reader import _write_test_record
+
+    dataset_folders = [_write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1800)]
+    sliding_window_dataset_config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("5 minutes"),
+                                                                time_window_stride=5, ground_truth_vector_width=1)
+    ai_datasets = [AiDataset(config=AiDataset.Config(sliding_window_dataset_config=sliding_window_dataset_config,
+                                                     dataset_folders=dataset_folders, noise_mean_std=None,
+                                                     precompute_normalization=precompute), n_processes=1)
+                   for precompute in (True, False)]
+    assert len(ai_datasets[0]._sliding_window_datasets[0].record._window_statistics) == len(NORMALIZE_SIGNAL_NAMES)
+    for idx in range(0, len(ai_datasets[0]), 7):
+        assert torch.equal(ai_datasets[0][idx][0], ai_datasets[1][idx][0])
+
+
+@pytest.mark.speed
+def test_precompute_normalization__speed(tmp_path):
+    from util.datasets.physionet.reader import _write_test_record
+
+    dataset_folders = [_write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1800)]
+    sliding_window_dataset_config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("5 minutes"),
+                                                                time_window_stride=5, ground_truth_vector_width=1)
+    print()
+    for precompute in (True, False):
+        ai_dataset = AiDataset(config=AiDataset.Config(sliding_window_dataset_config=sliding_window_dataset_config,
+                                                       dataset_folders=dataset_folders, noise_mean_std=None,
+                                                       precompute_normalization=precompute), n_processes=1)
+        started_at = datetime.now()
+        for idx in range(len(ai_dataset)):
+            _ = ai_dataset[idx]
+        overall_seconds = (datetime.now() - started_at).total_seconds()
+        print(f"precompute_normalization={precompute}: {overall_seconds / len(ai_dataset) * 1_000_000:.1f}us per index")
@@ -55,11 +55,13 @@ training_dataset_config = ai_datasets.AiDataset.Config(
     sliding_window_dataset_config=sliding_window_dataset_config,
     dataset_folders=train_folders,
     noise_mean_std=(0, 0.2),
+    precompute_normalization=True,
 )
 test_dataset_config = ai_datasets.AiDataset.Config(
     sliding_window_dataset_config=sliding_window_dataset_config,
     dataset_folders=test_folders,
     noise_mean_std=None,
+    precompute_normalization=True,
 )
 
 # Pull some knowledge out of our train data set
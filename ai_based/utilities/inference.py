@@ -70,6 +70,12 @@ def retrieve_respiratory_events(model: torch.nn.Module, ai_dataset: AiDataset, b
 
     for i in range(len(prediction_vectors)):
         dataset_name = ai_dataset._sliding_window_datasets[i].dataset_name
+        # Windows that the AiDataset left out (see AiDataset.Config.skip_masked) were never predicted; they hold no event
+        unmasked_indexes_ = ai_dataset._unmasked_window_indexes[i]
+        if unmasked_indexes_ is not None:
+            is_skipped_ = np.ones(shape=prediction_vectors[i].shape, dtype=bool)
+            is_skipped_[unmasked_indexes_] = False
+            prediction_vectors[i][is_skipped_] = GroundTruthClass.NoEvent.value
         assert not np.any(np.isnan(prediction_vectors[i])), \
             f"We expect none of the predictions to be NaN! SlidingWindowDataset name: '{dataset_name}'"
         prediction_vectors[i] = prediction_vectors[i].astype(int)
@@ -94,10 +100,12 @@ def retrieve_respiratory_events(model: torch.nn.Module, ai_dataset: AiDataset, b
         # Translate SlidingWindowDataset-sample-index-based clusters to time-based events
         respiratory_events: List[RespiratoryEvent] = []
         for event_type in RespiratoryEventType:
-            for event_cluster in event_clusters[event_type]:
-                start = sliding_window_dataset[event_cluster.start].ground_truth.index[0]
-                end = sliding_window_dataset[event_cluster.end].ground_truth.index[-1]
-                respiratory_events += [RespiratoryEvent(start=start, aux_note=None, end=end, event_type=event_type)]
+            if len(event_clusters[event_type]) == 0:
+                continue
+            starts, _ = sliding_window_dataset.get_ground_truth_time_range(np.array([c.start for c in event_clusters[event_type]]))
+            _, ends = sliding_window_dataset.get_ground_truth_time_range(np.array([c.end for c in event_clusters[event_type]]))
+            respiratory_events += [RespiratoryEvent(start=start, aux_note=None, end=end, event_type=event_type)
+                                   for start, end in zip(starts, ends)]
         respiratory_events = sorted(respiratory_events, key=lambda ev: ev.start)
         respiratory_event_lists[sliding_window_dataset.dataset_name] = respiratory_events
 
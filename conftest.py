@@ -0,0 +1,18 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption("--run-speed", action="store_true", default=False, help="Also run speed tests (benchmarks)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "speed: benchmark that is skipped unless --run-speed is given")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-speed"):
+        return
+    skip_speed = pytest.mark.skip(reason="Speed test, use --run-speed to run it")
+    for item in items:
+        if "speed" in item.keywords:
+            item.add_marker(skip_speed)
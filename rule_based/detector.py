@@ -8,11 +8,13 @@ import pandas as pd
 import numpy as np
 import numba
 
-from util.mathutil import PeakType, IntRange, get_peaks, Peak
-from util.datasets import RespiratoryEvent, RespiratoryEventType
+from util.mathutil import PeakType, IntRange, PeakArrays, get_peak_arrays, slice_peak_arrays
+from util.datasets import RespiratoryEvent, RespiratoryEventType, PeakIndex
+from util.datasets.peak_index import detect_peak_arrays
 
 
 _NECESSARY_COLUMNS = ("AIRFLOW", "ABD", "CHEST", "SaO2")
+_PEAK_SIGNAL_NAMES = ("AIRFLOW", "CHEST", "ABD")  # Signals whose peaks we detect
 
 
 class _CoarseRespiratoryEventType(Enum):
@@ -22,127 +24,145 @@ class _CoarseRespiratoryEventType(Enum):
 
 @numba.jit(nopython=True)
 def _detect_airflow_resp_events(airflow_vector: np.ndarray, sample_frequency_hz: float,
-                                min_event_length_seconds: float = 10) -> Tuple[List[IntRange], List[_CoarseRespiratoryEventType]]:
-    """Takes a look at the AIRFLOW signal and determines areas of apneas/hypopneas."""
+                                min_event_length_seconds: float = 10, n_masked_until: Optional[np.ndarray] = None,
+                                airflow_peaks: Optional[PeakArrays] = None) -> Tuple[List[IntRange], List[_CoarseRespiratoryEventType]]:
+    """
+    Takes a look at the AIRFLOW signal and determines areas of apneas/hypopneas.
+
+    @param n_masked_until: Number of masked signal positions before each position (cumulated mask, of length
+                           len(airflow_vector)+1). Positions whose reference peaks touch masked positions are skipped.
+                           If None, nothing is skipped.
+    @param airflow_peaks: Peaks of the AIRFLOW signal, if they were already detected. If None, they are detected here.
+    """
     min_event_length = min_event_length_seconds * sample_frequency_hz
     max_event_length = 100*sample_frequency_hz
     moving_baseline_window_lr = 200  # specifies each direction (left/right) from current peak_index position
     filter_kernel_width = int(sample_frequency_hz*0.7)
     n_reference_peaks = 3
-    peaks: List[Peak] = get_peaks(waveform=airflow_vector, filter_kernel_width=filter_kernel_width)
+    if airflow_peaks is None:
+        peaks = get_peak_arrays(waveform=airflow_vector, filter_kernel_width=filter_kernel_width)
+    else:
+        peaks = airflow_peaks
+    n_peaks = len(peaks.starts)
+    abs_extreme_values = np.abs(peaks.extreme_values)
 
     event_areas: List[IntRange] = []
     coarse_event_types: List[_CoarseRespiratoryEventType] = []
     peak_index = 0
-    while peak_index < len(peaks)-n_reference_peaks:
+    while peak_index < n_peaks-n_reference_peaks:
+        # Skip masked areas (e.g. disconnected sensors, wake stages) without examining them any further
+        if n_masked_until is not None:
+            masked_range_start, masked_range_end = peaks.starts[peak_index], peaks.ends[peak_index + n_reference_peaks]
+            if n_masked_until[masked_range_end + 1] - n_masked_until[masked_range_start] > 0:
+                peak_index += 1
+                continue
         # Determine a moving baseline for values that surround our current peak_index-position
         moving_window_left_index = max(peak_index - moving_baseline_window_lr, 0)
-        moving_window_right_index = min(peak_index + moving_baseline_window_lr, len(peaks))
-        window_peaks = peaks[moving_window_left_index:moving_window_right_index]
-        moving_baseline = np.median(np.array([abs(p.extreme_value) for p in window_peaks]))
-        # moving_baseline = np.sqrt(np.mean(np.array([np.square(p.extreme_value) for p in window_peaks])))
+        moving_window_right_index = min(peak_index + moving_baseline_window_lr, n_peaks)
+        moving_baseline = np.median(abs_extreme_values[moving_window_left_index:moving_window_right_index])
+        # moving_baseline = np.sqrt(np.mean(np.square(peaks.extreme_values[moving_window_left_index:moving_window_right_index])))
         max_allowed_moving_baseline_value = 1.0 * moving_baseline
 
         # Determine the reference-peaks-baseline defined by the peaks directly at our current peak_index-position
-        reference_peaks = peaks[peak_index:peak_index + n_reference_peaks]
-        reference_peaks_baseline = np.sqrt(np.mean(np.array([np.square(abs(p.extreme_value)) for p in reference_peaks])))
+        reference_abs_extreme_values = abs_extreme_values[peak_index:peak_index + n_reference_peaks]
+        reference_peaks_baseline = np.sqrt(np.mean(np.square(reference_abs_extreme_values)))
         # Determine how many subsequent peaks we need to cover at least 10s
         head_index = peak_index + n_reference_peaks
-        lengths_right = np.array([p.length for p in peaks[head_index:]]).cumsum()
+        lengths_right = peaks.lengths[head_index:].cumsum()
         cumulated_lengths_larger_than = (lengths_right >= min_event_length)
         if np.sum(cumulated_lengths_larger_than) == 0:
             break
         tail_index = head_index + cumulated_lengths_larger_than.argmax()
         # Try to stretch the window longer, whilst preserving its baseline smaller than our above determined baselines
-        window_peaks = peaks[head_index:tail_index + 1]
-        outside_moving_baseline = np.array([abs(p.extreme_value) for p in window_peaks]) > max_allowed_moving_baseline_value
+        window_abs_extreme_values = abs_extreme_values[head_index:tail_index + 1]
+        outside_moving_baseline = window_abs_extreme_values > max_allowed_moving_baseline_value
         ratio_outside_moving_baseline = np.sum(outside_moving_baseline) / outside_moving_baseline.shape[0]
-        window_baseline = np.max(np.array([abs(p.extreme_value) for p in window_peaks]))
+        window_baseline = np.max(window_abs_extreme_values)
         if window_baseline > reference_peaks_baseline * 0.7 or ratio_outside_moving_baseline > 0.5:
             peak_index += 1
             continue
-        for tail_index in range(tail_index+1, len(peaks)):
-            window_peaks = peaks[head_index:tail_index + 1]
-            outside_moving_baseline = np.array([abs(p.extreme_value) for p in window_peaks]) > max_allowed_moving_baseline_value
+        for tail_index in range(tail_index+1, n_peaks):
+            window_abs_extreme_values = abs_extreme_values[head_index:tail_index + 1]
+            outside_moving_baseline = window_abs_extreme_values > max_allowed_moving_baseline_value
             ratio_outside_moving_baseline = np.sum(outside_moving_baseline) / outside_moving_baseline.shape[0]
-            window_baseline = np.max(np.array([abs(p.extreme_value) for p in window_peaks]))
+            window_baseline = np.max(window_abs_extreme_values)
             if window_baseline > reference_peaks_baseline * 0.7 or ratio_outside_moving_baseline > 0.5:
                 tail_index -= 1
                 break
         # Window longer than allowed? Smells like a false-positive!
-        window_length = peaks[tail_index].end - peaks[head_index].start + 1
+        window_length = peaks.ends[tail_index] - peaks.starts[head_index] + 1
         if window_length > max_event_length:
             peak_index += 1
             continue
         # Window tail is stretched. Now make sure the signal rises up to its initial (high) value afterwards again
-        post_tail_max_peak_index = min(len(peaks), tail_index+10)
-        post_tail_peaks = peaks[tail_index:post_tail_max_peak_index]
-        if np.sum(np.array([abs(p.extreme_value) > reference_peaks_baseline*0.9 for p in post_tail_peaks])) == 0:
+        post_tail_max_peak_index = min(n_peaks, tail_index+10)
+        if np.sum(abs_extreme_values[tail_index:post_tail_max_peak_index] > reference_peaks_baseline*0.9) == 0:
             peak_index += 1
             continue
         # Now, let the beginning of the window reach to the most-negative dip right before
-        pre_head_peaks = peaks[head_index-1:head_index+2]
-        min_index = np.argmin(np.array([p.extreme_value for p in pre_head_peaks]))
+        min_index = np.argmin(peaks.extreme_values[head_index-1:head_index+2])
         most_negative_dip_index = head_index - 1 + min_index
         # Determine the coarse type of our respiratory event:  Apnea/Hypopnea
-        window_peaks = peaks[head_index:tail_index + 1]
-        window_baseline = np.percentile(np.array([abs(p.extreme_value) for p in window_peaks]), 15)
-        type_decision_reference_peaks_baseline = np.max(np.array([(abs(p.extreme_value)) for p in reference_peaks]))
+        window_baseline = np.percentile(abs_extreme_values[head_index:tail_index + 1], 15)
+        type_decision_reference_peaks_baseline = np.max(reference_abs_extreme_values)
         coarse_event_type: _CoarseRespiratoryEventType = _CoarseRespiratoryEventType.Apnea \
             if window_baseline <= 0.1 * type_decision_reference_peaks_baseline else _CoarseRespiratoryEventType.Hypopnea
         coarse_event_types.append(coarse_event_type)
 
-        start = peaks[most_negative_dip_index].center
-        end = peaks[tail_index].end
+        start = peaks.centers[most_negative_dip_index]
+        end = peaks.ends[tail_index]
         event_areas.append(IntRange(start=start, end=end, length=end - start + 1))
 
         peak_index = tail_index
     return event_areas, coarse_event_types
 
 
-def _get_peak_index(time: int, peaks: List[Peak]) -> Optional[int]:
-    """Determines a peak's index within its list, depending on the given time"""
-    peak_endings = np.array([p.end for p in peaks])
-    flipped_index = (peak_endings < time)[::-1].argmax()
+def _get_peak_index(time: int, peaks: PeakArrays) -> Optional[int]:
+    """Determines a peak's index within its arrays, depending on the given time"""
+    flipped_index = (peaks.ends < time)[::-1].argmax()
     if flipped_index == 0:
         return None
-    index = len(peaks) - flipped_index
-    if peaks[index].start <= time:
+    index = len(peaks.ends) - flipped_index
+    if peaks.starts[index] <= time:
         return index
     return None
 
 
-def _get_pre_event_peaks(event_start_time: int, peaks: List[Peak], n_peaks: int) -> List[Peak]:
+def _get_pre_event_peaks(event_start_time: int, peaks: PeakArrays, n_peaks: int) -> PeakArrays:
     """
     Returns peaks that occurred directly before a given event.
 
     @param event_start_time: Start index (with respect to signal) of the event.
-    @param peaks: Peaks list of the entire signal. Pre-event peaks will be taken directly from here.
+    @param peaks: Peaks of the entire signal. Pre-event peaks will be taken directly from here.
     @param n_peaks: Number of pre-event peaks that we wish to get.
-    @return: List of pre-event peaks.
+    @return: Pre-event peaks, as views into the given peak arrays.
     """
-    if event_start_time > peaks[-1].end:
+    if event_start_time > peaks.ends[-1]:
         return peaks
 
     event_start_peak_index = _get_peak_index(time=event_start_time, peaks=peaks)
     if event_start_peak_index is None:
-        return []
+        return slice_peak_arrays(peaks, 0, 0)
 
     pre_event__end_index = event_start_peak_index - 1
     if pre_event__end_index < 0:
-        return []
+        return slice_peak_arrays(peaks, 0, 0)
     pre_event__start_index = max(0, pre_event__end_index-n_peaks+1)
-    pre_event_peaks = [p for p in peaks[pre_event__start_index:pre_event__end_index + 1]]
-    return pre_event_peaks
+    return slice_peak_arrays(peaks, pre_event__start_index, pre_event__end_index + 1)
 
 
-def _classify_apnea(apnea_time_range: IntRange, abd_peaks: List[Peak], chest_peaks: List[Peak]) -> RespiratoryEventType:
+def _get_peak_density(peaks: PeakArrays) -> float:
+    """Number of peaks per time quantum"""
+    return len(peaks.starts) / (int(peaks.ends[-1]) - int(peaks.starts[0]))
+
+
+def _classify_apnea(apnea_time_range: IntRange, abd_peaks: PeakArrays, chest_peaks: PeakArrays) -> RespiratoryEventType:
     """
     Classifies an already-detected apnea (no hypopnea!) upon ABD and CHEST signals
 
     @param apnea_time_range: Time range (with respect to our AIRFLOW/ABD/CHEST/etc. signals) of the apnea.
-    @param abd_peaks: Peaks list of the entire ABD signal.
-    @param chest_peaks: Peaks list of the entire CHEST signal.
+    @param abd_peaks: Peaks of the entire ABD signal.
+    @param chest_peaks: Peaks of the entire CHEST signal.
     @return: Classified type of the respiratory event.
     """
     n_pre_apnea_peaks = 10
@@ -150,26 +170,33 @@ def _classify_apnea(apnea_time_range: IntRange, abd_peaks: List[Peak], chest_pea
     baseline_range_factor__part_2 = 2/5
     baseline_threshold_factor = 0.25
     density_threshold_factor = 0.6
+
+    def _abs_extreme_values(peaks: PeakArrays) -> np.ndarray:
+        return np.abs(peaks.extreme_values.astype(np.float64))
+
     # Determine our pre-event baseline for both ABD and CHEST signals
     pre_apnea_abd_peaks = _get_pre_event_peaks(event_start_time=apnea_time_range.start, peaks=abd_peaks, n_peaks=n_pre_apnea_peaks)
     pre_apnea_chest_peaks = _get_pre_event_peaks(event_start_time=apnea_time_range.start, peaks=chest_peaks, n_peaks=n_pre_apnea_peaks)
-    pre_apnea_abd_baseline = np.median(np.array([abs(p.extreme_value) for p in pre_apnea_abd_peaks]))
-    pre_apnea_chest_baseline = np.median(np.array([abs(p.extreme_value) for p in pre_apnea_chest_peaks]))
+    pre_apnea_abd_baseline = np.median(_abs_extreme_values(pre_apnea_abd_peaks))
+    pre_apnea_chest_baseline = np.median(_abs_extreme_values(pre_apnea_chest_peaks))
     # Determine ABD and CHEST mid-apnea peaks
-    apnea_abd_peaks = abd_peaks[_get_peak_index(time=apnea_time_range.start, peaks=abd_peaks):_get_peak_index(time=apnea_time_range.end, peaks=abd_peaks)]
-    apnea_chest_peaks = chest_peaks[_get_peak_index(time=apnea_time_range.start, peaks=chest_peaks):_get_peak_index(time=apnea_time_range.end, peaks=chest_peaks)]
-    if len(apnea_abd_peaks) < 4 or len(apnea_chest_peaks) < 4:
+    apnea_abd_peaks = slice_peak_arrays(abd_peaks, _get_peak_index(time=apnea_time_range.start, peaks=abd_peaks), _get_peak_index(time=apnea_time_range.end, peaks=abd_peaks))
+    apnea_chest_peaks = slice_peak_arrays(chest_peaks, _get_peak_index(time=apnea_time_range.start, peaks=chest_peaks), _get_peak_index(time=apnea_time_range.end, peaks=chest_peaks))
+    n_apnea_abd_peaks, n_apnea_chest_peaks = len(apnea_abd_peaks.starts), len(apnea_chest_peaks.starts)
+    if n_apnea_abd_peaks < 4 or n_apnea_chest_peaks < 4:
         return RespiratoryEventType.CentralApnea  # Short-cut to prevent division-by-0 errors in the next lines
     # Determine the mid-event baselines for both of the signals
-    apnea_abd_baseline__part_1 = np.median(np.array([abs(p.extreme_value) for p in apnea_abd_peaks[:int(len(apnea_abd_peaks)*baseline_range_factor__part_1)]]))
-    apnea_abd_baseline__part_2 = np.median(np.array([abs(p.extreme_value) for p in apnea_abd_peaks[int(len(apnea_abd_peaks)*baseline_range_factor__part_2):]]))
-    apnea_chest_baseline__part_1 = np.median(np.array([abs(p.extreme_value) for p in apnea_chest_peaks[:int(len(apnea_chest_peaks)*baseline_range_factor__part_1)]]))
-    apnea_chest_baseline__part_2 = np.median(np.array([abs(p.extreme_value) for p in apnea_chest_peaks[int(len(apnea_chest_peaks)*baseline_range_factor__part_2):]]))
+    apnea_abd_abs_extreme_values = _abs_extreme_values(apnea_abd_peaks)
+    apnea_chest_abs_extreme_values = _abs_extreme_values(apnea_chest_peaks)
+    apnea_abd_baseline__part_1 = np.median(apnea_abd_abs_extreme_values[:int(n_apnea_abd_peaks*baseline_range_factor__part_1)])
+    apnea_abd_baseline__part_2 = np.median(apnea_abd_abs_extreme_values[int(n_apnea_abd_peaks*baseline_range_factor__part_2):])
+    apnea_chest_baseline__part_1 = np.median(apnea_chest_abs_extreme_values[:int(n_apnea_chest_peaks*baseline_range_factor__part_1)])
+    apnea_chest_baseline__part_2 = np.median(apnea_chest_abs_extreme_values[int(n_apnea_chest_peaks*baseline_range_factor__part_2):])
     # Determine the density of peaks (per time quantum)
-    pre_apnea_abd__peak_density = len(pre_apnea_abd_peaks) / (pre_apnea_abd_peaks[-1].end - pre_apnea_abd_peaks[0].start)
-    pre_apnea_chest__peak_density = len(pre_apnea_chest_peaks) / (pre_apnea_chest_peaks[-1].end - pre_apnea_chest_peaks[0].start)
-    apnea_abd__peak_density = len(apnea_abd_peaks) / (apnea_abd_peaks[-1].end - apnea_abd_peaks[0].start)
-    apnea_chest__peak_density = len(apnea_chest_peaks) / (apnea_chest_peaks[-1].end - apnea_chest_peaks[0].start)
+    pre_apnea_abd__peak_density = _get_peak_density(pre_apnea_abd_peaks)
+    pre_apnea_chest__peak_density = _get_peak_density(pre_apnea_chest_peaks)
+    apnea_abd__peak_density = _get_peak_density(apnea_abd_peaks)
+    apnea_chest__peak_density = _get_peak_density(apnea_chest_peaks)
 
     # Now let's specify the ApneaType
     def _is_mixed(pre_event_baseline, event_part_1, event_part_2) -> bool:
@@ -187,7 +214,9 @@ def _classify_apnea(apnea_time_range: IntRange, abd_peaks: List[Peak], chest_pea
 
 
 def detect_respiratory_events(signals: pd.DataFrame, sample_frequency_hz: float, awake_series: pd.Series = None,
-                              discard_invalid_hypopneas: bool = True, min_event_length_seconds: float = 10) -> List[RespiratoryEvent]:
+                              discard_invalid_hypopneas: bool = True, min_event_length_seconds: float = 10,
+                              mask: Optional[np.ndarray] = None, parallel: bool = False,
+                              peak_index: Optional[PeakIndex] = None) -> List[RespiratoryEvent]:
     """
     Detects respiratory events within a bunch of given signals.
 
@@ -197,27 +226,46 @@ def detect_respiratory_events(signals: pd.DataFrame, sample_frequency_hz: float,
                          will be discarded. If None is passed, no wake stages will be taken into account.
     @param discard_invalid_hypopneas: Denotes if potential hypopneas shall be discarded if SaO2 does not drop by >=3% accordingly.
     @param min_event_length_seconds: Defines the minimum seconds length of detected apneas/hypopneas. Shorter events will be discarded. Default value (as per AASM manual) is 10 seconds.
+    @param mask: Boolean vector (True=masked) of the same length as signals, e.g. obtained via
+                 SlidingWindowDataset.get_signal_mask(). Masked areas are skipped during detection, and events that
+                 overlap them are discarded. Unlike awake_series, this saves the detection work in these areas;
+                 detected events right next to masked areas may thus differ from an unmasked run.
+    @param parallel: If True, peaks of AIRFLOW, CHEST and ABD are detected concurrently on all cores, each signal split
+                     into chunks. Results are the same. Meant for low latency on single records; when processing many
+                     records at once (see detect_respiratory_events_multicore), leave it False.
+    @param peak_index: Index that AIRFLOW, CHEST and ABD peaks are taken from/stored to, e.g. the peak_index of the
+                       SlidingWindowDataset that the signals belong to. If None, peaks are always detected.
     @return: List of detected respiratory events.
     """
     assert all([col in signals for col in _NECESSARY_COLUMNS]), \
         f"At least one of the necessary columns ({_NECESSARY_COLUMNS}) is missing in the passed DataFrame"
+    n_awake_until: Optional[np.ndarray] = None
     if awake_series is not None:
-        assert awake_series.index == signals.index, "Indexes of both 'signals' and 'is_awake' must be equal!"
-    ranges, coarse_respiratory_event_types = _detect_airflow_resp_events(airflow_vector=signals["AIRFLOW"].values, sample_frequency_hz=sample_frequency_hz, min_event_length_seconds=min_event_length_seconds)
-    chest_peaks = get_peaks(waveform=signals["CHEST"].values, filter_kernel_width=int(sample_frequency_hz*0.7))
-    abd_peaks = get_peaks(waveform=signals["ABD"].values, filter_kernel_width=int(sample_frequency_hz * 0.7))
+        assert awake_series.index.equals(signals.index), "Indexes of both 'signals' and 'is_awake' must be equal!"
+        n_awake_until = np.concatenate([[0], np.cumsum(awake_series.values != 0)])
+    n_masked_until: Optional[np.ndarray] = None
+    if mask is not None:
+        assert len(mask) == len(signals), "Lengths of both 'signals' and 'mask' must be equal!"
+        n_masked_until = np.concatenate([[0], np.cumsum(mask != 0)])
+    peak_waveforms = [signals[signal_name].values for signal_name in _PEAK_SIGNAL_NAMES]
+    if peak_index is None:
+        airflow_peaks, chest_peaks, abd_peaks = detect_peak_arrays(waveforms=peak_waveforms, filter_kernel_width=int(sample_frequency_hz*0.7), parallel=parallel)
+    else:
+        airflow_peaks, chest_peaks, abd_peaks = peak_index.get_peak_arrays(signal_names=_PEAK_SIGNAL_NAMES, waveforms=peak_waveforms,
+                                                                           filter_kernel_width=int(sample_frequency_hz*0.7), parallel=parallel)
+    ranges, coarse_respiratory_event_types = _detect_airflow_resp_events(airflow_vector=signals["AIRFLOW"].values, sample_frequency_hz=sample_frequency_hz, min_event_length_seconds=min_event_length_seconds, n_masked_until=n_masked_until, airflow_peaks=airflow_peaks)
 
     apnea_events: List[RespiratoryEvent] = []
     n_discarded_wake_stages = 0
+    n_discarded_masked = 0
     n_filtered_hypopneas = 0
     for range, coarse_type in zip(ranges, coarse_respiratory_event_types):
-        if awake_series is not None:
-            is_awake_values = awake_series.values != 0
-            range_mat = np.zeros(shape=(len(signals),), dtype=bool)
-            range_mat[range.start:range.end] = True
-            if np.sum(is_awake_values & range_mat) != 0:
-                n_discarded_wake_stages += 1
-                continue
+        if n_awake_until is not None and n_awake_until[range.end] - n_awake_until[range.start] > 0:
+            n_discarded_wake_stages += 1
+            continue
+        if n_masked_until is not None and n_masked_until[range.end + 1] - n_masked_until[range.start] > 0:
+            n_discarded_masked += 1
+            continue
         start = signals.index[range.start]
         end = signals.index[range.end]
 
@@ -237,20 +285,23 @@ def detect_respiratory_events(signals: pd.DataFrame, sample_frequency_hz: float,
 
         apnea_events += [RespiratoryEvent(start=start, end=end, aux_note=None, event_type=event_type)]
 
-    if awake_series:
+    if awake_series is not None:
         print(f"Discarded {n_discarded_wake_stages} detected respiratory events, as they overlap with wake stages")
+    if mask is not None:
+        print(f"Discarded {n_discarded_masked} detected respiratory events, as they overlap with masked areas")
     if discard_invalid_hypopneas is True:
         print(f"Discarded {n_filtered_hypopneas} hypopneas, due to SaO2 not falling by 3%")
     return apnea_events
 
 
-def _mp_exec_fn(index: int, signals_list: List[pd.DataFrame], awake_series_list: List[Optional[pd.Series]], sample_frequency_hz: float, discard_invalid_hypopneas: bool, min_event_length_seconds: float):
+def _mp_exec_fn(index: int, signals_list: List[pd.DataFrame], awake_series_list: List[Optional[pd.Series]], sample_frequency_hz: float, discard_invalid_hypopneas: bool, min_event_length_seconds: float, masks_list: List[Optional[np.ndarray]], peak_indexes: List[Optional[PeakIndex]]):
     """Just an internal helper function. Wraps multicore access."""
     try:
         return detect_respiratory_events(signals=signals_list[index], sample_frequency_hz=sample_frequency_hz,
                                          awake_series=awake_series_list[index],
                                          discard_invalid_hypopneas=discard_invalid_hypopneas,
-                                         min_event_length_seconds=min_event_length_seconds)
+                                         min_event_length_seconds=min_event_length_seconds, mask=masks_list[index],
+                                         peak_index=peak_indexes[index])
     except (KeyboardInterrupt, SystemExit):
         raise
     except BaseException as e:
@@ -260,7 +311,9 @@ def _mp_exec_fn(index: int, signals_list: List[pd.DataFrame], awake_series_list:
 def detect_respiratory_events_multicore(signals: List[pd.DataFrame], sample_frequency_hz: float,
                                         awake_series: List[Optional[pd.Series]] = None,
                                         discard_invalid_hypopneas = True, min_event_length_seconds: float = 10,
-                                        progress_fn=None, n_processes: int = None) -> List[List[RespiratoryEvent]]:
+                                        progress_fn=None, n_processes: int = None,
+                                        masks: List[Optional[np.ndarray]] = None,
+                                        peak_indexes: List[Optional[PeakIndex]] = None) -> List[List[RespiratoryEvent]]:
     """
     Essentially the same as the function detect_respiratory_events, just that its heavy calculations will be performed
     on multiple CPU cores.
@@ -275,6 +328,10 @@ def detect_respiratory_events_multicore(signals: List[pd.DataFrame], sample_freq
     @param min_event_length_seconds: Defines the minimum seconds length of detected apneas/hypopneas. Shorter events will be discarded. Default value (as per AASM manual) is 10 seconds.
     @param progress_fn: Function that may print prediction progress, e.g. tqdm. If None, no progress will be shown.
     @param n_processes: Number of processes we wish spread the work to. If None, an optimum will be chosen.
+    @param masks: Masks of areas that shall be skipped (see detect_respiratory_events). If a list is passed, its length
+                  must match the length of signals list. Single list elements may be None.
+    @param peak_indexes: Peak index of each dataset (see detect_respiratory_events). If a list is passed, its length
+                         must match the length of signals list. Single list elements may be None.
 
     @return: A list of the same length as the signals list.
     """
@@ -286,6 +343,14 @@ def detect_respiratory_events_multicore(signals: List[pd.DataFrame], sample_freq
         awake_series = [None] * len(signals)
     assert len(signals) == len(awake_series), \
         f"Length of passed 'awake_series' list ({len(awake_series)}) differs from 'signals' list ({len(signals)})"
+    if masks is None:
+        masks = [None] * len(signals)
+    assert len(signals) == len(masks), \
+        f"Length of passed 'masks' list ({len(masks)}) differs from 'signals' list ({len(signals)})"
+    if peak_indexes is None:
+        peak_indexes = [None] * len(signals)
+    assert len(signals) == len(peak_indexes), \
+        f"Length of passed 'peak_indexes' list ({len(peak_indexes)}) differs from 'signals' list ({len(signals)})"
 
     affinity = len(os.sched_getaffinity(0))
     if n_processes is None:
@@ -300,7 +365,7 @@ def detect_respiratory_events_multicore(signals: List[pd.DataFrame], sample_freq
 
     # Let's get started
     with mp.Pool(processes=n_processes) as pool:
-        load_fn_ = functools.partial(_mp_exec_fn, signals_list=signals, awake_series_list=awake_series, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=discard_invalid_hypopneas, min_event_length_seconds=min_event_length_seconds)
+        load_fn_ = functools.partial(_mp_exec_fn, signals_list=signals, awake_series_list=awake_series, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=discard_invalid_hypopneas, min_event_length_seconds=min_event_length_seconds, masks_list=masks, peak_indexes=peak_indexes)
         loading_results = list(progress_fn(pool.imap(load_fn_, range(len(signals)))))
         results: List[List[RespiratoryEvent]] = loading_results
     return results
@@ -358,3 +423,61 @@ def test_development__multiprocessing():
 
     events_lists = detect_respiratory_events_multicore(signals=[sliding_window_dataset.signals], sample_frequency_hz=config.downsample_frequency_hz, awake_series=None)
     pass
+
+
+def _make_synthetic_breathing_signals(sample_frequency_hz: int = 5) -> pd.DataFrame:
+    """Synthetic breathing of one hour, interrupted by a 20s apnea every 3 minutes. ABD & CHEST breathe a bit out of phase."""
+    t = np.arange(3600 * sample_frequency_hz) / sample_frequency_hz
+    amplitude = np.ones(shape=t.shape)
+    for apnea_start in range(120, 3540, 180):
+        amplitude[apnea_start*sample_frequency_hz:(apnea_start+20)*sample_frequency_hz] = 0.05
+    noise = np.random.default_rng(0).normal(scale=0.01, size=(3, len(t)))
+    return pd.DataFrame({"AIRFLOW": np.sin(2*np.pi*0.25*t) * amplitude + noise[0],
+                         "ABD": np.sin(2*np.pi*0.25*t + 0.3) * amplitude + noise[1],
+                         "CHEST": np.sin(2*np.pi*0.25*t - 0.3) * amplitude + noise[2], "SaO2": 97.0},
+                        index=pd.timedelta_range(start="0s", periods=len(t), freq=pd.Timedelta(seconds=1/sample_frequency_hz))).astype(np.float32)
+
+
+def test_detect_respiratory_events__masks():
+    sample_frequency_hz = 5
+    signals = _make_synthetic_breathing_signals(sample_frequency_hz=sample_frequency_hz)
+
+    events = detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=False)
+    assert len(events) == 19
+    assert detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=False,
+                                     mask=np.zeros(shape=(len(signals),), dtype=bool)) == events
+
+    # Events overlapping wake stages are discarded
+    awake_series = pd.Series(data=(signals.index.total_seconds() // 900) % 2, index=signals.index)  # Awake during the second & fourth quarter hour
+    awake_events = detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz,
+                                             awake_series=awake_series, discard_invalid_hypopneas=False)
+    assert awake_events == [e for e in events if not np.any(awake_series[e.start:e.end].values[:-1])]
+    assert 0 < len(awake_events) < len(events)
+
+    # Masked areas are skipped, so no event overlaps them. Apart from that, the same events are found
+    masked_events = detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz,
+                                              discard_invalid_hypopneas=False, mask=awake_series.values != 0)
+    assert masked_events == awake_events
+
+
+def test_detect_respiratory_events__parallel():
+    sample_frequency_hz = 5
+    signals = _make_synthetic_breathing_signals(sample_frequency_hz=sample_frequency_hz)
+
+    events = detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=False)
+    assert len(events) > 0
+    assert detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz,
+                                     discard_invalid_hypopneas=False, parallel=True) == events
+
+
+def test_detect_respiratory_events__peak_index(tmp_path):
+    sample_frequency_hz = 5
+    signals = _make_synthetic_breathing_signals(sample_frequency_hz=sample_frequency_hz)
+    events = detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz, discard_invalid_hypopneas=False)
+
+    # First run fills the index, second run takes all peaks (memory-mapped) from it
+    peak_index = PeakIndex(cache_folder=tmp_path / "peaks")
+    for _ in range(2):
+        assert detect_respiratory_events(signals=signals, sample_frequency_hz=sample_frequency_hz,
+                                         discard_invalid_hypopneas=False, peak_index=peak_index) == events
+        assert len(peak_index._cache.info()) == len(_PEAK_SIGNAL_NAMES)
@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
 
-from util.mathutil import Peak, PeakType
+from util.mathutil import Peak, PeakType, peak_list_to_arrays
 from .detector import detect_respiratory_events, _get_pre_event_peaks, _get_peak_index, _detect_airflow_resp_events
 
 
@@ -12,12 +12,13 @@ def test_get_pre_event_peaks():
              Peak(type=PeakType.Minimum, extreme_value=1, start=41, end=50, center=0, length=0),
              Peak(type=PeakType.Minimum, extreme_value=1, start=51, end=60, center=0, length=0),
              Peak(type=PeakType.Minimum, extreme_value=1, start=61, end=70, center=0, length=0)]
-    assert len(_get_pre_event_peaks(event_start_time=5, peaks=peaks, n_peaks=5)) == 0
-    assert len(_get_pre_event_peaks(event_start_time=12, peaks=peaks, n_peaks=5)) == 0
-    assert len(_get_pre_event_peaks(event_start_time=15, peaks=peaks, n_peaks=5)) == 0
-    assert len(_get_pre_event_peaks(event_start_time=16, peaks=peaks, n_peaks=5)) == 1
-    assert len(_get_pre_event_peaks(event_start_time=30, peaks=peaks, n_peaks=5)) == 1
-    assert len(_get_pre_event_peaks(event_start_time=100, peaks=peaks, n_peaks=5)) == 6
+    peaks = peak_list_to_arrays(peaks)
+    assert len(_get_pre_event_peaks(event_start_time=5, peaks=peaks, n_peaks=5).starts) == 0
+    assert len(_get_pre_event_peaks(event_start_time=12, peaks=peaks, n_peaks=5).starts) == 0
+    assert len(_get_pre_event_peaks(event_start_time=15, peaks=peaks, n_peaks=5).starts) == 0
+    assert len(_get_pre_event_peaks(event_start_time=16, peaks=peaks, n_peaks=5).starts) == 1
+    assert len(_get_pre_event_peaks(event_start_time=30, peaks=peaks, n_peaks=5).starts) == 1
+    assert len(_get_pre_event_peaks(event_start_time=100, peaks=peaks, n_peaks=5).starts) == 6
 
 
 def test_get_peak_index():
@@ -27,6 +28,7 @@ def test_get_peak_index():
              Peak(type=PeakType.Minimum, extreme_value=1, start=41, end=50, center=0, length=0),
              Peak(type=PeakType.Minimum, extreme_value=1, start=51, end=60, center=0, length=0),
              Peak(type=PeakType.Minimum, extreme_value=1, start=61, end=70, center=0, length=0)]
+    peaks = peak_list_to_arrays(peaks)
     assert _get_peak_index(time=33, peaks=peaks) == 2
     assert _get_peak_index(time=31, peaks=peaks) == 2
     assert _get_peak_index(time=40, peaks=peaks) == 2
@@ -1,5 +1,10 @@
-from .physionet import PhysioNetDataset, RespiratoryEvent, EnduringEvent, TransientEvent, RespiratoryEventType, read_physionet_dataset
-from .sliding_window import SlidingWindowDataset, GroundTruthClass, RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS
+from .physionet import PhysioNetDataset, RespiratoryEvent, EnduringEvent, TransientEvent, RespiratoryEventType, read_physionet_dataset, \
+    EventTable, EventKind
+from .sliding_window import SlidingWindowDataset, SlidingWindowRecord, GroundTruthClass, SignalMask, \
+    RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS
+from .live_sliding_window import LiveSlidingWindowDataset
+from .signal_codec import QuantizedSignalCodec
+from .peak_index import PeakIndex, LowpassPrefilter
 
 __author__ = "Robert Voelckner"
 __copyright__ = "Copyright 2021"
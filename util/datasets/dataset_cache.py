@@ -0,0 +1,483 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+import uuid
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Optional, List, Tuple, Sequence, Callable
+
+import numpy as np
+import pandas as pd
+
+from .physionet import PhysioNetDataset, EventTable
+from .signal_codec import QuantizedSignalCodec, decode_signals
+
+
+CACHE_FOLDER_NAME = "cache"  # Default sub-folder (within a dataset folder) that holds the cache entries
+_META_FILE_NAME = "meta.json"
+_LOCK_FILE_SUFFIX = ".lock"
+_TEMP_FOLDER_PREFIX = ".tmp-"
+_CACHE_FORMAT_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CacheEntryInfo:
+    key: str
+    folder: Path
+    n_bytes: int
+    last_used: datetime
+    meta: Dict[str, Any]
+
+
+def fingerprint_files(files: Sequence[Path]) -> List[Tuple[str, int, int]]:
+    """
+    Cheap fingerprint of source files: name, size & modification time of each file. Files that don't exist are left
+    out. Changing (or replacing) any of the source files therefore results in another cache key.
+    """
+    fingerprints = []
+    for f in sorted(files):
+        if f.is_file():
+            stat = f.stat()
+            fingerprints += [(f.name, stat.st_size, stat.st_mtime_ns)]
+    return fingerprints
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Derives a cache key by hashing the given parts (e.g. config, source fingerprints and code version). The parts must
+    be JSON-serializable; everything else is serialized via its repr().
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:24]
+
+
+class DatasetCache:
+    """
+    Folder of cache entries, each entry identified by a key (see make_cache_key). An entry consists of named numpy
+    arrays, stored as .npy files (no pickles), and a JSON-serializable meta dictionary.
+
+    The cache holds multiple entries at a time, e.g. one per dataset config. Least recently used entries are evicted
+    once the configured maximum number of entries or maximum size is exceeded.
+
+    The cache may be shared by several processes, also across nodes on a shared file system:
+    - Entries are written to a temporary folder first & renamed afterwards, so readers never see a torn entry.
+    - get_or_build(...) takes a per-entry build lock, so exactly one process builds an entry while the others wait
+      and reuse its result.
+    - Each array carries a checksum, which is validated when loading. Corrupt entries are removed.
+
+    Optionally, (2-D float) arrays can be stored in a more compact, lossy format (see QuantizedSignalCodec) instead of
+    .npy files. Such arrays allow to load sample ranges without reading the whole array; see load_array_range(...).
+    """
+    def __init__(self, cache_folder: Path, max_entries: Optional[int] = 8, max_bytes: Optional[int] = None,
+                 lock_timeout_seconds: float = 60 * 60, array_codecs: Optional[Dict[str, QuantizedSignalCodec]] = None):
+        """
+        :param cache_folder: Folder that holds the cache entries. Will be created on demand.
+        :param max_entries: Maximum number of entries. If None, the number of entries is not limited.
+        :param max_bytes: Maximum overall size of all entries. If None, the size is not limited.
+        :param lock_timeout_seconds: Build locks (and temporary folders) older than this are considered stale, i.e.
+                                     left behind by a crashed process. They are broken/removed then.
+        :param array_codecs: Codec per array name, for arrays that shall be stored encoded. Only affects storing;
+                             encoded arrays are always decoded when loading.
+        """
+        self.cache_folder = cache_folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self.array_codecs: Dict[str, QuantizedSignalCodec] = {} if array_codecs is None else dict(array_codecs)
+
+    def _entry_folder(self, key: str) -> Path:
+        return self.cache_folder / key
+
+    def _lock_file(self, key: str) -> Path:
+        return self.cache_folder / f"{key}{_LOCK_FILE_SUFFIX}"
+
+    def contains(self, key: str) -> bool:
+        return (self._entry_folder(key) / _META_FILE_NAME).is_file()
+
+    def load(self, key: str, mmap_mode: Optional[str] = None,
+             verify: Optional[bool] = None) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+        """
+        Loads an entry. Returns its arrays & its meta dictionary, or None if there is no (valid) entry for the key.
+
+        :param mmap_mode: If given (e.g. "r"), .npy arrays are memory-mapped instead of read into memory, see np.load.
+                          Encoded arrays are decoded anyway.
+        :param verify: If True, the checksums of .npy arrays are validated, which reads them entirely. If None, this is
+                       only done for arrays that are read into memory. Memory-mapped arrays are then only checked for
+                       a valid header & file size, so that their data is not read before it is accessed. (Encoded
+                       arrays are always validated, chunk by chunk while decoding.)
+        """
+        entry_folder = self._entry_folder(key)
+        meta_file = entry_folder / _META_FILE_NAME
+        if not meta_file.is_file():
+            return None
+        try:
+            with open(file=meta_file, mode="r") as file:
+                data = json.load(file)
+            if data["format_version"] != _CACHE_FORMAT_VERSION:
+                return None
+            encoded_arrays = data.get("encoded_arrays", {})
+            arrays = {name: np.load(file=entry_folder / f"{name}.npy", mmap_mode=mmap_mode, allow_pickle=False)
+                      for name in data["arrays"] if name not in encoded_arrays}
+            verify = mmap_mode is None if verify is None else verify
+            is_corrupt = verify and any(_checksum(arrays[name]) != checksum for name, checksum in data["checksums"].items())
+            if not is_corrupt:
+                try:
+                    arrays.update({name: decode_signals(entry_folder / f"{name}.bin", meta=codec_meta)
+                                   for name, codec_meta in encoded_arrays.items()})
+                except ValueError:
+                    is_corrupt = True
+            if is_corrupt:
+                logger.warning(f"Cache entry '{entry_folder}' is corrupt and gets removed")
+                self._remove_entry(entry_folder=entry_folder)
+                return None
+            arrays = {name: arrays[name] for name in data["arrays"]}
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException:  # We intentionally catch everything here! A broken entry is treated like a missing one
+            return None
+        try:
+            os.utime(meta_file)  # Mark the entry as recently used
+        except OSError:
+            pass  # Entry was evicted in the meantime, which doesn't bother us since the data is loaded already
+        return arrays, data["meta"]
+
+    def load_array_range(self, key: str, name: str, start: int, stop: int) -> Optional[np.ndarray]:
+        """
+        Loads the rows start..stop (exclusive) of a single array of an entry, e.g. the samples of a single window. Of
+        encoded arrays, only the chunks holding these rows are read & decoded; .npy arrays are memory-mapped. Returns
+        None if there is no (valid) entry for the key.
+        """
+        entry_folder = self._entry_folder(key)
+        try:
+            with open(file=entry_folder / _META_FILE_NAME, mode="r") as file:
+                data = json.load(file)
+            if data["format_version"] != _CACHE_FORMAT_VERSION or name not in data["arrays"]:
+                return None
+            if name in data.get("encoded_arrays", {}):
+                return decode_signals(entry_folder / f"{name}.bin", meta=data["encoded_arrays"][name], start=start, stop=stop)
+            array = np.load(file=entry_folder / f"{name}.npy", mmap_mode="r", allow_pickle=False)
+            return np.array(array[start:stop])
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException:  # Same as in load(...): a broken entry is treated like a missing one
+            return None
+
+    def store(self, key: str, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        """
+        Atomically stores an entry. In case an entry of the same key already exists, it is kept. (Since the key is
+        derived from everything the entry depends on, both entries are equal anyway.) Evicts least recently used
+        entries afterwards.
+        """
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        temp_folder = self.cache_folder / f"{_TEMP_FOLDER_PREFIX}{key}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        temp_folder.mkdir()
+        try:
+            encoded_arrays = {}
+            for name, array in arrays.items():
+                if name in self.array_codecs:
+                    payload, encoded_arrays[name] = self.array_codecs[name].encode(array)
+                    (temp_folder / f"{name}.bin").write_bytes(payload)
+                else:
+                    np.save(file=temp_folder / f"{name}.npy", arr=array, allow_pickle=False)
+            data = {
+                "format_version": _CACHE_FORMAT_VERSION,
+                "created_at": datetime.now().isoformat(),
+                "arrays": list(arrays.keys()),
+                "checksums": {name: _checksum(array) for name, array in arrays.items() if name not in encoded_arrays},
+                "encoded_arrays": encoded_arrays,  # Encoded arrays carry checksums per chunk
+                "meta": meta,
+            }
+            with open(file=temp_folder / _META_FILE_NAME, mode="w") as file:
+                json.dump(obj=data, fp=file)
+                file.flush()
+                os.fsync(file.fileno())
+            try:
+                os.rename(temp_folder, self._entry_folder(key))
+            except OSError:
+                if not self.contains(key):
+                    raise
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+        self.prune(max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def get_or_build(self, key: str, build_fn: Callable[[], Tuple[Dict[str, np.ndarray], Dict[str, Any]]],
+                     poll_interval_seconds: float = 1.0, mmap_mode: Optional[str] = None) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """
+        Loads an entry. In case it does not exist yet, it is built via build_fn & stored. Concurrent callers (other
+        processes or nodes) that ask for the same key wait for the building one & then load its result.
+
+        :param build_fn: Returns arrays & meta dictionary of the entry.
+        :param mmap_mode: Memory-maps loaded .npy arrays, see load(...). Arrays that were just built are returned as is.
+        :return: Arrays & meta dictionary of the entry.
+        """
+        entry = self.load(key=key, mmap_mode=mmap_mode)
+        if entry is not None:
+            return entry
+        with self._build_lock(key=key, poll_interval_seconds=poll_interval_seconds):
+            entry = self.load(key=key, mmap_mode=mmap_mode)  # Someone else might have built it while we were waiting for the lock
+            if entry is not None:
+                return entry
+            arrays, meta = build_fn()
+            self.store(key=key, arrays=arrays, meta=meta)
+        # Lossy codecs: return the very same values that later loads of this entry return
+        arrays = {name: self.array_codecs[name].roundtrip(array) if name in self.array_codecs else array
+                  for name, array in arrays.items()}
+        return arrays, meta
+
+    @contextlib.contextmanager
+    def _build_lock(self, key: str, poll_interval_seconds: float):
+        """Exclusive per-entry lock, based on a lock file that is created atomically (works on NFS, too)."""
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        lock_file = self._lock_file(key)
+        fd = None
+        while fd is None:
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self.contains(key):
+                    break  # The lock owner is done building, no need to wait until it released the lock
+                try:
+                    lock_age_seconds = time.time() - lock_file.stat().st_mtime
+                except FileNotFoundError:
+                    continue  # Lock was released in the meantime
+                if lock_age_seconds > self.lock_timeout_seconds:
+                    logger.warning(f"Breaking stale cache build lock '{lock_file}'")
+                    lock_file.unlink(missing_ok=True)
+                    continue
+                time.sleep(poll_interval_seconds)
+        if fd is None:
+            yield
+            return
+        try:
+            with os.fdopen(fd, mode="w") as file:
+                file.write(f"{socket.gethostname()}:{os.getpid()}")
+            yield
+        finally:
+            lock_file.unlink(missing_ok=True)
+
+    def _remove_entry(self, entry_folder: Path):
+        """Removes an entry. It is renamed first, so that concurrent readers never see a half-removed entry."""
+        trash_folder = self.cache_folder / f"{_TEMP_FOLDER_PREFIX}removed-{entry_folder.name}-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(entry_folder, trash_folder)
+        except OSError:
+            return  # Someone else removed it already
+        shutil.rmtree(trash_folder, ignore_errors=True)
+
+    def info(self) -> List[CacheEntryInfo]:
+        """Returns information on all complete entries, most recently used entries first."""
+        if not self.cache_folder.is_dir():
+            return []
+        infos = []
+        for entry_folder in self.cache_folder.iterdir():
+            meta_file = entry_folder / _META_FILE_NAME
+            if entry_folder.name.startswith(_TEMP_FOLDER_PREFIX) or not meta_file.is_file():
+                continue
+            try:
+                with open(file=meta_file, mode="r") as file:
+                    meta = json.load(file).get("meta", {})
+                n_bytes = sum(f.stat().st_size for f in entry_folder.iterdir() if f.is_file())
+                last_used = datetime.fromtimestamp(meta_file.stat().st_mtime)
+            except (ValueError, OSError):
+                continue  # Entry was evicted in the meantime
+            infos += [CacheEntryInfo(key=entry_folder.name, folder=entry_folder, n_bytes=n_bytes, last_used=last_used,
+                                     meta=meta)]
+        return sorted(infos, key=lambda i: i.last_used, reverse=True)
+
+    def prune(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+              unused_since: Optional[datetime] = None) -> List[CacheEntryInfo]:
+        """
+        Removes least recently used entries, until all given limits are met. Stale temporary folders (e.g. left behind
+        by a crashed process) are removed as well.
+
+        :param max_entries: Maximum number of entries that are kept.
+        :param max_bytes: Maximum overall size of the entries that are kept.
+        :param unused_since: Entries that have not been used since then are removed.
+        :return: Information on the removed entries.
+        """
+        if not self.cache_folder.is_dir():
+            return []
+        for temp_folder in self.cache_folder.glob(f"{_TEMP_FOLDER_PREFIX}*"):
+            try:
+                if time.time() - temp_folder.stat().st_mtime > self.lock_timeout_seconds:
+                    shutil.rmtree(temp_folder, ignore_errors=True)
+            except OSError:
+                pass
+
+        kept_bytes, removed = 0, []
+        for i, info in enumerate(self.info()):
+            keep = (max_entries is None or i < max_entries) and \
+                   (max_bytes is None or kept_bytes + info.n_bytes <= max_bytes) and \
+                   (unused_since is None or info.last_used >= unused_since)
+            if keep:
+                kept_bytes += info.n_bytes
+            else:
+                self._remove_entry(entry_folder=info.folder)
+                removed += [info]
+        return removed
+
+    def clear(self) -> None:
+        """Removes all entries."""
+        if self.cache_folder.is_dir():
+            shutil.rmtree(self.cache_folder)
+
+
+def _checksum(array: np.ndarray) -> int:
+    return zlib.crc32(memoryview(np.ascontiguousarray(array)).cast("B"))
+
+
+_EVENT_TABLE_ARRAYS = ("starts", "ends", "kinds", "type_codes", "aux_note_ids")
+
+
+def physionet_dataset_to_cache_entry(dataset: PhysioNetDataset) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Splits a PhysioNetDataset into arrays & meta data, as expected by DatasetCache.store(...)."""
+    signals_index = dataset.signals.index.values.astype("timedelta64[ns]")  # Entries always store the index in ns
+    arrays = {"signals": dataset.signals.values, "signals_index": signals_index.view(np.int64)}
+    meta = {"columns": list(dataset.signals.columns), "signal_units": list(dataset.signal_units),
+            "sample_frequency_hz": dataset.sample_frequency_hz, "signals_index_freq": dataset.signals.index.freqstr,
+            "has_event_table": dataset.event_table is not None}
+    if dataset.event_table is not None:
+        arrays.update({f"events__{name}": getattr(dataset.event_table, name) for name in _EVENT_TABLE_ARRAYS})
+        meta.update({"events__aux_notes": list(dataset.event_table.aux_notes),
+                     "events__sample_frequency_hz": dataset.event_table.sample_frequency_hz})
+    return arrays, meta
+
+
+def physionet_dataset_from_cache_entry(arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> PhysioNetDataset:
+    """Counterpart of physionet_dataset_to_cache_entry."""
+    index = pd.TimedeltaIndex(arrays["signals_index"].view("timedelta64[ns]"), freq=meta["signals_index_freq"])
+    event_table = None
+    if meta["has_event_table"]:
+        event_table = EventTable(sample_frequency_hz=meta["events__sample_frequency_hz"],
+                                 aux_notes=tuple(meta["events__aux_notes"]),
+                                 **{name: arrays[f"events__{name}"] for name in _EVENT_TABLE_ARRAYS})
+    return PhysioNetDataset(signals=pd.DataFrame(data=arrays["signals"], index=index, columns=meta["columns"]),
+                            signal_units=meta["signal_units"], sample_frequency_hz=meta["sample_frequency_hz"],
+                            event_table=event_table)
+
+
+def find_dataset_caches(root_folder: Path) -> List[DatasetCache]:
+    """Returns the caches of all dataset folders within a root folder (e.g. for corpus-wide info/prune)."""
+    cache_folders = sorted(f for f in root_folder.glob(f"*/{CACHE_FOLDER_NAME}") if f.is_dir())
+    return [DatasetCache(cache_folder=f) for f in cache_folders]
+
+
+def test_dataset_cache(tmp_path):
+    cache = DatasetCache(cache_folder=tmp_path / "tr00-0001" / CACHE_FOLDER_NAME, max_entries=2)
+    key1 = make_cache_key({"downsample_frequency_hz": 5}, [("a.hea", 10, 1)], 1)
+    key2 = make_cache_key({"downsample_frequency_hz": 10}, [("a.hea", 10, 1)], 1)
+    key3 = make_cache_key({"downsample_frequency_hz": 5}, [("a.hea", 10, 2)], 1)
+    assert len({key1, key2, key3}) == 3
+    assert key1 == make_cache_key({"downsample_frequency_hz": 5}, [("a.hea", 10, 1)], 1)
+    assert cache.load(key1) is None
+
+    arrays = {"signals": np.arange(12, dtype=np.float32).reshape(4, 3), "gt": np.array([0, 1, 1, 0], dtype=np.uint8)}
+    cache.store(key1, arrays=arrays, meta={"columns": ["A", "B", "C"]})
+    cache.store(key2, arrays=arrays, meta={})
+    loaded_arrays, meta = cache.load(key1)
+    assert meta == {"columns": ["A", "B", "C"]}
+    assert all(np.array_equal(arrays[n], loaded_arrays[n]) and arrays[n].dtype == loaded_arrays[n].dtype for n in arrays)
+
+    # Storing a third entry evicts the least recently used one. Make sure modification times differ in between
+    os.utime(cache._entry_folder(key2) / _META_FILE_NAME, (0, 0))
+    cache.store(key3, arrays=arrays, meta={})
+    assert [i.key for i in cache.info()] == [key3, key1]
+
+    removed = cache.prune(max_bytes=cache.info()[0].n_bytes)
+    assert [i.key for i in removed] == [key1] and cache.contains(key3)
+    assert [c.cache_folder for c in find_dataset_caches(tmp_path)] == [cache.cache_folder]
+    cache.clear()
+    assert cache.info() == []
+
+
+def test_dataset_cache__corruption(tmp_path):
+    cache = DatasetCache(cache_folder=tmp_path / CACHE_FOLDER_NAME)
+    cache.store("key", arrays={"signals": np.arange(1000, dtype=np.float32)}, meta={})
+    npy_file = cache._entry_folder("key") / "signals.npy"
+    content = bytearray(npy_file.read_bytes())
+    content[-1] ^= 0xFF  # Flip some bits of the last value
+    npy_file.write_bytes(content)
+    assert cache.load("key") is None
+    assert not cache.contains("key"), "Corrupt entries must be removed"
+
+
+def test_dataset_cache__mmap(tmp_path, monkeypatch):
+    cache = DatasetCache(cache_folder=tmp_path / CACHE_FOLDER_NAME)
+    cache.store("key", arrays={"signals": np.arange(1000, dtype=np.float32)}, meta={"a": 1})
+    npy_file = cache._entry_folder("key") / "signals.npy"
+    content = bytearray(npy_file.read_bytes())
+    content[-1] ^= 0xFF
+    npy_file.write_bytes(content)
+
+    # Memory-mapped loads don't read the data, hence can't notice the corrupt value...
+    def _checksum_(array):
+        raise AssertionError("Data must not be read")
+    with monkeypatch.context() as m:
+        m.setattr(f"{__name__}._checksum", _checksum_)
+        arrays, meta = cache.load("key", mmap_mode="r")
+    assert isinstance(arrays["signals"], np.memmap) and meta == {"a": 1}
+    del arrays
+
+    # ...unless asked to verify them. Truncated files are noticed anyway.
+    npy_file.write_bytes(content[:-100])
+    assert cache.load("key", mmap_mode="r") is None
+    npy_file.write_bytes(content)
+    assert cache.load("key", mmap_mode="r", verify=True) is None
+    assert not cache.contains("key")
+
+
+def test_dataset_cache__encoded_arrays(tmp_path):
+    codec = QuantizedSignalCodec(chunk_size=100)
+    cache = DatasetCache(cache_folder=tmp_path / CACHE_FOLDER_NAME, array_codecs={"signals": codec})
+    signals = np.cumsum(np.random.default_rng(0).normal(size=(1000, 3)), axis=0).astype(np.float32)
+    arrays = {"signals": signals, "gt": np.arange(1000, dtype=np.uint8)}
+    built_arrays, _ = cache.get_or_build("key", build_fn=lambda: (arrays, {}))
+    assert (cache._entry_folder("key") / "signals.bin").is_file()
+    assert not (cache._entry_folder("key") / "signals.npy").exists()
+
+    loaded_arrays, _ = cache.load("key")
+    assert list(loaded_arrays) == ["signals", "gt"]
+    assert np.array_equal(loaded_arrays["gt"], arrays["gt"])
+    assert np.array_equal(loaded_arrays["signals"], built_arrays["signals"]), "Built & loaded entries must not differ"
+    assert np.allclose(loaded_arrays["signals"], signals, atol=1e-3)
+    assert np.array_equal(cache.load_array_range("key", "signals", start=250, stop=420), loaded_arrays["signals"][250:420])
+    assert np.array_equal(cache.load_array_range("key", "gt", start=250, stop=420), arrays["gt"][250:420])
+
+    bin_file = cache._entry_folder("key") / "signals.bin"
+    content = bytearray(bin_file.read_bytes())
+    content[-1] ^= 0xFF
+    bin_file.write_bytes(content)
+    assert cache.load("key") is None
+    assert not cache.contains("key"), "Corrupt entries must be removed"
+
+
+def _build_test_entry(cache_folder: Path, build_log_file: Path) -> float:
+    def _build_fn():
+        with open(build_log_file, mode="a") as file:
+            file.write(f"{os.getpid()}\n")
+        time.sleep(0.5)
+        return {"signals": np.arange(100_000, dtype=np.float32)}, {"built_by": os.getpid()}
+    cache = DatasetCache(cache_folder=cache_folder)
+    arrays, meta = cache.get_or_build("key", build_fn=_build_fn, poll_interval_seconds=0.05)
+    assert np.array_equal(arrays["signals"], np.arange(100_000, dtype=np.float32))
+    return meta["built_by"]
+
+
+def test_dataset_cache__concurrent_builds(tmp_path):
+    import multiprocessing as mp
+
+    build_log_file = tmp_path / "builds.log"
+    with mp.Pool(processes=4) as pool:
+        built_by = pool.starmap(_build_test_entry, [(tmp_path / CACHE_FOLDER_NAME, build_log_file)] * 8)
+    assert len(build_log_file.read_text().splitlines()) == 1, "Exactly one process must build the entry"
+    assert len(set(built_by)) == 1
+    assert [p.name for p in (tmp_path / CACHE_FOLDER_NAME).iterdir()] == ["key"], "No leftovers (locks, temp folders)"
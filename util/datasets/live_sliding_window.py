@@ -0,0 +1,299 @@
+import math
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from util.filter import CausalBandpassFilterBank, StreamingMeanDownsampler
+from .physionet.definitions import _PRE_CLEAN_BANDPASS_CUTOFFS, _get_sample_period
+from .sliding_window import SlidingWindowDataset, WindowData, WindowArrays, _SIGNAL_NAMES
+
+
+class LiveSlidingWindowDataset:
+    """
+    Appendable counterpart of SlidingWindowDataset, for recordings that grow while we process them (e.g. bedside
+    monitoring). Raw samples are pushed block by block; they are pre-cleaned, filtered & downsampled on the fly, with
+    all filter/downsampling states carried over from one block to the next. A window becomes available as soon as it
+    is complete.
+
+    Window geometry & indexing follow SlidingWindowDataset.Config: after pushing a whole record, the window indexes &
+    center points equal those of a SlidingWindowDataset of the same record. Signal values differ, though: filtering is
+    causal (forward only) instead of zero-phase, and implausible SaO2 values are replaced by the last plausible one
+    instead of being interpolated. Live data carries no annotations, so there is no ground truth.
+
+    Downsampled signals are kept in a buffer of bounded size. Windows whose beginning left the buffer cannot be
+    retrieved any more; see first_available_index.
+
+    Until the first plausible SaO2 value arrived (e.g. during sensor warm-up), samples are held back instead of being
+    processed. That value then replaces the implausible ones before it, as the batch pre-processing does. Held back
+    samples that exceed the buffer duration are skipped, i.e. windows containing them never get available.
+    """
+    def __init__(self, config: SlidingWindowDataset.Config, sample_frequency_hz: float,
+                 signal_names: Sequence[str] = _SIGNAL_NAMES, buffer_duration: Optional[pd.Timedelta] = None):
+        """
+        :param config: Window geometry & downsample frequency, as for SlidingWindowDataset.
+        :param sample_frequency_hz: Sample frequency of the raw samples that are pushed.
+        :param signal_names: Names of the channels (columns) of the pushed blocks. These are the rows of the feature
+                             arrays returned by get_window_arrays().
+        :param buffer_duration: Duration of downsampled signals that is kept. Must cover at least one window. If None,
+                                two windows are kept.
+        """
+        factor = sample_frequency_hz / config.downsample_frequency_hz
+        assert round(factor) >= 1 and math.isclose(factor, round(factor)), \
+            f"Sample frequency ({sample_frequency_hz} Hz) must be an integer multiple of the downsample frequency " \
+            f"({config.downsample_frequency_hz} Hz)!"
+        self.config = config
+        self.sample_frequency_hz = sample_frequency_hz
+        self.signal_names = tuple(signal_names)
+
+        channel_cutoffs = {i: _PRE_CLEAN_BANDPASS_CUTOFFS[name] for i, name in enumerate(self.signal_names)
+                           if name in _PRE_CLEAN_BANDPASS_CUTOFFS}
+        self._filter_bank = CausalBandpassFilterBank(n_channels=len(self.signal_names), channel_cutoffs=channel_cutoffs,
+                                                     f_sample=sample_frequency_hz, filter_order=5)
+        self._downsampler = StreamingMeanDownsampler(downsampling_factor=round(factor), n_channels=len(self.signal_names))
+        self._sa_o2_channel: Optional[int] = self.signal_names.index("SaO2") if "SaO2" in self.signal_names else None
+        self._last_valid_sa_o2 = np.nan
+        self._held_back = np.empty(shape=(0, len(self.signal_names)), dtype=np.float32)  # Raw samples, see _hold_back()
+
+        # Margin & stride of our center points, same as SlidingWindowDataset._determine_center_points()
+        self._center_point_margin = max(2, int(max(config.time_window_size__index_steps/2,
+                                                   config.ground_truth_vector_width__index_steps/2)))
+        self._half_window_size = int(config.time_window_size__index_steps/2)
+
+        # Buffer of downsampled signals (channels x samples). Once full, its second half is moved to the front, so that
+        # windows are always contiguous slices. '_buffer_offset' is the absolute sample position of the buffer's start.
+        if buffer_duration is None:
+            buffer_capacity = 2 * config.time_window_size__index_steps
+        else:
+            buffer_capacity = int(buffer_duration / _get_sample_period(config.downsample_frequency_hz))
+        assert buffer_capacity >= config.time_window_size__index_steps, "Buffer must cover at least one window!"
+        self._buffer_capacity = buffer_capacity
+        self._held_back_capacity = buffer_capacity * round(factor)
+        self._buffer = np.empty(shape=(len(self.signal_names), 2 * buffer_capacity), dtype=np.float32)
+        self._buffer_offset = 0
+        self._n_samples = 0  # Number of downsampled samples received so far
+
+    def push(self, block: Union[np.ndarray, pd.DataFrame]) -> range:
+        """
+        Appends a block of raw samples (samples x channels, channels ordered as 'signal_names').
+
+        :return: Indexes of the windows that became available through this block.
+        """
+        if isinstance(block, pd.DataFrame):
+            block = block[list(self.signal_names)].to_numpy()
+        assert block.ndim == 2 and block.shape[1] == len(self.signal_names), \
+            f"Block must be 2-D with {len(self.signal_names)} channels"
+        n_windows_before_ = len(self)
+
+        block = block.astype(np.float32)
+        if self._sa_o2_channel is not None:
+            if np.isnan(self._last_valid_sa_o2):
+                block = self._hold_back(block)
+            self._clean_sa_o2(block[:, self._sa_o2_channel])
+        self._filter_bank.process(block)
+        self._append(self._downsampler.process(block))
+        return range(max(n_windows_before_, self.first_available_index), len(self))
+
+    def _hold_back(self, block: np.ndarray) -> np.ndarray:
+        """
+        Holds back raw samples until a plausible SaO2 value arrives. Returns the samples that are to be processed now:
+        all held back ones plus the block, once there is a plausible SaO2 value among them; nothing otherwise.
+        """
+        block = np.concatenate([self._held_back, block])
+        if np.any(block[:, self._sa_o2_channel] > 20.0):
+            self._held_back = block[:0]
+            return block
+        # Samples beyond our buffer duration would leave the buffer anyway. Hence, they are filtered & downsampled (to
+        # keep the filter states going), but skipped. Whole downsampling groups are skipped, so none of them is mixed
+        # with samples that we keep.
+        factor_ = self._downsampler.downsampling_factor
+        n_skipped = max(0, len(block) - self._held_back_capacity) // factor_ * factor_
+        if n_skipped > 0:
+            skipped = block[:n_skipped]
+            skipped[:, self._sa_o2_channel] = np.nan
+            self._filter_bank.process(skipped)
+            self._skip(len(self._downsampler.process(skipped)))
+        self._held_back = block[n_skipped:]
+        return block[:0]
+
+    def _clean_sa_o2(self, sa_o2: np.ndarray):
+        """
+        Causal counterpart of the batch SaO2 cleaning: implausible values (<= 20%) take the last plausible value. Before
+        the first plausible value, they take that one (see _hold_back).
+        """
+        valid = sa_o2 > 20.0
+        if np.all(valid):
+            self._last_valid_sa_o2 = sa_o2[-1] if len(sa_o2) != 0 else self._last_valid_sa_o2
+            return
+        fallback_value = self._last_valid_sa_o2
+        if np.isnan(fallback_value) and np.any(valid):
+            fallback_value = sa_o2[np.argmax(valid)]
+        # Index of the last valid sample at or before each position (-1: none within this block)
+        last_valid_positions = np.maximum.accumulate(np.where(valid, np.arange(len(sa_o2)), -1))
+        held_values = np.where(last_valid_positions >= 0, sa_o2[np.maximum(last_valid_positions, 0)], fallback_value)
+        sa_o2[~valid] = held_values[~valid]
+        self._last_valid_sa_o2 = sa_o2[-1]
+
+    def _skip(self, n_samples: int):
+        """Counts downsampled samples without storing them. Our buffer is emptied, as it must stay contiguous."""
+        self._n_samples += n_samples
+        self._buffer_offset = self._n_samples
+
+    def _append(self, samples: np.ndarray):
+        n_new = len(samples)
+        if n_new == 0:
+            return
+        if n_new > self._buffer_capacity:
+            # Only the newest samples fit into our buffer anyway
+            self._buffer_offset = self._n_samples + n_new - self._buffer_capacity
+            self._buffer[:, :self._buffer_capacity] = samples[-self._buffer_capacity:].T
+            self._n_samples += n_new
+            return
+        write_position = self._n_samples - self._buffer_offset
+        if write_position + n_new > self._buffer.shape[1]:
+            n_keep = self._buffer_capacity - n_new
+            self._buffer[:, :n_keep] = self._buffer[:, write_position - n_keep:write_position]
+            self._buffer_offset = self._n_samples - n_keep
+            write_position = n_keep
+        self._buffer[:, write_position:write_position + n_new] = samples.T
+        self._n_samples += n_new
+
+    @property
+    def n_samples(self) -> int:
+        """Number of downsampled samples received so far."""
+        return self._n_samples
+
+    def __len__(self):
+        """Number of windows that got available so far (including the ones that already left our buffer)."""
+        n_center_points_ = self._n_samples - 2 * self._center_point_margin
+        if n_center_points_ <= 0:
+            return 0
+        return (n_center_points_ - 1) // self.config.time_window_stride__index_steps + 1
+
+    @property
+    def first_available_index(self) -> int:
+        """Index of the oldest window that is still within our buffer."""
+        first_position_ = self._buffer_offset + self._half_window_size
+        stride_ = self.config.time_window_stride__index_steps
+        return max(0, -(-(first_position_ - self._center_point_margin) // stride_))
+
+    def _get_signal_position(self, idx: int) -> int:
+        assert -len(self) <= idx < len(self), "Index out of bounds"
+        if idx < 0:
+            idx += len(self)
+        assert idx >= self.first_available_index, \
+            f"Window {idx} already left the buffer (oldest available window: {self.first_available_index})"
+        return self._center_point_margin + idx * self.config.time_window_stride__index_steps
+
+    def index_to_center_point(self, idx: int) -> pd.Timedelta:
+        """Returns the center point of a window, relative to the beginning of the recording."""
+        return self._get_signal_position(idx) * _get_sample_period(self.config.downsample_frequency_hz)
+
+    def get_window_arrays(self, idx: int) -> WindowArrays:
+        """
+        Array-native window access, as SlidingWindowDataset.get_window_arrays(). The returned features are a view into
+        our buffer, which gets overwritten by later pushes; copy it if it needs to outlive the next push.
+        """
+        center_point_index = self._get_signal_position(idx)
+        start = center_point_index - self._half_window_size - self._buffer_offset
+        features = self._buffer[:, start:start + self.config.time_window_size__index_steps]
+        assert not np.any(~np.isfinite(features)), f"Oops, there's something NaN/inf! idx={idx}"
+        return WindowArrays(features=features, center_point_index=center_point_index, ground_truth=None)
+
+    def __getitem__(self, idx: int) -> WindowData:
+        window_arrays = self.get_window_arrays(idx)
+        sample_period = _get_sample_period(self.config.downsample_frequency_hz)
+        first_position_ = window_arrays.center_point_index - self._half_window_size
+        index = pd.timedelta_range(start=first_position_ * sample_period, periods=window_arrays.features.shape[1],
+                                   freq=sample_period)
+        features = pd.DataFrame(data=window_arrays.features.T.copy(), index=index, columns=list(self.signal_names))
+        return WindowData(signals=features, center_point=window_arrays.center_point_index * sample_period, ground_truth=None)
+
+
+def test_live_sliding_window_dataset(tmp_path):
+    from .physionet import read_physionet_dataset
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    raw_dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=_SIGNAL_NAMES)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    batch_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+
+    # Pushing everything at once is our reference; the whole recording fits into the buffer
+    reference = LiveSlidingWindowDataset(config=config, sample_frequency_hz=raw_dataset.sample_frequency_hz,
+                                         buffer_duration=pd.Timedelta("30 minutes"))
+    assert reference.push(raw_dataset.signals) == range(0, len(batch_dataset))
+    assert reference.index_to_center_point(-1) == batch_dataset.valid_center_points[-1]
+
+    # Pushing small, irregular blocks into a small buffer yields the very same windows, as soon as they are complete
+    live_dataset = LiveSlidingWindowDataset(config=config, sample_frequency_hz=raw_dataset.sample_frequency_hz)
+    raw_values = raw_dataset.signals.to_numpy()
+    block_ends = np.cumsum(np.random.default_rng(0).integers(1, 3000, size=len(raw_values) // 1000))
+    n_windows = 0
+    for block in np.split(raw_values, block_ends[block_ends < len(raw_values)]):
+        new_indexes = live_dataset.push(block)
+        assert new_indexes.start == n_windows
+        n_windows = new_indexes.stop
+        for idx in new_indexes:
+            assert np.allclose(live_dataset.get_window_arrays(idx).features, reference.get_window_arrays(idx).features, atol=1e-4)
+    assert n_windows == len(batch_dataset)
+    assert live_dataset._buffer.shape[1] == 4 * config.time_window_size__index_steps
+    with pytest.raises(AssertionError):
+        live_dataset.get_window_arrays(0)
+
+    window_data = live_dataset[-1]
+    assert window_data.center_point == batch_dataset.valid_center_points[-1]
+    assert list(window_data.signals.index) == list(batch_dataset[-1].signals.index)
+
+    # Unfiltered channels (SaO2) match the batch pre-processing, as long as there is nothing to clean
+    assert np.all(raw_dataset.signals["SaO2"] > 20)
+    assert np.allclose(window_data.signals["SaO2"], batch_dataset[-1].signals["SaO2"], atol=1e-4)
+
+    # Implausible SaO2 values take the last plausible value, also across block boundaries
+    live_dataset = LiveSlidingWindowDataset(config=config, sample_frequency_hz=10, signal_names=["SaO2"])
+    block = np.array([[95.], [0.], [96.], [0.], [0.], [0.]])
+    live_dataset._clean_sa_o2(block[:3, 0])
+    live_dataset._clean_sa_o2(block[3:, 0])
+    assert list(block[:, 0]) == [95, 95, 96, 96, 96, 96]
+
+
+def test_live_sliding_window_dataset__sa_o2_warm_up(tmp_path):
+    from .physionet import read_physionet_dataset
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=300)
+    raw_dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=_SIGNAL_NAMES)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("1 minute"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    sa_o2_channel, fs = _SIGNAL_NAMES.index("SaO2"), int(raw_dataset.sample_frequency_hz)
+    raw_values = raw_dataset.signals.to_numpy(copy=True)
+    first_valid_sa_o2 = raw_values[10 * fs, sa_o2_channel]
+    reference = LiveSlidingWindowDataset(config=config, sample_frequency_hz=fs, buffer_duration=pd.Timedelta("10 minutes"))
+    reference.push(raw_values)
+
+    # Implausible SaO2 values during the first 10s take the first plausible value, as the batch pre-processing does
+    raw_values[:10 * fs, sa_o2_channel] = 0
+    for block_size in (len(raw_values), 500):
+        live_dataset = LiveSlidingWindowDataset(config=config, sample_frequency_hz=fs, buffer_duration=pd.Timedelta("10 minutes"))
+        new_indexes = [live_dataset.push(b) for b in np.split(raw_values, range(block_size, len(raw_values), block_size))]
+        assert new_indexes[0].start == 0 and new_indexes[-1].stop == len(reference)
+        for idx in range(len(live_dataset)):
+            features, expected = live_dataset.get_window_arrays(idx).features, reference.get_window_arrays(idx).features
+            assert np.all(np.isfinite(features))
+            assert np.allclose(np.delete(features, sa_o2_channel, axis=0), np.delete(expected, sa_o2_channel, axis=0), atol=1e-4)
+        assert np.allclose(live_dataset.get_window_arrays(0).features[sa_o2_channel, :5], first_valid_sa_o2)
+
+    # Implausible SaO2 values for longer than the buffer duration: windows containing skipped samples never get available
+    raw_values[:200 * fs, sa_o2_channel] = 0
+    live_dataset = LiveSlidingWindowDataset(config=config, sample_frequency_hz=fs, buffer_duration=pd.Timedelta("2 minutes"))
+    n_windows = 0
+    for block in np.split(raw_values, range(777, len(raw_values), 777)):
+        new_indexes = live_dataset.push(block)
+        assert new_indexes.start >= n_windows
+        n_windows = new_indexes.stop
+        for idx in new_indexes:
+            assert np.all(np.isfinite(live_dataset.get_window_arrays(idx).features))
+    assert n_windows == len(reference) and live_dataset.first_available_index > 0
+    assert len(live_dataset._held_back) == 0
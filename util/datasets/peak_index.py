@@ -0,0 +1,140 @@
+"""
+Persisted peaks of (pre-processed) signals, so that the CHEST/ABD/AIRFLOW peaks of a record are detected only once per
+filter configuration, instead of each time the record is touched (AI dataset preparation, rule-based detection,
+plotting). Peaks are stored as .npy arrays next to the pre-processed signals & loaded memory-mapped, i.e. without
+copying them into memory.
+"""
+from dataclasses import dataclass, asdict
+import hashlib
+from pathlib import Path
+from typing import Optional, Sequence, List
+
+import numpy as np
+
+from util.filter import apply_butterworth_lowpass_filter
+from util.mathutil import PeakArrays, get_peak_arrays, get_multichannel_peak_arrays
+from .dataset_cache import DatasetCache, make_cache_key
+
+
+# Version of our peak detection. Increment it whenever a code change alters the detected peaks, so that existing
+# peak index entries are not used any more.
+_PEAK_INDEX_CODE_VERSION = 1
+
+
+@dataclass(frozen=True)
+class LowpassPrefilter:
+    """Butterworth low-pass filter that is applied to a signal before its peaks get detected."""
+    f_cutoff: float
+    f_sample: float
+    filter_order: int = 5
+
+    def apply(self, waveform: np.ndarray) -> np.ndarray:
+        return apply_butterworth_lowpass_filter(data=waveform, f_cutoff=self.f_cutoff, f_sample=self.f_sample,
+                                                filter_order=self.filter_order)
+
+
+def detect_peak_arrays(waveforms: Sequence[np.ndarray], filter_kernel_width: int,
+                       prefilter: Optional[LowpassPrefilter] = None, parallel: bool = False) -> List[PeakArrays]:
+    """
+    Detects the peaks of several waveforms, see get_peak_arrays(...).
+
+    :param prefilter: If given, each waveform is filtered before its peaks get detected.
+    :param parallel: If True, the waveforms are processed concurrently on all cores (see get_multichannel_peak_arrays).
+                     All waveforms must then share length & dtype. Results are the same.
+    """
+    if prefilter is not None:
+        waveforms = [prefilter.apply(w) for w in waveforms]
+    if parallel and len(waveforms) > 1:
+        assert len(set(w.dtype for w in waveforms)) == 1, "Waveforms must share their dtype for parallel peak detection"
+        return list(get_multichannel_peak_arrays(waveforms=np.stack(waveforms), filter_kernel_width=filter_kernel_width))
+    return [get_peak_arrays(waveform=w, filter_kernel_width=filter_kernel_width) for w in waveforms]
+
+
+class PeakIndex:
+    """
+    Cache of detected peaks, one entry per signal & filter configuration. Entries are keyed by signal name, the signal
+    values (a digest of them, so that changed signals never hit outdated peaks), the prefilter & the filter kernel
+    width.
+
+    Loaded peak arrays are copy-on-write memory maps of the cache files: loading an entry only checks the array headers
+    & file sizes (not the checksums, see DatasetCache.load), so peak values are read once they are accessed, and
+    changes never reach the files. (Unlike read-only maps, they are typed like freshly detected peaks by numba, so
+    jitted consumers don't need another specialization.)
+    """
+    def __init__(self, cache_folder: Path, max_entries: Optional[int] = 32):
+        """
+        :param cache_folder: Folder that holds the peak entries, usually a sub-folder of the record's cache folder.
+        :param max_entries: Maximum number of entries. If None, the number of entries is not limited.
+        """
+        self._cache = DatasetCache(cache_folder=cache_folder, max_entries=max_entries)
+
+    @property
+    def cache_folder(self) -> Path:
+        return self._cache.cache_folder
+
+    @staticmethod
+    def _get_key(signal_name: str, waveform: np.ndarray, filter_kernel_width: int, prefilter: Optional[LowpassPrefilter]) -> str:
+        waveform = np.ascontiguousarray(waveform)
+        digest = hashlib.sha256(memoryview(waveform).cast("B")).hexdigest()
+        prefilter_ = None if prefilter is None else asdict(prefilter)
+        return make_cache_key("peaks", signal_name, digest, str(waveform.dtype), waveform.shape, prefilter_,
+                              filter_kernel_width, _PEAK_INDEX_CODE_VERSION)
+
+    def get_peak_arrays(self, signal_names: Sequence[str], waveforms: Sequence[np.ndarray], filter_kernel_width: int,
+                        prefilter: Optional[LowpassPrefilter] = None, parallel: bool = False) -> List[PeakArrays]:
+        """
+        Returns the peaks of the given signals, as detect_peak_arrays(...) does. Peaks that are not in the index yet
+        are detected (all of them at once, see 'parallel') & stored.
+
+        :param signal_names: Name of each waveform, e.g. "AIRFLOW".
+        :param waveforms: Signal values, before prefiltering.
+        """
+        assert len(signal_names) == len(waveforms)
+        keys = [self._get_key(n, w, filter_kernel_width=filter_kernel_width, prefilter=prefilter)
+                for n, w in zip(signal_names, waveforms)]
+        entries = [self._cache.load(key=k, mmap_mode="c") for k in keys]
+        peaks: List[Optional[PeakArrays]] = [None if e is None else PeakArrays(**e[0]) for e in entries]
+
+        missing = [i for i, p in enumerate(peaks) if p is None]
+        if len(missing) != 0:
+            detected = detect_peak_arrays([waveforms[i] for i in missing], filter_kernel_width=filter_kernel_width,
+                                          prefilter=prefilter, parallel=parallel)
+            for i, peaks_ in zip(missing, detected):
+                meta = {"signal_name": signal_names[i], "filter_kernel_width": filter_kernel_width,
+                        "prefilter": None if prefilter is None else asdict(prefilter)}
+                self._cache.store(key=keys[i], arrays=peaks_._asdict(), meta=meta)
+                peaks[i] = peaks_
+        return peaks
+
+
+def test_peak_index(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    waveforms = [np.sin(np.linspace(0, 300, 20_000)).astype(np.float32) + rng.normal(scale=0.2, size=20_000).astype(np.float32)
+                 for _ in range(3)]
+    signal_names = ["AIRFLOW", "CHEST", "ABD"]
+    prefilter = LowpassPrefilter(f_cutoff=0.1, f_sample=1)
+    peak_index = PeakIndex(cache_folder=tmp_path / "peaks")
+
+    for prefilter_ in (None, prefilter):
+        expected = detect_peak_arrays(waveforms, filter_kernel_width=3, prefilter=prefilter_)
+        for parallel in (False, True):
+            for peaks, expected_peaks in zip(peak_index.get_peak_arrays(signal_names, waveforms, filter_kernel_width=3,
+                                                                        prefilter=prefilter_, parallel=parallel), expected):
+                for name in PeakArrays._fields:
+                    assert np.array_equal(getattr(peaks, name), getattr(expected_peaks, name))
+                    assert getattr(peaks, name).dtype == getattr(expected_peaks, name).dtype
+    assert len(peak_index._cache.info()) == 6
+
+    # Loaded entries are memory maps, i.e. zero copy: index hits neither checksum nor copy the peak arrays
+    def _checksum(array):
+        raise AssertionError("Index hits must not read the peak arrays")
+    monkeypatch.setattr("util.datasets.dataset_cache._checksum", _checksum)
+    peaks, = peak_index.get_peak_arrays(signal_names[:1], waveforms[:1], filter_kernel_width=3)
+    assert all(isinstance(a, np.memmap) and not a.flags.owndata for a in peaks)
+    monkeypatch.undo()
+
+    # Other signal names, values & kernel widths result in new entries
+    peak_index.get_peak_arrays(["SaO2"], waveforms[:1], filter_kernel_width=3)
+    peak_index.get_peak_arrays(signal_names[:1], [waveforms[0] * 2], filter_kernel_width=3)
+    peak_index.get_peak_arrays(signal_names[:1], waveforms[:1], filter_kernel_width=4)
+    assert len(peak_index._cache.info()) == 9
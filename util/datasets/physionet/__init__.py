@@ -1,6 +1,9 @@
 from .definitions import EnduringEvent, TransientEvent, RespiratoryEvent, RespiratoryEventType, PhysioNetDataset, SleepStageEvent, \
-    SleepStageType
-from .reader import read_physionet_dataset
+    SleepStageType, EventTable, EventKind
+from .reader import read_physionet_dataset, read_physionet_dataset_time_range, iterate_physionet_dataset_chunks
+from .memmap_store import convert_to_memmap_store, MemmapRecord, has_memmap_store
+from .catalog import DatasetCatalog, RecordInfo, build_catalog, load_or_build_catalog, read_record_info
+from .prefetch import PrefetchingReader
 
 __author__ = "Robert Voelckner"
 __copyright__ = "Copyright 2021"
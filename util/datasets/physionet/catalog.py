@@ -0,0 +1,278 @@
+import heapq
+import json
+import os
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import List, Optional, Dict, Tuple, Sequence, Callable, Iterator
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+import pytest
+import wfdb
+
+from .definitions import EventTable, EventKind, RespiratoryEventType, SleepStageType
+from .reader import _read_annotations
+
+
+CATALOG_FILE_NAME = "catalog.json"  # Default file name of a catalog, placed within the dataset root folder
+_CATALOG_FORMAT_VERSION = 1
+
+
+@dataclass(frozen=True)
+class RecordInfo:
+    """
+    Meta data of a single record, derived from its header (.hea) & annotation (.arousal) file only.
+    """
+    record_name: str  # Name of the record folder, relative to the catalog's root folder
+    sample_frequency_hz: float
+    n_samples: int
+    signal_names: Tuple[str, ...]
+    has_annotations: bool
+    respiratory_event_counts: Dict[str, int]  # RespiratoryEventType name -> number of events
+    sleep_stage_seconds: Dict[str, float]  # SleepStageType name -> total duration of the sleep stage
+
+    @property
+    def duration(self) -> pd.Timedelta:
+        return pd.Timedelta(seconds=self.n_samples / self.sample_frequency_hz)
+
+    def n_respiratory_events(self, event_type: Optional[RespiratoryEventType] = None) -> int:
+        """Returns the number of respiratory events of the given type, or of all types if None."""
+        if event_type is None:
+            return sum(self.respiratory_event_counts.values())
+        return self.respiratory_event_counts[event_type.name]
+
+    def sleep_stage_duration(self, sleep_stage_type: SleepStageType) -> pd.Timedelta:
+        return pd.Timedelta(seconds=self.sleep_stage_seconds[sleep_stage_type.name])
+
+
+def read_record_info(dataset_folder: Path, dataset_filename_stem: str = None) -> RecordInfo:
+    """
+    Reads the meta data of a record. Only the header & annotations are read, no signal data.
+
+    :param dataset_folder: The folder containing our .mat, .hea and .arousal files
+    :param dataset_filename_stem: Name that all the dataset files have in common. If None, we'll derive it from the
+                                  folder name.
+    """
+    if dataset_filename_stem is None:
+        dataset_filename_stem = dataset_folder.name
+    record_path = dataset_folder / dataset_filename_stem
+    header = wfdb.rdheader(record_name=str(record_path))
+    sample_frequency = float(header.fs)
+
+    respiratory_event_counts = {t.name: 0 for t in RespiratoryEventType}
+    sleep_stage_seconds = {s.name: 0.0 for s in SleepStageType}
+    annotations = _read_annotations(record_path=record_path)
+    if annotations is not None:
+        event_table = EventTable.from_annotations(samples=annotations[0], aux_notes=annotations[1],
+                                                  sample_frequency_hz=sample_frequency)
+        respiratory_codes = event_table.type_codes[event_table.kinds == EventKind.Respiratory.value]
+        for t in RespiratoryEventType:
+            respiratory_event_counts[t.name] = int(np.sum(respiratory_codes == t.value))
+
+        # Each sleep stage lasts until the next one begins, the last one until the end of the record
+        sleep_stages = event_table.of_kind(EventKind.SleepStage)
+        order = np.argsort(sleep_stages.starts, kind="stable")
+        stage_starts = sleep_stages.starts[order]
+        stage_ends = np.append(stage_starts[1:], header.sig_len).clip(min=stage_starts)
+        stage_samples = np.bincount(sleep_stages.type_codes[order].astype(np.int64), weights=stage_ends - stage_starts,
+                                    minlength=len(SleepStageType))
+        for i, s in enumerate(SleepStageType):
+            sleep_stage_seconds[s.name] = float(stage_samples[i] / sample_frequency)
+
+    return RecordInfo(record_name=dataset_folder.name, sample_frequency_hz=sample_frequency, n_samples=int(header.sig_len),
+                      signal_names=tuple(header.sig_name), has_annotations=annotations is not None,
+                      respiratory_event_counts=respiratory_event_counts, sleep_stage_seconds=sleep_stage_seconds)
+
+
+class DatasetCatalog:
+    """
+    Index of the records within a dataset root folder (e.g. PhysioNet's 'training' folder). Allows to pick records and
+    to plan jobs without loading any signal data. Build it via build_catalog(...), or load a persisted one via load(...).
+    """
+    def __init__(self, root_folder: Path, records: Sequence[RecordInfo]):
+        self.root_folder = root_folder
+        self.records: List[RecordInfo] = list(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[RecordInfo]:
+        return iter(self.records)
+
+    def __getitem__(self, record_name: str) -> RecordInfo:
+        for r in self.records:
+            if r.record_name == record_name:
+                return r
+        raise KeyError(f"Record '{record_name}' is not part of the catalog")
+
+    @property
+    def dataset_folders(self) -> List[Path]:
+        return [self.root_folder / r.record_name for r in self.records]
+
+    @property
+    def total_duration(self) -> pd.Timedelta:
+        return pd.Timedelta(seconds=sum(r.n_samples / r.sample_frequency_hz for r in self.records))
+
+    def filter(self, predicate: Callable[[RecordInfo], bool]) -> "DatasetCatalog":
+        """Returns a catalog that only contains the records which fulfill the given predicate."""
+        return DatasetCatalog(root_folder=self.root_folder, records=[r for r in self.records if predicate(r)])
+
+    def select(self, min_respiratory_events: Optional[Dict[RespiratoryEventType, int]] = None,
+               channels: Optional[Sequence[str]] = None, min_duration: Optional[pd.Timedelta] = None,
+               annotated_only: bool = False) -> "DatasetCatalog":
+        """
+        Returns a catalog that only contains the records which fulfill all of the given criteria.
+
+        :param min_respiratory_events: Minimum number of events per respiratory event type, e.g.
+                                       {RespiratoryEventType.ObstructiveApnea: 10}
+        :param channels: Signals that each record must provide.
+        :param min_duration: Minimum duration of each record.
+        :param annotated_only: If True, only records that come with annotations are kept.
+        """
+        def _predicate(r: RecordInfo) -> bool:
+            if annotated_only and not r.has_annotations:
+                return False
+            if min_duration is not None and r.duration < min_duration:
+                return False
+            if channels is not None and not all(c in r.signal_names for c in channels):
+                return False
+            if min_respiratory_events is not None and \
+                    any(r.n_respiratory_events(t) < n for t, n in min_respiratory_events.items()):
+                return False
+            return True
+        return self.filter(_predicate)
+
+    def shard(self, n_shards: int) -> List["DatasetCatalog"]:
+        """
+        Splits the catalog into n_shards catalogs of about equal total duration (which is what the processing cost of
+        a record is mostly proportional to). Uses the longest-processing-time-first heuristic.
+        """
+        assert n_shards >= 1, "Number of shards must be at least 1"
+        shard_records: List[List[RecordInfo]] = [[] for _ in range(n_shards)]
+        heap = [(0.0, i) for i in range(n_shards)]
+        for r in sorted(self.records, key=lambda r: r.duration, reverse=True):
+            shard_seconds, i = heapq.heappop(heap)
+            shard_records[i].append(r)
+            heapq.heappush(heap, (shard_seconds + r.duration.total_seconds(), i))
+        return [DatasetCatalog(root_folder=self.root_folder, records=records) for records in shard_records]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns one row per record, e.g. for interactive exploration & filtering via DataFrame.query(...)."""
+        rows = []
+        for r in self.records:
+            row = {"record_name": r.record_name, "sample_frequency_hz": r.sample_frequency_hz,
+                   "n_samples": r.n_samples, "duration": r.duration, "signal_names": ",".join(r.signal_names),
+                   "has_annotations": r.has_annotations}
+            row.update({f"n_{name}": n for name, n in r.respiratory_event_counts.items()})
+            row.update({f"{name}_seconds": s for name, s in r.sleep_stage_seconds.items()})
+            rows += [row]
+        return pd.DataFrame(rows).set_index("record_name") if len(rows) else pd.DataFrame()
+
+    def save(self, catalog_file: Path) -> None:
+        """Persists the catalog as a single JSON file. The file is written to a temporary file first & renamed then."""
+        data = {
+            "format_version": _CATALOG_FORMAT_VERSION,
+            "records": [asdict(r) for r in self.records],
+        }
+        temp_file = catalog_file.parent / f".{catalog_file.name}.{os.getpid()}.tmp"
+        with open(file=temp_file, mode="w") as file:
+            json.dump(obj=data, fp=file)
+        os.replace(temp_file, catalog_file)
+
+    @staticmethod
+    def load(catalog_file: Path, root_folder: Optional[Path] = None) -> "DatasetCatalog":
+        """
+        Loads a persisted catalog.
+
+        :param root_folder: Folder that the records reside in. If None, the folder of the catalog file is used.
+        """
+        with open(file=catalog_file, mode="r") as file:
+            data = json.load(file)
+        assert data["format_version"] == _CATALOG_FORMAT_VERSION, \
+            f"Catalog '{catalog_file}' has an unsupported format version ({data['format_version']})"
+        records = [RecordInfo(**{**r, "signal_names": tuple(r["signal_names"])}) for r in data["records"]]
+        return DatasetCatalog(root_folder=catalog_file.parent if root_folder is None else root_folder, records=records)
+
+
+def _list_record_folders(root_folder: Path) -> List[Path]:
+    """Lists all sub-folders that contain a record header named like the folder itself."""
+    sub_folders = [sub for sub in root_folder.iterdir() if sub.is_dir() and (sub / f"{sub.name}.hea").is_file()]
+    return list(sorted(sub_folders))
+
+
+def build_catalog(root_folder: Path, catalog_file: Optional[Path] = None, n_processes: int = None,
+                  progress_fn: Callable = None) -> DatasetCatalog:
+    """
+    Scans a dataset root folder for records & builds their catalog. Only headers & annotations are read, in parallel.
+
+    :param root_folder: Folder whose sub-folders contain the records (e.g. PhysioNet's 'training' folder).
+    :param catalog_file: If given, the catalog is persisted to this file. Use CATALOG_FILE_NAME within the root folder
+                         to make load_or_build_catalog(...) find it.
+    :param n_processes: Number of processes used for reading. If None, the number is automatically determined.
+    :param progress_fn: Optional wrapper around the result iterator, e.g. tqdm.
+    """
+    root_folder = root_folder.expanduser().resolve()
+    assert root_folder.exists() and root_folder.is_dir(), f"Given folder '{root_folder}' either not exists or is no folder."
+    affinity = len(os.sched_getaffinity(0))
+    if n_processes is None:
+        n_processes = affinity
+    assert 1 <= n_processes <= affinity, f"Given 'n_processes' not in the allowed range of 1..{affinity}"
+    if progress_fn is None:
+        def progress_fn(x): return x
+
+    record_folders = _list_record_folders(root_folder=root_folder)
+    if n_processes == 1 or len(record_folders) <= 1:
+        records = [read_record_info(dataset_folder=f) for f in progress_fn(record_folders)]
+    else:
+        with mp.Pool(processes=n_processes) as pool:
+            records = list(progress_fn(pool.imap(read_record_info, record_folders, chunksize=4)))
+
+    catalog = DatasetCatalog(root_folder=root_folder, records=records)
+    if catalog_file is not None:
+        catalog.save(catalog_file=catalog_file)
+    return catalog
+
+
+def load_or_build_catalog(root_folder: Path, n_processes: int = None) -> DatasetCatalog:
+    """Loads the catalog of a dataset root folder. In case there is none yet, it is built & persisted beforehand."""
+    catalog_file = root_folder / CATALOG_FILE_NAME
+    if catalog_file.is_file():
+        return DatasetCatalog.load(catalog_file=catalog_file, root_folder=root_folder)
+    return build_catalog(root_folder=root_folder, catalog_file=catalog_file, n_processes=n_processes)
+
+
+def test_build_catalog(tmp_path):
+    from .reader import _write_test_record, read_physionet_dataset
+
+    _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=600)
+    _write_test_record(dataset_folder=tmp_path / "tr00-0002", duration_seconds=1200, seed=1)
+    _write_test_record(dataset_folder=tmp_path / "tr00-0003", duration_seconds=300, seed=2)
+
+    catalog = build_catalog(root_folder=tmp_path, catalog_file=tmp_path / CATALOG_FILE_NAME,
+                            n_processes=min(2, len(os.sched_getaffinity(0))))
+    assert [r.record_name for r in catalog] == ["tr00-0001", "tr00-0002", "tr00-0003"]
+
+    # Compare against the fully loaded record
+    info = catalog["tr00-0002"]
+    dataset = read_physionet_dataset(dataset_folder=tmp_path / "tr00-0002")
+    assert info.duration == pd.Timedelta("1200s") and info.sample_frequency_hz == dataset.sample_frequency_hz
+    assert info.signal_names == tuple(dataset.signals.columns)
+    for t in RespiratoryEventType:
+        assert info.n_respiratory_events(t) == sum(e.event_type == t for e in dataset.respiratory_events)
+    assert sum(info.sleep_stage_seconds.values()) == pytest.approx(1200 - 1)  # First sleep stage begins after 1s
+
+    # Persistence
+    loaded_catalog = load_or_build_catalog(root_folder=tmp_path)
+    assert loaded_catalog.records == catalog.records
+
+    # Filtering & sharding
+    assert len(catalog.select(min_duration=pd.Timedelta("10 minutes"))) == 2
+    n_obstructive = info.n_respiratory_events(RespiratoryEventType.ObstructiveApnea)
+    selected = catalog.select(min_respiratory_events={RespiratoryEventType.ObstructiveApnea: n_obstructive})
+    assert "tr00-0002" in [r.record_name for r in selected]
+    assert len(catalog.select(channels=["ABD", "Foo"])) == 0
+    shards = catalog.shard(n_shards=2)
+    assert [[r.record_name for r in s] for s in shards] == [["tr00-0002"], ["tr00-0001", "tr00-0003"]]
+    assert len(catalog.to_dataframe()) == 3
+
@@ -1,14 +1,32 @@
 from abc import ABC
+import math
 from dataclasses import dataclass
 import functools
-from copy import deepcopy
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Sequence, Dict, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import pytest
 
-from util.filter import apply_butterworth_lowpass_filter, apply_butterworth_bandpass_filter
+from util.filter import apply_butterworth_lowpass_filter, apply_butterworth_bandpass_filter_bank, \
+    downsample_by_mean, downsample_polyphase
+
+
+# Band-pass cutoff frequencies (low, high) that 'pre_clean' applies, according to AASM v2.0.3, page 12
+_PRE_CLEAN_BANDPASS_CUTOFFS: Dict[str, Tuple[float, float]] = {
+    "AIRFLOW": (0.03, 3),
+    "ABD": (0.1, 15),
+    "CHEST": (0.1, 15),
+    "F3-M2": (0.3, 35),
+    "F4-M1": (0.3, 35),
+    "C3-M2": (0.3, 35),
+    "C4-M1": (0.3, 35),
+    "O1-M2": (0.3, 35),
+    "O2-M1": (0.3, 35),
+    "Chin1-Chin2": (0.3, 35),
+    "ECG": (0.3, 70),
+}
 
 
 class RespiratoryEventType(Enum):
@@ -67,7 +85,229 @@ class RespiratoryEvent(EnduringEvent):
     event_type: RespiratoryEventType
 
 
-@dataclass
+class EventKind(Enum):
+    """Kind of an event within an EventTable. Each kind corresponds to one of the event dataclasses."""
+    Transient = 0
+    SleepStage = 1
+    Enduring = 2
+    Respiratory = 3
+
+
+_SLEEP_STAGE_TYPES = list(SleepStageType)
+_RESPIRATORY_EVENT_KEYWORDS = (("centralapnea", RespiratoryEventType.CentralApnea),
+                               ("mixedapnea", RespiratoryEventType.MixedApnea),
+                               ("obstructiveapnea", RespiratoryEventType.ObstructiveApnea),
+                               ("hypopnea", RespiratoryEventType.Hypopnea))
+
+
+def _get_sample_period(sample_frequency_hz: float) -> pd.Timedelta:
+    """Returns the time between two consecutive samples."""
+    return pd.to_timedelta(f"{1/sample_frequency_hz*1_000_000}us")
+
+
+def _classify_aux_note(aux_note: str, is_enduring: bool) -> Tuple[EventKind, int]:
+    """Determines kind and type code (-1 if there is none) of an event, based on its aux note."""
+    if is_enduring:
+        if "pnea" not in aux_note:
+            return EventKind.Enduring, -1
+        for keyword, event_type in _RESPIRATORY_EVENT_KEYWORDS:
+            if keyword in aux_note:
+                return EventKind.Respiratory, event_type.value
+        raise RuntimeError(f"Unrecognized *pnea event aux_note: '{aux_note}'")
+    if aux_note in [s.value for s in SleepStageType]:
+        return EventKind.SleepStage, _SLEEP_STAGE_TYPES.index(SleepStageType(aux_note))
+    return EventKind.Transient, -1
+
+
+@dataclass(frozen=True, eq=False)
+class EventTable:
+    """
+    Compact, struct-of-arrays representation of the events of a record. Each row represents one event; rows are kept
+    in the order that the event dataclasses would have in a list (i.e. the order of their terminating annotations).
+
+    Start/end positions are sample offsets relative to the beginning of the record, with respect to the table's
+    sample frequency. Transient events have equal start and end.
+    """
+    sample_frequency_hz: float
+    starts: np.ndarray  # int64
+    ends: np.ndarray  # int64
+    kinds: np.ndarray  # int8, values of EventKind
+    type_codes: np.ndarray  # int8. RespiratoryEventType value or index within SleepStageType; -1 for other kinds
+    aux_note_ids: np.ndarray  # int32, indexes into 'aux_notes'
+    aux_notes: Tuple[str, ...]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def from_annotations(samples: Sequence[int], aux_notes: Sequence[str], sample_frequency_hz: float) -> "EventTable":
+        """
+        Vectorized construction from raw annotations (e.g. the output of wfdb.rdann). Annotations of enduring events
+        come in pairs "(<name>" and "<name>)"; all other annotations are transient events.
+        """
+        samples = np.asarray(samples, dtype=np.int64)
+        notes = np.char.strip(np.asarray([str(a) for a in aux_notes], dtype=str))
+        is_start = np.char.startswith(notes, "(")
+        is_end = ~is_start & np.char.endswith(notes, ")")
+        is_transient = ~is_start & ~is_end
+        names = notes.copy()
+        names[is_start] = np.char.lstrip(notes[is_start], "(")
+        names[is_end] = np.char.rstrip(notes[is_end], ")")
+        unique_names, name_ids = np.unique(names, return_inverse=True)
+
+        # Pair start & end annotations: per name, they must alternate (start, end, start, end, ...)
+        enduring_positions = np.where(is_start | is_end)[0]
+        enduring_positions = enduring_positions[np.lexsort((enduring_positions, name_ids[enduring_positions]))]
+        enduring_name_ids = name_ids[enduring_positions]
+        is_group_begin = np.ones(shape=enduring_positions.shape, dtype=bool)
+        is_group_begin[1:] = enduring_name_ids[1:] != enduring_name_ids[:-1]
+        group_begin_positions = np.where(is_group_begin)[0]
+        rank_within_group = np.arange(len(enduring_positions)) - \
+            group_begin_positions[np.cumsum(is_group_begin) - 1]
+        expect_start = (rank_within_group % 2) == 0
+        violations = np.where(is_start[enduring_positions] != expect_start)[0]
+        if len(violations) != 0:
+            name = unique_names[enduring_name_ids[violations[0]]]
+            assert expect_start[violations[0]], f"Event '{name}' cannot start twice!"
+            raise AssertionError(f"Event '{name}' cannot end before starting!")
+        has_end = np.zeros(shape=enduring_positions.shape, dtype=bool)
+        has_end[:-1] = expect_start[:-1] & ~is_group_begin[1:]
+        pair_start_positions = enduring_positions[has_end]
+        pair_end_positions = enduring_positions[np.where(has_end)[0] + 1]  # Unterminated events are dropped
+        transient_positions = np.where(is_transient)[0]
+
+        # Assemble the rows, ordered by the annotation that terminates each event
+        order_keys = np.concatenate([pair_end_positions, transient_positions])
+        row_order = np.argsort(order_keys, kind="stable")
+        starts = np.concatenate([samples[pair_start_positions], samples[transient_positions]])[row_order]
+        ends = np.concatenate([samples[pair_end_positions], samples[transient_positions]])[row_order]
+        row_name_ids = np.concatenate([name_ids[pair_start_positions], name_ids[transient_positions]])[row_order]
+        row_is_enduring = np.concatenate([np.ones(len(pair_end_positions), dtype=bool),
+                                          np.zeros(len(transient_positions), dtype=bool)])[row_order]
+
+        # Classification is done once per distinct aux note & broadcast to the rows afterwards
+        row_keys = list(zip(row_name_ids.tolist(), row_is_enduring.tolist()))
+        classifications = {k: _classify_aux_note(aux_note=str(unique_names[k[0]]), is_enduring=k[1]) for k in set(row_keys)}
+        kinds = np.array([classifications[k][0].value for k in row_keys], dtype=np.int8)
+        type_codes = np.array([classifications[k][1] for k in row_keys], dtype=np.int8)
+        return EventTable(sample_frequency_hz=sample_frequency_hz, starts=starts, ends=ends, kinds=kinds,
+                          type_codes=type_codes, aux_note_ids=row_name_ids.astype(np.int32),
+                          aux_notes=tuple(str(n) for n in unique_names))
+
+    @staticmethod
+    def from_events(events: Sequence[_Event], sample_frequency_hz: float) -> "EventTable":
+        """Adapter that builds a table out of a list of event dataclasses (e.g. detected respiratory events)."""
+        sample_period = _get_sample_period(sample_frequency_hz=sample_frequency_hz)
+        aux_notes = sorted({str(e.aux_note) for e in events if e.aux_note is not None})
+        starts, ends, kinds, type_codes, aux_note_ids = [], [], [], [], []
+        for e in events:
+            starts += [round(e.start / sample_period)]
+            ends += [round(e.end / sample_period) if isinstance(e, EnduringEvent) else starts[-1]]
+            if isinstance(e, RespiratoryEvent):
+                kinds += [EventKind.Respiratory.value]
+                type_codes += [e.event_type.value]
+            elif isinstance(e, SleepStageEvent):
+                kinds += [EventKind.SleepStage.value]
+                type_codes += [_SLEEP_STAGE_TYPES.index(e.sleep_stage_type)]
+            else:
+                kinds += [EventKind.Enduring.value if isinstance(e, EnduringEvent) else EventKind.Transient.value]
+                type_codes += [-1]
+            aux_note_ids += [-1 if e.aux_note is None else aux_notes.index(str(e.aux_note))]
+        return EventTable(sample_frequency_hz=sample_frequency_hz, starts=np.array(starts, dtype=np.int64),
+                          ends=np.array(ends, dtype=np.int64), kinds=np.array(kinds, dtype=np.int8),
+                          type_codes=np.array(type_codes, dtype=np.int8),
+                          aux_note_ids=np.array(aux_note_ids, dtype=np.int32), aux_notes=tuple(aux_notes))
+
+    def to_events(self) -> List[_Event]:
+        """Adapter that returns the rows as event dataclasses, for code that works with event lists."""
+        start_times, end_times = self.start_times, self.end_times
+        events: List[_Event] = []
+        for i, (kind, type_code, aux_note_id) in enumerate(zip(self.kinds.tolist(), self.type_codes.tolist(),
+                                                                 self.aux_note_ids.tolist())):
+            aux_note = None if aux_note_id < 0 else self.aux_notes[aux_note_id]
+            kind = EventKind(kind)
+            if kind == EventKind.Respiratory:
+                events += [RespiratoryEvent(start=start_times[i], end=end_times[i], aux_note=aux_note,
+                                            event_type=RespiratoryEventType(type_code))]
+            elif kind == EventKind.Enduring:
+                events += [EnduringEvent(start=start_times[i], end=end_times[i], aux_note=aux_note)]
+            elif kind == EventKind.SleepStage:
+                events += [SleepStageEvent(start=start_times[i], aux_note=aux_note,
+                                           sleep_stage_type=_SLEEP_STAGE_TYPES[type_code])]
+            else:
+                events += [TransientEvent(start=start_times[i], aux_note=aux_note)]
+        return events
+
+    @property
+    def start_times(self) -> pd.TimedeltaIndex:
+        return pd.to_timedelta(self.starts * _get_sample_period(self.sample_frequency_hz).value, unit="ns")
+
+    @property
+    def end_times(self) -> pd.TimedeltaIndex:
+        return pd.to_timedelta(self.ends * _get_sample_period(self.sample_frequency_hz).value, unit="ns")
+
+    def take(self, rows: np.ndarray) -> "EventTable":
+        """Returns a table that consists of the given rows (indexes or boolean mask)."""
+        return EventTable(sample_frequency_hz=self.sample_frequency_hz, starts=self.starts[rows], ends=self.ends[rows],
+                          kinds=self.kinds[rows], type_codes=self.type_codes[rows],
+                          aux_note_ids=self.aux_note_ids[rows], aux_notes=self.aux_notes)
+
+    def of_kind(self, kind: EventKind) -> "EventTable":
+        """Returns all events of the given kind."""
+        return self.take(self.kinds == kind.value)
+
+    def type_mask(self, event_type: Union[RespiratoryEventType, SleepStageType]) -> np.ndarray:
+        """Returns a boolean mask of all rows that are respiratory events or sleep stages of the given type."""
+        if isinstance(event_type, RespiratoryEventType):
+            return (self.kinds == EventKind.Respiratory.value) & (self.type_codes == event_type.value)
+        type_code = _SLEEP_STAGE_TYPES.index(event_type)
+        return (self.kinds == EventKind.SleepStage.value) & (self.type_codes == type_code)
+
+    def of_type(self, event_type: Union[RespiratoryEventType, SleepStageType]) -> "EventTable":
+        """Returns all respiratory events or sleep stages of the given type."""
+        return self.take(self.type_mask(event_type))
+
+    def _to_sample(self, value: Union[int, pd.Timedelta]) -> int:
+        if isinstance(value, pd.Timedelta):
+            return round(value / _get_sample_period(self.sample_frequency_hz))
+        return int(value)
+
+    @functools.cached_property
+    def _start_order(self) -> np.ndarray:
+        return np.argsort(self.starts, kind="stable")
+
+    def overlapping(self, start: Union[int, pd.Timedelta], end: Union[int, pd.Timedelta]) -> "EventTable":
+        """
+        Returns all events that overlap the range start..end (both inclusive, samples or Timedeltas). Transient events
+        are returned if they lie within the range. Uses a binary search on the sorted event starts.
+        """
+        start, end = self._to_sample(start), self._to_sample(end)
+        start_order = self._start_order
+        candidates = start_order[:np.searchsorted(self.starts[start_order], end, side="right")]
+        return self.take(np.sort(candidates[self.ends[candidates] >= start]))
+
+    def clip(self, start: Union[int, pd.Timedelta], end: Union[int, pd.Timedelta]) -> "EventTable":
+        """
+        Restricts the table to the range start..end (both inclusive, samples or Timedeltas):
+        - Enduring events that overlap the range are kept, their start/end get clipped to the range.
+        - Transient events are kept if they lie within the range.
+        - The sleep stage that is active at the beginning of the range is kept as well, starting at the range's
+          beginning.
+        """
+        start, end = self._to_sample(start), self._to_sample(end)
+        is_enduring = self.kinds >= EventKind.Enduring.value
+        keep = (self.starts <= end) & (self.ends >= start) & (is_enduring | (self.starts >= start))
+        rows = np.where(keep)[0]
+        preceding_sleep_stages = np.where((self.kinds == EventKind.SleepStage.value) & (self.starts < start))[0]
+        if len(preceding_sleep_stages) != 0:
+            rows = np.concatenate([preceding_sleep_stages[-1:], rows])
+        clipped = self.take(rows)
+        np.clip(clipped.starts, start, end, out=clipped.starts)
+        np.clip(clipped.ends, start, end, out=clipped.ends)
+        return clipped
+
+
+@dataclass(init=False)
 class PhysioNetDataset:
     """
     Container for parsed PhysioNet 2018 dataset data. Supports both annotated (train) and non-annotated (test) datasets.
@@ -79,64 +319,170 @@ class PhysioNetDataset:
     signals: pd.DataFrame
     signal_units: List[str]
     sample_frequency_hz: float
-    events: Optional[List[_Event]]  # May be None in case there is no event list (i.e. arousal file)
+    event_table: Optional[EventTable]  # May be None in case there is no event list (i.e. arousal file)
+
+    def __init__(self, signals: pd.DataFrame, signal_units: List[str], sample_frequency_hz: float,
+                 event_table: Optional[Union[EventTable, Sequence[_Event]]] = None,
+                 events: Optional[Sequence[_Event]] = None):
+        """
+        :param event_table: Events of the dataset. For compatibility, a list of event dataclasses is accepted, too.
+        :param events: List of event dataclasses, as taken before there was an event table. It is converted into an
+                       event table. Must not be given together with 'event_table'.
+        """
+        if events is not None:
+            assert event_table is None, "Illegal parameter combination!"
+            event_table = events
+        if event_table is not None and not isinstance(event_table, EventTable):
+            event_table = EventTable.from_events(event_table, sample_frequency_hz=sample_frequency_hz)
+        self.signals = signals
+        self.signal_units = signal_units
+        self.sample_frequency_hz = sample_frequency_hz
+        self.event_table = event_table
+
+    @functools.cached_property
+    def events(self) -> Optional[List[_Event]]:
+        """List view of the event table, for code that works with event dataclasses."""
+        if self.event_table is None:
+            return None
+        return self.event_table.to_events()
 
     @functools.cached_property
     def respiratory_events(self) -> Optional[List[RespiratoryEvent]]:
-        if self.events is None:
+        if self.event_table is None:
             return None
-        respiratory_events = [e for e in self.events if isinstance(e, RespiratoryEvent)]
+        respiratory_events = self.event_table.of_kind(EventKind.Respiratory).to_events()
         return respiratory_events  # noqa   <-- Code-checker complains about allegedly incorrect type of list
 
     @functools.cached_property
     def sleep_stage_events(self) -> Optional[List[SleepStageEvent]]:
-        if self.events is None:
+        if self.event_table is None:
             return None
-        sleep_stage_events = [e for e in self.events if isinstance(e, SleepStageEvent)]
+        sleep_stage_events = self.event_table.of_kind(EventKind.SleepStage).to_events()
         return sleep_stage_events  # noqa   <-- Code-checker complains about allegedly incorrect type of list
 
-    def pre_clean(self) -> "PhysioNetDataset":
+    def select_channels(self, channels: Sequence[str]) -> "PhysioNetDataset":
         """
-        This function pre-cleans the signal data and applies low-/band-pass filtering according to AASM v2.0.3, page 12.
+        Returns a copy of the dataset that only contains the given channels (in the given order).
 
-        :return: Cleaned and filtered copy of the dataset
+        :param channels: Names of the signals that we wish to keep.
         """
-        o = deepcopy(self)
-        bandpass_wrapper = functools.partial(apply_butterworth_bandpass_filter, f_sample=self.sample_frequency_hz,
-                                             filter_order=5)
+        missing_channels = [c for c in channels if c not in self.signals]
+        assert len(missing_channels) == 0, f"Channels {missing_channels} are not part of the dataset"
+        signal_units = [self.signal_units[self.signals.columns.get_loc(c)] for c in channels]
+        return PhysioNetDataset(signals=self.signals[list(channels)].copy(), signal_units=signal_units,
+                                sample_frequency_hz=self.sample_frequency_hz, event_table=self.event_table)
 
-        sa_o2 = o.signals["SaO2"]
-        sa_o2[sa_o2 <= 20.0] = np.NAN
-        sa_o2 = sa_o2.interpolate(method="linear").bfill().ffill()
-        o.signals["SaO2"] = sa_o2
+    def _get_signal_units(self, channels: Sequence[str]) -> List[str]:
+        return [self.signal_units[self.signals.columns.get_loc(c)] for c in channels]
 
-        o.signals["AIRFLOW"] = bandpass_wrapper(o.signals["AIRFLOW"], f_low_cutoff=0.03, f_high_cutoff=3)
-        o.signals["ABD"] = bandpass_wrapper(o.signals["ABD"], f_low_cutoff=0.1, f_high_cutoff=15)
-        o.signals["CHEST"] = bandpass_wrapper(o.signals["CHEST"], f_low_cutoff=0.1, f_high_cutoff=15)
-
-        eeg_eog_signals = ("F3-M2", "F4-M1", "C3-M2", "C4-M1", "O1-M2", "O2-M1", "Chin1-Chin2")
-        for name in eeg_eog_signals:
-            o.signals[name] = bandpass_wrapper(o.signals[name], f_low_cutoff=0.3, f_high_cutoff=35)
+    def _get_cleaned_signals(self, channels: Optional[Sequence[str]]) -> pd.DataFrame:
+        """
+        Returns the pre-cleaned signals of the given channels. Raw signals are copied exactly once into a float32 array,
+        which is then cleaned & filtered in place.
+        """
+        channels = list(self.signals.columns) if channels is None else list(channels)
+        missing_channels = [c for c in channels if c not in self.signals]
+        assert len(missing_channels) == 0, f"Channels {missing_channels} are not part of the dataset"
+
+        values = np.empty(shape=(len(self.signals), len(channels)), dtype=np.float32)
+        for i, name in enumerate(channels):
+            values[:, i] = self.signals[name].to_numpy()
+        if "SaO2" in channels:
+            _clean_sa_o2(values[:, channels.index("SaO2")])
+
+        channel_cutoffs = {i: _PRE_CLEAN_BANDPASS_CUTOFFS[name] for i, name in enumerate(channels)
+                           if name in _PRE_CLEAN_BANDPASS_CUTOFFS}
+        apply_butterworth_bandpass_filter_bank(values, channel_cutoffs=channel_cutoffs,
+                                               f_sample=self.sample_frequency_hz, filter_order=5)
+        return pd.DataFrame(data=values, index=self.signals.index, columns=channels, copy=False)
+
+    def pre_clean(self, channels: Optional[Sequence[str]] = None) -> "PhysioNetDataset":
+        """
+        This function pre-cleans the signal data and applies low-/band-pass filtering according to AASM v2.0.3, page 12.
+        Only channels that are present in the dataset are processed.
 
-        o.signals["ECG"] = bandpass_wrapper(o.signals["ABD"], f_low_cutoff=0.3, f_high_cutoff=70)
-        o.signals = o.signals.astype("float32")
-        return o
+        :param channels: If given, only these channels are cleaned & kept in the returned dataset. If None, all
+                         channels are processed.
+        :return: Cleaned and filtered copy of the dataset
+        """
+        signals = self._get_cleaned_signals(channels=channels)
+        return PhysioNetDataset(signals=signals, signal_units=self._get_signal_units(signals.columns),
+                                sample_frequency_hz=self.sample_frequency_hz, event_table=self.event_table)
 
-    def downsample(self, downsampling_factor: int = None, target_frequency: float = None) -> "PhysioNetDataset":
+    def downsample(self, downsampling_factor: int = None, target_frequency: float = None,
+                   channels: Optional[Sequence[str]] = None, polyphase: bool = False) -> "PhysioNetDataset":
         """
         Returns a downsampled version of the dataset. The only touched data fields are 'signals' and
-        'sample_frequency_hz'. Exactly one of two two parameters must be provided!
+        'sample_frequency_hz'. Exactly one of two two parameters 'downsampling_factor' and 'target_frequency' must be
+        provided!
+
+        If the original sample frequency is an integer multiple of the target frequency, a fast path averages groups of
+        samples directly on the underlying arrays. Otherwise, we fall back to pandas' resampling.
+
+        :param channels: If given, only these channels are downsampled & kept in the returned dataset. If None, all
+                         channels are processed.
+        :param polyphase: If True, an anti-aliasing polyphase decimator is used instead of averaging. Requires an
+                          integer downsampling factor.
         """
         assert (downsampling_factor is None and target_frequency is not None) or \
                (downsampling_factor is not None and target_frequency is None), \
             "Exactly one of both parameters must be provided!"
-        o = deepcopy(self)
-        if downsampling_factor is not None:
-            o.sample_frequency_hz /= downsampling_factor
-        else:
-            o.sample_frequency_hz = target_frequency
-        o.signals = o.signals.resample(rule=f"{1/o.sample_frequency_hz*1_000_000}us").mean()
-        return o
+        if target_frequency is None:
+            target_frequency = self.sample_frequency_hz / downsampling_factor
+        signals = self.signals if channels is None else self.signals[list(channels)]
+        signals = _downsample_signals(signals, sample_frequency_hz=self.sample_frequency_hz,
+                                      target_frequency_hz=target_frequency, polyphase=polyphase)
+        return PhysioNetDataset(signals=signals, signal_units=self._get_signal_units(signals.columns),
+                                sample_frequency_hz=target_frequency, event_table=self.event_table)
+
+    def preprocess(self, target_frequency: float, channels: Optional[Sequence[str]] = None,
+                   polyphase: bool = False) -> "PhysioNetDataset":
+        """
+        Fused version of pre_clean(...).downsample(...). Goes from raw signals to downsampled float32 signals, with only
+        one full-resolution working copy of the selected channels & without copying the event table. Use this whenever
+        the full-resolution cleaned signals are not needed on their own.
+
+        :param target_frequency: Sample frequency of the returned dataset.
+        :param channels: If given, only these channels are processed & kept in the returned dataset. If None, all
+                         channels are processed.
+        :param polyphase: See downsample(...).
+        """
+        signals = self._get_cleaned_signals(channels=channels)
+        signals = _downsample_signals(signals, sample_frequency_hz=self.sample_frequency_hz,
+                                      target_frequency_hz=target_frequency, polyphase=polyphase)
+        return PhysioNetDataset(signals=signals, signal_units=self._get_signal_units(signals.columns),
+                                sample_frequency_hz=target_frequency, event_table=self.event_table)
+
+
+def _clean_sa_o2(sa_o2: np.ndarray) -> None:
+    """
+    Replaces implausible SaO2 values (<= 20%) in place, by linearly interpolating in between the valid neighbours.
+    Values at the very beginning/end are filled with the nearest valid value.
+    """
+    valid = sa_o2 > 20.0
+    if np.all(valid) or not np.any(valid):
+        if not np.all(valid):
+            sa_o2[:] = np.nan
+        return
+    positions = np.flatnonzero(valid)
+    invalid_positions = np.flatnonzero(~valid)
+    sa_o2[invalid_positions] = np.interp(invalid_positions, positions, sa_o2[positions].astype(np.float64))
+
+
+def _downsample_signals(signals: pd.DataFrame, sample_frequency_hz: float, target_frequency_hz: float,
+                        polyphase: bool) -> pd.DataFrame:
+    factor = sample_frequency_hz / target_frequency_hz
+    is_integer_factor = round(factor) >= 1 and math.isclose(factor, round(factor))
+    assert is_integer_factor or not polyphase, \
+        f"Polyphase decimation requires an integer downsampling factor, but it is {factor}"
+    signals_mat = signals.to_numpy()
+    if is_integer_factor and (polyphase or not np.any(np.isnan(signals_mat))):
+        decimate_fn = downsample_polyphase if polyphase else downsample_by_mean
+        signals_mat = decimate_fn(signals_mat, downsampling_factor=round(factor))
+        index = pd.timedelta_range(start=signals.index[0], periods=len(signals_mat),
+                                   freq=_get_sample_period(target_frequency_hz))
+        return pd.DataFrame(data=signals_mat, index=index, columns=signals.columns, copy=False)
+    return signals.resample(rule=f"{1/target_frequency_hz*1_000_000}us").mean()
 
 
 def test_enduring_event_overlaps():
@@ -174,3 +520,89 @@ def test_enduring_event_overlaps():
     event2 = EnduringEvent(start=pd.to_timedelta("1 minute"), end=pd.to_timedelta("2 minute"), aux_note=None)
     assert event1.overlaps(event2) is False
     assert event2.overlaps(event1) is False
+
+
+def test_event_table_from_annotations():
+    samples = [0, 10, 12, 20, 30, 35, 40, 50, 60]
+    aux_notes = ["W", "(resp_obstructiveapnea", "(arousal_rera", "resp_obstructiveapnea)", "N2", "arousal_rera)",
+                 "(resp_hypopnea", "resp_hypopnea)", "(resp_centralapnea"]
+    table = EventTable.from_annotations(samples=samples, aux_notes=aux_notes, sample_frequency_hz=10)
+    assert len(table) == 5  # The unterminated central apnea is dropped
+    s = pd.Timedelta("100ms")
+    assert table.to_events() == [
+        SleepStageEvent(start=0*s, aux_note="W", sleep_stage_type=SleepStageType.Wakefulness),
+        RespiratoryEvent(start=10*s, end=20*s, aux_note="resp_obstructiveapnea", event_type=RespiratoryEventType.ObstructiveApnea),
+        SleepStageEvent(start=30*s, aux_note="N2", sleep_stage_type=SleepStageType.NREM2),
+        EnduringEvent(start=12*s, end=35*s, aux_note="arousal_rera"),
+        RespiratoryEvent(start=40*s, end=50*s, aux_note="resp_hypopnea", event_type=RespiratoryEventType.Hypopnea),
+    ]
+    assert EventTable.from_events(table.to_events(), sample_frequency_hz=10).to_events() == table.to_events()
+
+    # Datasets still accept event lists, as before there was an event table
+    signals = pd.DataFrame(data={"ABD": np.zeros(70)}, index=pd.timedelta_range(start=0, periods=70, freq="100ms"))
+    for dataset in (PhysioNetDataset(signals=signals, signal_units=["uV"], sample_frequency_hz=10, events=table.to_events()),
+                    PhysioNetDataset(signals, ["uV"], 10, table.to_events())):
+        assert isinstance(dataset.event_table, EventTable) and dataset.events == table.to_events()
+    assert PhysioNetDataset(signals=signals, signal_units=["uV"], sample_frequency_hz=10).event_table is None
+
+    assert len(table.of_kind(EventKind.Respiratory)) == 2
+    assert table.of_type(RespiratoryEventType.Hypopnea).to_events()[0].start == 40*s
+    assert table.of_type(SleepStageType.NREM2).to_events()[0].start == 30*s
+    assert list(table.overlapping(start=21, end=40).starts) == [30, 12, 40]
+    assert list(table.overlapping(start=pd.Timedelta("2.1s"), end=pd.Timedelta("2.9s")).starts) == [12]
+
+    clipped = table.clip(start=15, end=45)
+    assert list(clipped.starts) == [15, 15, 30, 15, 40]  # The active sleep stage "W" is carried into the range
+    assert list(clipped.ends) == [15, 20, 30, 35, 45]
+
+
+def test_event_table_from_annotations__invalid():
+    with pytest.raises(AssertionError, match="cannot start twice"):
+        EventTable.from_annotations(samples=[0, 1, 2], aux_notes=["(arousal", "(arousal", "arousal)"], sample_frequency_hz=1)
+    with pytest.raises(AssertionError, match="cannot end before starting"):
+        EventTable.from_annotations(samples=[0, 1], aux_notes=["arousal)", "(arousal"], sample_frequency_hz=1)
+    with pytest.raises(RuntimeError):
+        EventTable.from_annotations(samples=[0, 1], aux_notes=["(resp_xpnea", "resp_xpnea)"], sample_frequency_hz=1)
+    assert len(EventTable.from_annotations(samples=[], aux_notes=[], sample_frequency_hz=1)) == 0
+
+
+def test_downsample():
+    index = pd.timedelta_range(start=0, periods=20_010, freq="5ms")
+    signals = pd.DataFrame(data=np.random.default_rng(0).normal(size=(20_010, 2)).astype(np.float32), index=index,
+                           columns=["ABD", "CHEST"])
+    dataset = PhysioNetDataset(signals=signals, signal_units=["uV", "uV"], sample_frequency_hz=200, event_table=None)
+
+    for target_frequency in (5, 16):  # Integer factor (fast path) & non-integer factor (pandas fallback)
+        downsampled = dataset.downsample(target_frequency=target_frequency)
+        expected = signals.resample(rule=f"{1/target_frequency*1_000_000}us").mean()
+        assert downsampled.sample_frequency_hz == target_frequency
+        pd.testing.assert_index_equal(downsampled.signals.index, expected.index)
+        assert np.allclose(downsampled.signals.values, expected.values, rtol=0, atol=1e-6)
+
+    downsampled = dataset.downsample(downsampling_factor=40, polyphase=True)
+    assert downsampled.signals.shape == (501, 2) and downsampled.signals.dtypes.iloc[0] == np.float32
+    with pytest.raises(AssertionError):
+        dataset.downsample(target_frequency=16, polyphase=True)
+
+
+def test_preprocess():
+    index = pd.timedelta_range(start=0, periods=20_000, freq="5ms")
+    rng = np.random.default_rng(0)
+    signals = pd.DataFrame(data=rng.normal(size=(20_000, 3)).astype(np.float32), index=index,
+                           columns=["ABD", "SaO2", "F3-M2"])
+    signals["SaO2"] = np.float32(95) + rng.normal(size=20_000).astype(np.float32)
+    signals.iloc[:7, 1] = 0
+    signals.iloc[5000:5100, 1] = 10
+    signals.iloc[-3:, 1] = 0
+    dataset = PhysioNetDataset(signals=signals, signal_units=["uV", "%", "uV"], sample_frequency_hz=200, event_table=None)
+
+    cleaned = dataset.pre_clean()
+    sa_o2 = signals["SaO2"].copy()
+    sa_o2[sa_o2 <= 20.0] = np.nan
+    assert np.array_equal(cleaned.signals["SaO2"].values, sa_o2.interpolate(method="linear").bfill().ffill().values)
+    assert np.array_equal(signals["SaO2"].values[:7], np.zeros(7)), "Raw signals must not be touched"
+
+    preprocessed = dataset.preprocess(target_frequency=5, channels=["SaO2", "ABD"])
+    expected = dataset.pre_clean(channels=["SaO2", "ABD"]).downsample(target_frequency=5)
+    pd.testing.assert_frame_equal(preprocessed.signals, expected.signals)
+    assert preprocessed.signal_units == ["%", "uV"] and preprocessed.sample_frequency_hz == 5
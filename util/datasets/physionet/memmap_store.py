@@ -0,0 +1,172 @@
+import json
+from pathlib import Path
+from typing import List, Optional, Dict, Any, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .definitions import PhysioNetDataset, EventTable
+from .reader import _create_time_index, _read_annotations, _read_wfdb_signals
+
+
+MEMMAP_STORE_FOLDER_NAME = "memmap_store"  # Default sub-folder (within a dataset folder) that holds the store
+_HEADER_FILE_NAME = "header.json"
+_STORE_FORMAT_VERSION = 1
+
+
+def has_memmap_store(store_folder: Path) -> bool:
+    """Returns if the given folder contains a complete memory-mapped store."""
+    return (store_folder / _HEADER_FILE_NAME).is_file()
+
+
+def convert_to_memmap_store(dataset_folder: Path, dataset_filename_stem: str = None, store_folder: Path = None,
+                            overwrite: bool = False) -> Path:
+    """
+    One-time conversion of a PhysioNet record into a columnar, memory-mappable layout. Each channel ends up in its own
+    float32 .npy file; sample frequency, units and annotations are kept in a small JSON header.
+
+    :param dataset_folder: The folder containing our .mat, .hea and .arousal files
+    :param dataset_filename_stem: Name that all the dataset files have in common. If None, we'll derive it from the
+                                  folder name.
+    :param store_folder: Folder that the store is written to. If None, a sub-folder of the dataset folder is used.
+    :param overwrite: If False, an already existing store is left untouched.
+    :return: The folder of the store.
+    """
+    assert dataset_folder.is_dir() and dataset_folder.exists(), \
+        f"Given dataset folder {dataset_folder} either not exists or is no folder."
+    if dataset_filename_stem is None:
+        dataset_filename_stem = dataset_folder.name
+    if store_folder is None:
+        store_folder = dataset_folder / MEMMAP_STORE_FOLDER_NAME
+    if has_memmap_store(store_folder=store_folder) and not overwrite:
+        return store_folder
+    store_folder.mkdir(parents=True, exist_ok=True)
+    (store_folder / _HEADER_FILE_NAME).unlink(missing_ok=True)
+
+    record_path = dataset_folder / dataset_filename_stem
+    df_signals, signal_units, sample_frequency = \
+        _read_wfdb_signals(record_path=record_path, channels=None, sampfrom=0, sampto=None, read_digital=True)
+    for signal_name in df_signals.columns:
+        np.save(file=store_folder / f"{signal_name}.npy", arr=df_signals[signal_name].to_numpy())
+    n_samples = len(df_signals)
+
+    annotations = _read_annotations(record_path=record_path)
+    header: Dict[str, Any] = {
+        "format_version": _STORE_FORMAT_VERSION,
+        "record_name": dataset_filename_stem,
+        "sample_frequency_hz": sample_frequency,
+        "n_samples": n_samples,
+        "signal_names": list(df_signals.columns),
+        "signal_units": list(signal_units),
+        "annotations": None if annotations is None else {"samples": annotations[0].tolist(), "aux_notes": annotations[1]},
+    }
+    # The header is written last. This way, its presence tells us that the store is complete.
+    with open(file=store_folder / _HEADER_FILE_NAME, mode="w") as file:
+        json.dump(obj=header, fp=file)
+    return store_folder
+
+
+class MemmapRecord:
+    """
+    Read access to a record that was converted by convert_to_memmap_store. Opening a record only parses the header;
+    the signals are memory-mapped, so only those samples are read from disk that are actually touched.
+    """
+    def __init__(self, store_folder: Path):
+        assert has_memmap_store(store_folder=store_folder), f"Folder '{store_folder}' does not contain a memmap store"
+        self.store_folder = store_folder
+        with open(file=store_folder / _HEADER_FILE_NAME, mode="r") as file:
+            self._header: Dict[str, Any] = json.load(file)
+        assert self._header["format_version"] == _STORE_FORMAT_VERSION, \
+            f"Store '{store_folder}' has an unsupported format version ({self._header['format_version']})"
+
+    @property
+    def sample_frequency_hz(self) -> float:
+        return self._header["sample_frequency_hz"]
+
+    @property
+    def n_samples(self) -> int:
+        return self._header["n_samples"]
+
+    @property
+    def signal_names(self) -> List[str]:
+        return self._header["signal_names"]
+
+    @property
+    def signal_units(self) -> List[str]:
+        return self._header["signal_units"]
+
+    def get_signal(self, signal_name: str) -> np.memmap:
+        """Returns the (read-only) memory-mapped samples of a single channel."""
+        assert signal_name in self.signal_names, f"Signal '{signal_name}' is not part of the store"
+        return np.load(file=self.store_folder / f"{signal_name}.npy", mmap_mode="r")
+
+    def get_signal_units(self, channels: Optional[Sequence[str]] = None) -> List[str]:
+        """Returns the units of the given channels. If None, the units of all channels are returned."""
+        if channels is None:
+            return list(self.signal_units)
+        return [self.signal_units[self.signal_names.index(c)] for c in channels]
+
+    def read_signals(self, channels: Optional[Sequence[str]] = None, sampfrom: int = 0,
+                     sampto: Optional[int] = None) -> pd.DataFrame:
+        """
+        Reads (a time range of) the signals into a DataFrame. Only the requested samples are touched on disk.
+
+        :param channels: Names of the signals that we wish to read. If None, all signals of the record are read.
+        :param sampfrom: First sample that we wish to read.
+        :param sampto: Sample (exclusive) up to which we wish to read. If None, we read up to the end of the record.
+        """
+        if channels is None:
+            channels = self.signal_names
+        if sampto is None:
+            sampto = self.n_samples
+        assert 0 <= sampfrom < sampto <= self.n_samples, f"Invalid sample range {sampfrom}..{sampto}"
+        index = _create_time_index(sample_frequency_hz=self.sample_frequency_hz, n_samples=sampto-sampfrom,
+                                   sampfrom=sampfrom)
+        signals_mat = np.empty(shape=(sampto-sampfrom, len(channels)), dtype=np.float32)
+        for i, signal_name in enumerate(channels):
+            signals_mat[:, i] = self.get_signal(signal_name)[sampfrom:sampto]
+        return pd.DataFrame(data=signals_mat, columns=list(channels), index=index, copy=False)
+
+    def read_event_table(self) -> Optional[EventTable]:
+        """Returns the events of the whole record. None if the record has no annotations."""
+        annotations: Optional[Dict[str, list]] = self._header["annotations"]
+        if annotations is None:
+            return None
+        return EventTable.from_annotations(samples=annotations["samples"], aux_notes=annotations["aux_notes"],
+                                           sample_frequency_hz=self.sample_frequency_hz)
+
+    def read(self, channels: Optional[Sequence[str]] = None, sampfrom: int = 0,
+             sampto: Optional[int] = None) -> PhysioNetDataset:
+        """
+        Materializes (a time range of) the record as PhysioNetDataset, equally to what read_physionet_dataset returns.
+        Parameters are the same as for read_signals.
+        """
+        df_signals = self.read_signals(channels=channels, sampfrom=sampfrom, sampto=sampto)
+        event_table = self.read_event_table()
+        if event_table is not None and (sampfrom != 0 or sampto is not None):
+            event_table = event_table.clip(start=sampfrom, end=sampfrom + len(df_signals) - 1)
+        return PhysioNetDataset(signals=df_signals, signal_units=self.get_signal_units(channels=channels),
+                                sample_frequency_hz=self.sample_frequency_hz, event_table=event_table)
+
+
+def test_memmap_store_equals_wfdb_read(tmp_path):
+    from .reader import read_physionet_dataset, _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001")
+    store_folder = convert_to_memmap_store(dataset_folder=dataset_folder)
+    assert has_memmap_store(store_folder=store_folder)
+
+    wfdb_dataset = read_physionet_dataset(dataset_folder=dataset_folder)
+    store_dataset = read_physionet_dataset(dataset_folder=dataset_folder, use_memmap_store=True)
+    pd.testing.assert_frame_equal(wfdb_dataset.signals, store_dataset.signals)
+    assert wfdb_dataset.signal_units == store_dataset.signal_units
+    assert wfdb_dataset.sample_frequency_hz == store_dataset.sample_frequency_hz
+    assert wfdb_dataset.events == store_dataset.events
+
+    airflow = MemmapRecord(store_folder=store_folder).get_signal("AIRFLOW")
+    assert isinstance(airflow, np.memmap)
+    assert np.array_equal(airflow[1000:1010], wfdb_dataset.signals["AIRFLOW"].values[1000:1010])
+
+    channels = ["SaO2", "ABD"]
+    pd.testing.assert_frame_equal(MemmapRecord(store_folder=store_folder).read(channels=channels).signals,
+                                  wfdb_dataset.signals[channels])
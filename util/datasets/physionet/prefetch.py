@@ -0,0 +1,208 @@
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Optional, Sequence, Iterator, Tuple, Any, Deque
+
+import pandas as pd
+import pytest
+import wfdb
+
+from .definitions import PhysioNetDataset
+from .reader import read_physionet_dataset
+
+
+def _estimate_physionet_dataset_bytes(dataset_folder: Path, channels: Optional[Sequence[str]] = None) -> int:
+    """Estimates the memory a (float32) PhysioNetDataset of the given record occupies, by reading its header only."""
+    header = wfdb.rdheader(record_name=str(dataset_folder / dataset_folder.name))
+    n_channels = header.n_sig if channels is None else len(channels)
+    return header.sig_len * (n_channels * 4 + 8)  # float32 signals + int64 time index
+
+
+def _get_nbytes(data: Any) -> Optional[int]:
+    """Returns the memory that is occupied by the signals of a loaded dataset. None, if unknown."""
+    signals = getattr(data, "signals", None)
+    if isinstance(signals, pd.DataFrame):
+        return int(signals.memory_usage(index=True, deep=False).sum())
+    return None
+
+
+class _MemoryBudget:
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n_bytes: int, force: bool = False) -> bool:
+        with self._lock:
+            if not force and self.max_bytes is not None and self.used_bytes + n_bytes > self.max_bytes:
+                return False
+            self.used_bytes += n_bytes
+            return True
+
+    def release(self, n_bytes: int):
+        with self._lock:
+            self.used_bytes -= n_bytes
+
+
+class PrefetchingReader:
+    """
+    Reads a sequence of records in the background & yields them as soon as they are ready. Each record passes two
+    stages: loading (I/O, 'load_fn') on a pool of I/O threads, followed by an optional processing step (CPU,
+    'process_fn', e.g. pre-cleaning/downsampling) on a pool of worker threads. Reading wfdb files, filtering & numba
+    code mostly release the GIL, and no datasets need to be pickled between processes.
+
+    Prefetching is bounded: at most 'max_prefetched' records are in flight (loading, processing, or waiting to be
+    consumed), and their estimated memory must not exceed 'max_bytes'. New loads are only started once the consumer
+    took records off the reader, so corpora larger than RAM can be streamed.
+
+    Usage:
+        reader = PrefetchingReader(dataset_folders, process_fn=lambda ds: ds.preprocess(target_frequency=5))
+        for dataset_folder, dataset in reader:
+            ...
+    """
+    def __init__(self, dataset_folders: Sequence[Path], load_fn: Optional[Callable[[Path], Any]] = None,
+                 process_fn: Optional[Callable[[Any], Any]] = None, channels: Optional[Sequence[str]] = None,
+                 n_io_threads: int = 2, n_cpu_workers: int = 1, max_prefetched: int = 4,
+                 max_bytes: Optional[int] = None, estimate_bytes_fn: Optional[Callable[[Path], int]] = None,
+                 ordered: bool = True):
+        """
+        :param dataset_folders: Record folders that we wish to read.
+        :param load_fn: Function that loads a record folder. If None, the record is read via read_physionet_dataset
+                        (digital read mode, restricted to 'channels').
+        :param process_fn: Optional function that is applied to each loaded record on the CPU workers.
+        :param channels: Channels that are read by the default 'load_fn' (all if None).
+        :param n_io_threads: Number of threads that run 'load_fn'.
+        :param n_cpu_workers: Number of threads that run 'process_fn'.
+        :param max_prefetched: Maximum number of records that are in flight at the same time.
+        :param max_bytes: Memory cap for all records in flight. A record whose estimate alone exceeds the cap is still
+                          read, but only once no other record is in flight. If None, only 'max_prefetched' applies.
+        :param estimate_bytes_fn: Estimates the memory of a loaded record before loading it. If None, it is estimated
+                                  from the record's header.
+        :param ordered: If True, records are yielded in the order of 'dataset_folders'. Otherwise, they are yielded in
+                        the order they become ready.
+        """
+        assert n_io_threads >= 1 and n_cpu_workers >= 1 and max_prefetched >= 1, \
+            "Number of threads/workers and of prefetched records must be at least 1"
+        self.dataset_folders = list(dataset_folders)
+        self.load_fn = load_fn if load_fn is not None else \
+            functools.partial(_read_physionet_dataset_folder, channels=channels)
+        self.process_fn = process_fn
+        self.n_io_threads = n_io_threads
+        self.n_cpu_workers = n_cpu_workers
+        self.max_prefetched = max_prefetched
+        self.max_bytes = max_bytes
+        self.estimate_bytes_fn = estimate_bytes_fn if estimate_bytes_fn is not None else \
+            functools.partial(_estimate_physionet_dataset_bytes, channels=channels)
+        self.ordered = ordered
+
+    def __len__(self):
+        return len(self.dataset_folders)
+
+    def __iter__(self) -> Iterator[Tuple[Path, Any]]:
+        budget = _MemoryBudget(max_bytes=self.max_bytes)
+        with ThreadPoolExecutor(max_workers=self.n_io_threads, thread_name_prefix="prefetch-io") as io_executor, \
+                ThreadPoolExecutor(max_workers=self.n_cpu_workers, thread_name_prefix="prefetch-cpu") as cpu_executor:
+            pending: Deque[Tuple[Path, Future, int]] = deque()
+            next_index = 0
+            try:
+                while next_index < len(self.dataset_folders) or len(pending) != 0:
+                    # Start as many loads as our limits allow. If nothing is in flight, we start one in any case
+                    while next_index < len(self.dataset_folders) and len(pending) < self.max_prefetched:
+                        dataset_folder = self.dataset_folders[next_index]
+                        n_bytes = self.estimate_bytes_fn(dataset_folder) if self.max_bytes is not None else 0
+                        if not budget.try_acquire(n_bytes, force=len(pending) == 0):
+                            break
+                        future = self._submit(dataset_folder, io_executor=io_executor, cpu_executor=cpu_executor)
+                        pending.append((dataset_folder, future, n_bytes))
+                        next_index += 1
+
+                    if self.ordered:
+                        dataset_folder, future, n_bytes = pending.popleft()
+                    else:
+                        wait([f for _, f, _ in pending], return_when=FIRST_COMPLETED)
+                        dataset_folder, future, n_bytes = next(p for p in pending if p[1].done())
+                        pending.remove((dataset_folder, future, n_bytes))
+                    data = future.result()
+
+                    # Once the record is processed, its actual size is known (processing usually shrinks it)
+                    actual_bytes = _get_nbytes(data) if self.max_bytes is not None else None
+                    if actual_bytes is not None:
+                        budget.release(n_bytes)
+                        budget.try_acquire(actual_bytes, force=True)
+                        n_bytes = actual_bytes
+                    yield dataset_folder, data
+                    del data
+                    budget.release(n_bytes)
+            finally:
+                # In case the consumer stops early, records that have not started loading yet are dropped
+                io_executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, dataset_folder: Path, io_executor: ThreadPoolExecutor,
+                cpu_executor: ThreadPoolExecutor) -> Future:
+        """Runs loading & processing of a record. The returned future is done once both stages are through."""
+        result_future = Future()
+
+        def _on_processed(processing_future: Future):
+            try:
+                result_future.set_result(processing_future.result())
+            except BaseException as e:
+                result_future.set_exception(e)
+
+        def _on_loaded(loading_future: Future):
+            try:
+                data = loading_future.result()
+                if self.process_fn is None:
+                    result_future.set_result(data)
+                    return
+                cpu_executor.submit(self.process_fn, data).add_done_callback(_on_processed)
+            except BaseException as e:
+                result_future.set_exception(e)
+
+        io_executor.submit(self.load_fn, dataset_folder).add_done_callback(_on_loaded)
+        return result_future
+
+
+def _read_physionet_dataset_folder(dataset_folder: Path, channels: Optional[Sequence[str]]) -> PhysioNetDataset:
+    return read_physionet_dataset(dataset_folder=dataset_folder, channels=channels, read_digital=True)
+
+
+def test_prefetching_reader(tmp_path):
+    from .reader import _write_test_record
+
+    dataset_folders = [_write_test_record(dataset_folder=tmp_path / f"tr00-000{i}", duration_seconds=120 + 60*i, seed=i)
+                       for i in range(5)]
+    expected = [read_physionet_dataset(dataset_folder=f, channels=["ABD", "SaO2"]).preprocess(target_frequency=5)
+                for f in dataset_folders]
+
+    reader = PrefetchingReader(dataset_folders, channels=["ABD", "SaO2"], n_io_threads=2, n_cpu_workers=2,
+                               process_fn=lambda ds: ds.preprocess(target_frequency=5), max_prefetched=3)
+    results = list(reader)
+    assert [f for f, _ in results] == dataset_folders
+    for (_, dataset), expected_dataset in zip(results, expected):
+        pd.testing.assert_frame_equal(dataset.signals, expected_dataset.signals)
+
+    # A memory cap that fits only a single raw record must still let every record pass, one after another
+    in_flight, max_in_flight = [0], [0]
+    lock = threading.Lock()
+
+    def _load_fn(dataset_folder: Path):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        return read_physionet_dataset(dataset_folder=dataset_folder, channels=["ABD"])
+
+    reader = PrefetchingReader(dataset_folders, load_fn=_load_fn, max_prefetched=5, ordered=False,
+                               max_bytes=_estimate_physionet_dataset_bytes(dataset_folders[0], channels=["ABD"]),
+                               estimate_bytes_fn=lambda f: _estimate_physionet_dataset_bytes(f, channels=["ABD"]))
+    for dataset_folder, dataset in reader:
+        with lock:
+            in_flight[0] -= 1
+    assert max_in_flight[0] == 1
+
+    # Errors of the loading stage are passed on to the consumer
+    reader = PrefetchingReader([tmp_path / "does-not-exist"])
+    with pytest.raises(Exception):
+        list(reader)
+
@@ -1,43 +1,105 @@
-from typing import List, Optional, Dict
+from typing import List, Optional, Tuple, Sequence, Iterator, Dict
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import wfdb
 
-from .definitions import RespiratoryEventType, RespiratoryEvent, EnduringEvent, PhysioNetDataset, _Event, TransientEvent, \
-    SleepStageType, SleepStageEvent
+from .definitions import PhysioNetDataset, EventTable, _get_sample_period
 
 
-_SLEEP_STAGE_KEYWORDS = [s.value for s in SleepStageType]
+def _create_time_index(sample_frequency_hz: float, n_samples: int, sampfrom: int = 0) -> pd.TimedeltaIndex:
+    """
+    Creates the TimedeltaIndex that we use for the signals of a record. In case only a part of the record is read,
+    'sampfrom' shifts the index, such that it keeps referring to the beginning of the record.
+    """
+    sample_period = _get_sample_period(sample_frequency_hz=sample_frequency_hz)
+    # Start from integer nanoseconds, such that the index keeps ns resolution regardless of the sample period's unit
+    return pd.timedelta_range(start=sample_period.value*sampfrom, periods=n_samples, freq=sample_period)
 
 
-def _create_enduring_event(start: pd.Timedelta, end: pd.Timedelta, aux_note: str) -> EnduringEvent:
+def _read_annotations(record_path: Path) -> Optional[Tuple[np.ndarray, List[str]]]:
     """
-    Creates an EnduringEvent out of the given parameters. In certain cases, it chooses the sub-class ApneaEvent instead.
+    Reads the raw annotations (sample indexes & aux notes) of a record, in case there is an arousal file.
+
+    :param record_path: Path to the record, without file extension.
+    :return: Tuple of sample indexes and aux notes. None if there is no arousal file.
     """
-    if "pnea" in aux_note:
-        if "centralapnea" in aux_note:
-            event_type = RespiratoryEventType.CentralApnea
-        elif "mixedapnea" in aux_note:
-            event_type = RespiratoryEventType.MixedApnea
-        elif "obstructiveapnea" in aux_note:
-            event_type = RespiratoryEventType.ObstructiveApnea
-        elif "hypopnea" in aux_note:
-            event_type = RespiratoryEventType.Hypopnea
-        else:
-            raise RuntimeError(f"Unrecognized *pnea event aux_note: '{aux_note}'")
-        return RespiratoryEvent(start=start, end=end, aux_note=aux_note, event_type=event_type)
-    return EnduringEvent(start=start, end=end, aux_note=aux_note)
+    arousal_file = record_path.parent / f"{record_path.name}.arousal"
+    if not arousal_file.exists():
+        return None
+    arousal = wfdb.rdann(record_name=str(record_path), extension="arousal")
+    return np.asarray(arousal.sample, dtype=np.int64), [str(a) for a in arousal.aux_note]
 
 
-def _create_transient_event(start: pd.Timedelta, aux_note: str) -> TransientEvent:
-    if aux_note in _SLEEP_STAGE_KEYWORDS:
-        sleep_stage_type = SleepStageType(aux_note)
-        return SleepStageEvent(start=start, aux_note=aux_note, sleep_stage_type=sleep_stage_type)
-    return TransientEvent(start=start, aux_note=aux_note)
+# Signal formats whose digital samples fit into int16, see https://www.physionet.org/physiotools/wag/signal-5.htm, and
+# the digital value that each of them reserves for invalid (NaN) samples. Format 8 (first differences) has none.
+_INT16_SIGNAL_FORMATS__DIGITAL_NAN = {"8": None, "16": -32768, "61": -32768, "80": -128, "160": -32768, "212": -2048,
+                                      "310": -512, "311": -512}
+
+
+def _digital_to_physical(d_signal: np.ndarray, baseline: int, adc_gain: float, d_nan: Optional[int]) -> np.ndarray:
+    """
+    Converts the digital samples of one channel to (float32) physical values. The arithmetic is done in float64, exactly
+    like wfdb does it, so the result equals wfdb's physical values cast to float32.
+    """
+    p_signal = d_signal.astype(np.float64)
+    np.subtract(p_signal, baseline, out=p_signal)
+    np.divide(p_signal, adc_gain, out=p_signal)
+    if d_nan is not None:
+        p_signal[d_signal == d_nan] = np.nan
+    return p_signal.astype(np.float32)
+
 
+def _read_wfdb_signals(record_path: Path, channels: Optional[Sequence[str]], sampfrom: int, sampto: Optional[int],
+                       read_digital: bool = False) -> Tuple[pd.DataFrame, List[str], float]:
+    """
+    Reads (a time range of) the signals of a record using wfdb. Returns signals, signal units & sample frequency.
 
-def read_physionet_dataset(dataset_folder: Path, dataset_filename_stem: str = None) -> PhysioNetDataset:
+    In case of 'read_digital', the digital samples are read as int16 and converted channel by channel. This way, wfdb
+    does not expand all channels into one float64 matrix first. This requires all channels that we read to be stored
+    in int16-compatible formats; otherwise, we fall back to wfdb's physical values.
+    """
+    channel_names = None if channels is None else list(channels)
+    if read_digital:
+        header = wfdb.rdheader(record_name=str(record_path))
+        read_formats = [fmt for name, fmt in zip(header.sig_name, header.fmt) if channels is None or name in channels]
+        read_digital = all(fmt in _INT16_SIGNAL_FORMATS__DIGITAL_NAN for fmt in read_formats)
+    record = wfdb.rdrecord(record_name=str(record_path), channel_names=channel_names, sampfrom=sampfrom, sampto=sampto,
+                           physical=not read_digital, return_res=16 if read_digital else 64)
+    if channels is not None:
+        missing_channels = [c for c in channels if c not in record.sig_name]
+        assert len(missing_channels) == 0, f"Channels {missing_channels} are not part of dataset '{record_path.name}'"
+    sample_frequency = float(record.fs)
+
+    if read_digital:
+        n_samples = len(record.d_signal)
+        signals_mat = np.empty(shape=(n_samples, record.n_sig), dtype=np.float32)
+        for i, fmt in enumerate(record.fmt):
+            signals_mat[:, i] = _digital_to_physical(record.d_signal[:, i], baseline=record.baseline[i],
+                                                     adc_gain=record.adc_gain[i], d_nan=_INT16_SIGNAL_FORMATS__DIGITAL_NAN[fmt])
+        record.d_signal = None
+    else:
+        n_samples = len(record.p_signal)
+        signals_mat = record.p_signal
+    index = _create_time_index(sample_frequency_hz=sample_frequency, n_samples=n_samples, sampfrom=sampfrom)
+    df_signals = pd.DataFrame(data=signals_mat, columns=record.sig_name, index=index, dtype="float32", copy=False)
+    return df_signals, record.units, sample_frequency
+
+
+def _open_memmap_store(dataset_folder: Path, dataset_filename_stem: str):
+    """Opens the memory-mapped store of a dataset. In case there is no store yet, it is created beforehand."""
+    from .memmap_store import MemmapRecord, MEMMAP_STORE_FOLDER_NAME, has_memmap_store, convert_to_memmap_store
+    store_folder = dataset_folder / MEMMAP_STORE_FOLDER_NAME
+    if not has_memmap_store(store_folder=store_folder):
+        convert_to_memmap_store(dataset_folder=dataset_folder, dataset_filename_stem=dataset_filename_stem,
+                                store_folder=store_folder)
+    return MemmapRecord(store_folder=store_folder)
+
+
+def read_physionet_dataset(dataset_folder: Path, dataset_filename_stem: str = None,
+                           channels: Optional[Sequence[str]] = None, sampfrom: int = 0, sampto: Optional[int] = None,
+                           use_memmap_store: bool = False, read_digital: bool = False) -> PhysioNetDataset:
     """
     Reads datasets of the [*PhysioNet Challenge 2018*](https://physionet.org/content/challenge-2018/1.0.0/). Reads
     samples and annotations from a given dataset folder.
@@ -46,6 +108,16 @@ def read_physionet_dataset(dataset_folder: Path, dataset_filename_stem: str = No
     :param dataset_folder: The folder containing our .mat, .hea and .arousal files
     :param dataset_filename_stem: Name that all the dataset files have in common. If None, we'll derive it from the
                                   folder name.
+    :param channels: Names of the signals that we wish to read. If None, all signals of the record are read.
+    :param sampfrom: First sample of the record that we wish to read.
+    :param sampto: Sample (exclusive) up to which we wish to read. If None, we read up to the end of the record. In case
+                   only a part of the record is read, the signals index keeps referring to the beginning of the record
+                   and the events are clipped to the read time range.
+    :param use_memmap_store: If True, the dataset is read from its memory-mapped store. In case there is no store yet,
+                             it will be created beforehand (one-time conversion).
+    :param read_digital: If True, the digital (int16) samples are read from disk & converted to physical values channel
+                         by channel. The result is the same, but the memory peak is considerably lower. Records whose
+                         signal format does not fit into int16 are read the usual way.
     :return: The Dataset instance.
     """
     assert dataset_folder.is_dir() and dataset_folder.exists(), \
@@ -53,35 +125,101 @@ def read_physionet_dataset(dataset_folder: Path, dataset_filename_stem: str = No
     if dataset_filename_stem is None:
         dataset_filename_stem = dataset_folder.name
 
+    if use_memmap_store:
+        record = _open_memmap_store(dataset_folder=dataset_folder, dataset_filename_stem=dataset_filename_stem)
+        return record.read(channels=channels, sampfrom=sampfrom, sampto=sampto)
+
     # Read the signal files (.hea & .mat)
-    record = wfdb.rdrecord(record_name=str(dataset_folder / dataset_filename_stem))
-    sample_frequency = float(record.fs)
-    index = pd.timedelta_range(start=0, periods=len(record.p_signal), freq=f"{1/sample_frequency*1_000_000}us")
-    df_signals = pd.DataFrame(data=record.p_signal, columns=record.sig_name, index=index, dtype="float32")
-    signal_units = record.units
+    record_path = dataset_folder / dataset_filename_stem
+    df_signals, signal_units, sample_frequency = \
+        _read_wfdb_signals(record_path=record_path, channels=channels, sampfrom=sampfrom, sampto=sampto,
+                           read_digital=read_digital)
 
     # In case they exist, read the annotations
-    arousal_file = dataset_folder / f"{dataset_filename_stem}.arousal"
-    events: Optional[List[_Event]] = None
-    if arousal_file.exists():
-        arousal = wfdb.rdann(record_name=str(dataset_folder / dataset_filename_stem), extension="arousal")
-        events = []
-        open_parentheses: Dict[str, int] = {}
-        for aux_note, sample_idx in zip(arousal.aux_note, arousal.sample):
-            aux_note = str(aux_note).strip()
-            if aux_note.startswith("("):
-                aux_note = aux_note.lstrip("(")
-                assert aux_note not in open_parentheses, f"Event '{aux_note}' cannot start twice!"
-                open_parentheses[aux_note] = sample_idx
-            elif aux_note.endswith(")"):
-                aux_note = aux_note.rstrip(")")
-                assert aux_note in open_parentheses, f"Event '{aux_note}' cannot end before starting!"
-                start_sample_idx = open_parentheses.pop(aux_note)
-                events += [_create_enduring_event(start=index[start_sample_idx], end=index[sample_idx], aux_note=aux_note)]
-            else:
-                events += [_create_transient_event(start=index[sample_idx], aux_note=aux_note)]
+    event_table: Optional[EventTable] = None
+    annotations = _read_annotations(record_path=record_path)
+    if annotations is not None:
+        event_table = EventTable.from_annotations(samples=annotations[0], aux_notes=annotations[1],
+                                                  sample_frequency_hz=sample_frequency)
+        if sampfrom != 0 or sampto is not None:
+            event_table = event_table.clip(start=sampfrom, end=sampfrom + len(df_signals) - 1)
     return PhysioNetDataset(signals=df_signals, signal_units=signal_units, sample_frequency_hz=sample_frequency,
-                            events=events)
+                            event_table=event_table)
+
+
+def read_physionet_dataset_time_range(dataset_folder: Path, start: pd.Timedelta, end: pd.Timedelta,
+                                      dataset_filename_stem: str = None, channels: Optional[Sequence[str]] = None,
+                                      use_memmap_store: bool = False, read_digital: bool = False) -> PhysioNetDataset:
+    """
+    Reads a time range (e.g. 02:00..02:10) of a PhysioNet dataset. Only the samples within that range are read from
+    disk. See read_physionet_dataset for a description of the remaining parameters.
+
+    :param start: Beginning of the time range, relative to the beginning of the record.
+    :param end: End (exclusive) of the time range, relative to the beginning of the record.
+    """
+    assert start < end, f"Given start ({start}) must lie before end ({end})"
+    if dataset_filename_stem is None:
+        dataset_filename_stem = dataset_folder.name
+    header = wfdb.rdheader(record_name=str(dataset_folder / dataset_filename_stem))
+    sampfrom = max(0, round(start.total_seconds() * header.fs))
+    sampto = min(header.sig_len, round(end.total_seconds() * header.fs))
+    assert sampfrom < sampto, f"Given time range {start}..{end} lies outside of the record"
+    return read_physionet_dataset(dataset_folder=dataset_folder, dataset_filename_stem=dataset_filename_stem,
+                                  channels=channels, sampfrom=sampfrom, sampto=sampto, use_memmap_store=use_memmap_store,
+                                  read_digital=read_digital)
+
+
+def iterate_physionet_dataset_chunks(dataset_folder: Path, chunk_duration: pd.Timedelta,
+                                     chunk_overlap: pd.Timedelta = pd.Timedelta(0), dataset_filename_stem: str = None,
+                                     channels: Optional[Sequence[str]] = None,
+                                     use_memmap_store: bool = False,
+                                     read_digital: bool = False) -> Iterator[PhysioNetDataset]:
+    """
+    Reads a PhysioNet dataset chunk by chunk, such that whole nights can be processed with bounded memory. Each chunk is
+    a PhysioNetDataset on its own; its signals index refers to the beginning of the record and its events are clipped
+    to the chunk. Annotations are read only once. See read_physionet_dataset for the remaining parameters.
+
+    :param chunk_duration: Duration of each chunk. The last chunk of a record may be shorter.
+    :param chunk_overlap: Duration by which consecutive chunks overlap. Must be smaller than chunk_duration.
+    """
+    assert dataset_folder.is_dir() and dataset_folder.exists(), \
+        f"Given dataset folder {dataset_folder} either not exists or is no folder."
+    if dataset_filename_stem is None:
+        dataset_filename_stem = dataset_folder.name
+    record_path = dataset_folder / dataset_filename_stem
+
+    if use_memmap_store:
+        record = _open_memmap_store(dataset_folder=dataset_folder, dataset_filename_stem=dataset_filename_stem)
+        sample_frequency, n_samples = record.sample_frequency_hz, record.n_samples
+        event_table = record.read_event_table()
+    else:
+        header = wfdb.rdheader(record_name=str(record_path))
+        sample_frequency, n_samples = float(header.fs), header.sig_len
+        event_table = None
+        annotations = _read_annotations(record_path=record_path)
+        if annotations is not None:
+            event_table = EventTable.from_annotations(samples=annotations[0], aux_notes=annotations[1],
+                                                      sample_frequency_hz=sample_frequency)
+
+    chunk_size = round(chunk_duration.total_seconds() * sample_frequency)
+    overlap_size = round(chunk_overlap.total_seconds() * sample_frequency)
+    assert chunk_size > 0 and 0 <= overlap_size < chunk_size, \
+        f"Invalid chunk parameters: chunk_duration={chunk_duration}, chunk_overlap={chunk_overlap}"
+
+    for sampfrom in range(0, n_samples, chunk_size - overlap_size):
+        sampto = min(sampfrom + chunk_size, n_samples)
+        if use_memmap_store:
+            df_signals = record.read_signals(channels=channels, sampfrom=sampfrom, sampto=sampto)
+            signal_units = record.get_signal_units(channels=channels)
+        else:
+            df_signals, signal_units, _ = \
+                _read_wfdb_signals(record_path=record_path, channels=channels, sampfrom=sampfrom, sampto=sampto,
+                                   read_digital=read_digital)
+        chunk_event_table = None if event_table is None else event_table.clip(start=sampfrom, end=sampto - 1)
+        yield PhysioNetDataset(signals=df_signals, signal_units=signal_units, sample_frequency_hz=sample_frequency,
+                               event_table=chunk_event_table)
+        if sampto == n_samples:
+            break
 
 
 def test_read_dataset():
@@ -91,3 +229,134 @@ def test_read_dataset():
     dataset = dataset.pre_clean()
     dataset = dataset.downsample(downsampling_factor=10)
     pass
+
+
+def test_read_dataset__channel_selection(tmp_path):
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001")
+    channels = ("ABD", "CHEST", "AIRFLOW", "SaO2")
+
+    full_dataset = read_physionet_dataset(dataset_folder=dataset_folder)
+    dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=channels)
+    assert tuple(dataset.signals.columns) == channels
+    assert dataset.signal_units == ["uV", "uV", "uV", "%"]
+    pd.testing.assert_frame_equal(dataset.signals, full_dataset.signals[list(channels)])
+    assert dataset.events == full_dataset.events
+
+    # Cleaning/downsampling a channel subset must equal cleaning/downsampling everything & selecting afterwards
+    pre_cleaned = dataset.pre_clean().downsample(target_frequency=5)
+    full_pre_cleaned = full_dataset.pre_clean().downsample(target_frequency=5)
+    pd.testing.assert_frame_equal(pre_cleaned.signals, full_pre_cleaned.signals[list(channels)])
+    pd.testing.assert_frame_equal(full_dataset.pre_clean(channels=channels).signals, dataset.pre_clean().signals)
+    assert list(full_dataset.downsample(target_frequency=5, channels=["SaO2"]).signals.columns) == ["SaO2"]
+
+
+def test_read_dataset__digital(tmp_path):
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001")
+    for channels in (None, ["SaO2", "ABD"]):
+        expected = read_physionet_dataset(dataset_folder=dataset_folder, channels=channels, sampfrom=1000, sampto=50_000)
+        dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=channels, sampfrom=1000, sampto=50_000,
+                                         read_digital=True)
+        pd.testing.assert_frame_equal(dataset.signals, expected.signals)
+        assert dataset.signal_units == expected.signal_units and dataset.events == expected.events
+
+
+def test_read_dataset__digital_formats(tmp_path, monkeypatch):
+    # A wide-format channel only forces the physical (float64) path if it is actually read
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=60,
+                                        signal_formats={"ECG": "32"})
+    physical_flags = []
+    rdrecord = wfdb.rdrecord
+    monkeypatch.setattr(wfdb, "rdrecord", lambda *args, **kwargs: physical_flags.append(kwargs["physical"]) or rdrecord(*args, **kwargs))
+    for channels in (["SaO2", "ABD"], None):
+        expected = read_physionet_dataset(dataset_folder=dataset_folder, channels=channels)
+        dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=channels, read_digital=True)
+        pd.testing.assert_frame_equal(dataset.signals, expected.signals)
+    assert physical_flags == [True, False, True, True]
+
+    # Invalid samples become NaN, exactly as wfdb's physical values. Of our int16 formats, wfdb only writes these two
+    formats = ["16", "80"]
+    p_signal = np.tile(np.linspace(-1, 1, 100)[:, np.newaxis], (1, len(formats)))
+    p_signal[[3, 50], :] = np.nan
+    wfdb.wrsamp("tr00-0002", fs=10, units=["uV"] * len(formats), sig_name=[f"S{fmt}" for fmt in formats],
+                p_signal=p_signal, fmt=formats, adc_gain=[100.0] * len(formats), baseline=[0] * len(formats),
+                write_dir=str(tmp_path))
+    expected, _, _ = _read_wfdb_signals(record_path=tmp_path / "tr00-0002", channels=None, sampfrom=0, sampto=None)
+    signals, _, _ = _read_wfdb_signals(record_path=tmp_path / "tr00-0002", channels=None, sampfrom=0, sampto=None,
+                                       read_digital=True)
+    pd.testing.assert_frame_equal(signals, expected)
+    assert signals.isna().sum().tolist() == [2] * len(formats)
+
+
+def test_read_dataset_time_range(tmp_path):
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=600)
+    full_dataset = read_physionet_dataset(dataset_folder=dataset_folder)
+
+    for use_memmap_store in (False, True):
+        dataset = read_physionet_dataset_time_range(dataset_folder=dataset_folder, start=pd.Timedelta("00:02:00"),
+                                                    end=pd.Timedelta("00:04:00"), use_memmap_store=use_memmap_store)
+        expected_signals = full_dataset.signals[pd.Timedelta("00:02:00"):pd.Timedelta("00:04:00")].iloc[:-1]
+        pd.testing.assert_frame_equal(dataset.signals, expected_signals, check_freq=False)
+        assert all(pd.Timedelta("00:02:00") <= e.start <= pd.Timedelta("00:04:00") for e in dataset.events)
+        # The sleep stage that is active at 00:02:00 must be carried into the time range
+        assert dataset.sleep_stage_events[0].start == pd.Timedelta("00:02:00")
+        assert dataset.sleep_stage_events[0].sleep_stage_type == full_dataset.sleep_stage_events[0].sleep_stage_type
+
+
+def test_iterate_dataset_chunks(tmp_path):
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=600)
+    full_dataset = read_physionet_dataset(dataset_folder=dataset_folder, channels=["ABD", "SaO2"])
+
+    for use_memmap_store in (False, True):
+        chunks = list(iterate_physionet_dataset_chunks(dataset_folder=dataset_folder, chunk_duration=pd.Timedelta("70s"),
+                                                       chunk_overlap=pd.Timedelta("10s"), channels=["ABD", "SaO2"],
+                                                       use_memmap_store=use_memmap_store))
+        assert len(chunks) == 10
+        assert chunks[0].signals.index[0] == pd.Timedelta(0)
+        assert chunks[-1].signals.index[-1] == full_dataset.signals.index[-1]
+        for previous_chunk, chunk in zip(chunks[:-1], chunks[1:]):
+            assert previous_chunk.signals.index[-1] - chunk.signals.index[0] == pd.Timedelta("10s") - pd.Timedelta("5ms")
+        for chunk in chunks:
+            pd.testing.assert_frame_equal(chunk.signals, full_dataset.signals.loc[chunk.signals.index], check_freq=False)
+            for event in chunk.respiratory_events:
+                assert chunk.signals.index[0] <= event.start <= event.end <= chunk.signals.index[-1]
+                assert any(event.overlaps(e) for e in full_dataset.respiratory_events)
+
+
+def _write_test_record(dataset_folder: Path, duration_seconds: float = 600, sample_frequency_hz: float = 200,
+                       seed: int = 0, signal_formats: Optional[Dict[str, str]] = None) -> Path:
+    """
+    Writes a small synthetic record (signals & arousal annotations) in PhysioNet 2018 layout. Only used by unit tests,
+    so that they don't depend on the real PhysioNet files.
+
+    :param signal_formats: WFDB storage format per signal name. Signals that are not given are stored in format "16".
+    """
+    signal_names = ["F3-M2", "F4-M1", "C3-M2", "C4-M1", "O1-M2", "O2-M1", "E1-M2", "Chin1-Chin2", "ABD", "CHEST",
+                    "AIRFLOW", "SaO2", "ECG"]
+    signal_units = ["uV"] * 11 + ["%", "mV"]
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration_seconds * sample_frequency_hz)
+    t = np.arange(n_samples) / sample_frequency_hz
+    signals = np.empty(shape=(n_samples, len(signal_names)))
+    for i in range(len(signal_names)):
+        signals[:, i] = 50 * np.sin(2 * np.pi * (0.25 + 0.01 * i) * t) + rng.normal(0, 5, size=n_samples)
+    signals[:, signal_names.index("SaO2")] = 95 + rng.normal(0, 0.5, size=n_samples)
+
+    dataset_folder.mkdir(parents=True, exist_ok=True)
+    record_name = dataset_folder.name
+    wfdb.wrsamp(record_name, fs=sample_frequency_hz, units=signal_units, sig_name=signal_names, p_signal=signals,
+                fmt=[(signal_formats or {}).get(n, "16") for n in signal_names], adc_gain=[20.0] * len(signal_names), baseline=[0] * len(signal_names),
+                write_dir=str(dataset_folder))
+
+    samples, aux_notes = [], []
+    fs = int(sample_frequency_hz)
+    for i, start in enumerate(range(fs, n_samples, 120 * fs)):
+        samples += [start]
+        aux_notes += [("W", "N1", "N2", "N3", "R")[i % 5]]
+    event_names = ("resp_obstructiveapnea", "resp_centralapnea", "resp_hypopnea", "resp_mixedapnea")
+    for i, start in enumerate(range(60 * fs, n_samples - 30 * fs, 90 * fs)):
+        samples += [start, start + 15 * fs]
+        aux_notes += [f"({event_names[i % 4]}", f"{event_names[i % 4]})"]
+    order = np.argsort(samples, kind="stable")
+    wfdb.wrann(record_name, "arousal", sample=np.array(samples)[order], symbol=["\""] * len(samples),
+               aux_note=[aux_notes[i] for i in order], write_dir=str(dataset_folder))
+    return dataset_folder
@@ -0,0 +1,186 @@
+"""
+Rasterization of events onto the time grid of a signal, e.g. respiratory events into a ground truth vector or sleep
+stages into a wake mask. Event times are mapped onto the grid by binary search; vectors are filled run by run instead
+of sample by sample, so that the costs are linear in number of samples & events.
+"""
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@dataclass(frozen=True)
+class RunLengthVector:
+    """
+    Run-length encoded vector of 'length' samples: run i holds 'values[i]' from 'starts[i]' up to the next run's start.
+    The first run starts at 0.
+    """
+    starts: np.ndarray  # int64, strictly increasing
+    values: np.ndarray
+    length: int
+
+    @property
+    def run_lengths(self) -> np.ndarray:
+        return np.diff(np.append(self.starts, self.length))
+
+    def to_dense(self) -> np.ndarray:
+        return np.repeat(self.values, self.run_lengths)
+
+    def bincount(self, minlength: int = 0, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Histogram of the (non-negative integer) values within the sample range start..stop (exclusive)."""
+        stop = self.length if stop is None else stop
+        run_ends = np.append(self.starts[1:], self.length)
+        weights = np.clip(run_ends, start, stop) - np.clip(self.starts, start, stop)
+        return np.bincount(self.values, weights=weights, minlength=minlength).astype(np.int64)
+
+
+def _to_nanoseconds(times: Union[pd.TimedeltaIndex, np.ndarray]) -> np.ndarray:
+    return np.asarray(times, dtype="timedelta64[ns]").view(np.int64)
+
+
+def get_nearest_indexes(time_index: pd.TimedeltaIndex, times: Union[pd.TimedeltaIndex, np.ndarray]) -> np.ndarray:
+    """
+    Equivalent of time_index.get_indexer(times, method="nearest"). In case a time lies exactly between two grid
+    points, the later one is chosen (as pandas does). The time index must be sorted.
+    """
+    grid = _to_nanoseconds(time_index)
+    times = _to_nanoseconds(times)
+    right = np.searchsorted(grid, times, side="left")
+    left = right - 1
+    right_ = np.minimum(right, len(grid) - 1)
+    left_ = np.maximum(left, 0)
+    take_left = (right == len(grid)) | ((left >= 0) & (times - grid[left_] < grid[right_] - times))
+    return np.where(take_left, left_, right_)
+
+
+def get_exact_indexes(time_index: pd.TimedeltaIndex, times: Union[pd.TimedeltaIndex, np.ndarray]) -> np.ndarray:
+    """Vectorized equivalent of time_index.get_loc(t). All times must be present in the (sorted) time index."""
+    grid = _to_nanoseconds(time_index)
+    times = _to_nanoseconds(times)
+    indexes = np.searchsorted(grid, times, side="left")
+    is_present = (indexes < len(grid)) & (grid[np.minimum(indexes, len(grid) - 1)] == times)
+    if not np.all(is_present):
+        raise KeyError(pd.Timedelta(int(times[~is_present][0])))
+    return indexes
+
+
+def rasterize_intervals(length: int, starts: np.ndarray, ends: np.ndarray, values: np.ndarray, fill_value,
+                        dtype=None, run_length_encoded: bool = False) -> Union[np.ndarray, RunLengthVector]:
+    """
+    Paints intervals start..end (end exclusive, in samples) with their values onto a vector that is filled with
+    'fill_value' otherwise. Intervals are painted in the given order, i.e. later ones overwrite earlier ones where they
+    overlap.
+
+    :param length: Number of samples of the resulting vector.
+    :param starts: Start sample of each interval.
+    :param ends: End sample (exclusive) of each interval. Empty intervals are ignored.
+    :param values: Value of each interval.
+    :param fill_value: Value of all samples that are not covered by an interval.
+    :param dtype: Data type of the resulting values. If None, it is taken from 'values'.
+    :param run_length_encoded: If True, a RunLengthVector is returned instead of a dense array.
+    """
+    dtype = np.asarray(values).dtype if dtype is None else dtype
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, length)
+    values = np.asarray(values, dtype=dtype)
+    is_non_empty = starts < ends
+    starts, ends, values = starts[is_non_empty], ends[is_non_empty], values[is_non_empty]
+
+    order = np.argsort(starts, kind="stable")
+    if np.all(ends[order][:-1] <= starts[order][1:]):
+        # Usual case: no overlaps. Intervals & the gaps in between them make up the runs
+        starts, ends, values = starts[order], ends[order], values[order]
+        run_starts = np.empty(shape=(2 * len(starts) + 1,), dtype=np.int64)
+        run_starts[0], run_starts[1::2], run_starts[2::2] = 0, starts, ends
+        run_values = np.empty(shape=run_starts.shape, dtype=dtype)
+        run_values[0::2], run_values[1::2] = fill_value, values
+        is_non_empty_run = np.diff(np.append(run_starts, length)) > 0
+        rle = RunLengthVector(starts=run_starts[is_non_empty_run], values=run_values[is_non_empty_run], length=length)
+        return rle if run_length_encoded else rle.to_dense()
+
+    # Overlapping intervals need to be painted one after another. Costs are linear in the painted samples.
+    vector = np.full(shape=(length,), fill_value=fill_value, dtype=dtype)
+    for start, end, value in zip(starts.tolist(), ends.tolist(), values):
+        vector[start:end] = value
+    return run_length_encode(vector) if run_length_encoded else vector
+
+
+def rasterize_steps(length: int, positions: np.ndarray, values: np.ndarray, initial_value, dtype=None,
+                    run_length_encoded: bool = False) -> Union[np.ndarray, RunLengthVector]:
+    """
+    Builds a step function: each step holds its value from its position onwards, until a later step takes over (e.g.
+    the sleep stage that is active at each sample). Steps are applied in the given order, i.e. a step overrides all
+    earlier ones from its position onwards. Samples before the first step hold 'initial_value'.
+
+    :param length: Number of samples of the resulting vector.
+    :param positions: Sample position of each step.
+    :param values: Value of each step.
+    :param initial_value: Value of the samples before the first step.
+    :param dtype: Data type of the resulting values. If None, it is taken from 'values'.
+    :param run_length_encoded: If True, a RunLengthVector is returned instead of a dense array.
+    """
+    dtype = np.asarray(values).dtype if dtype is None else dtype
+    positions = np.clip(np.asarray(positions, dtype=np.int64), 0, length)
+    values = np.append(np.asarray(values, dtype=dtype), np.array([initial_value], dtype=dtype))
+    initial_step = len(values) - 1
+
+    # The step that is active at a position is the one that comes last in the given order, among all steps at or
+    # before the position. This is a running maximum over the steps' order numbers.
+    order = np.lexsort((np.arange(len(positions)), positions))
+    sorted_positions, sorted_steps = positions[order], order
+    is_last_at_position = np.ones(shape=sorted_positions.shape, dtype=bool)
+    is_last_at_position[:-1] = sorted_positions[1:] != sorted_positions[:-1]
+    sorted_positions, sorted_steps = sorted_positions[is_last_at_position], sorted_steps[is_last_at_position]
+    run_starts = np.append(0, sorted_positions)
+    run_steps = np.append(initial_step, np.maximum.accumulate(sorted_steps))
+
+    is_non_empty_run = np.diff(np.append(run_starts, length)) > 0
+    rle = RunLengthVector(starts=run_starts[is_non_empty_run], values=values[run_steps[is_non_empty_run]], length=length)
+    return rle if run_length_encoded else rle.to_dense()
+
+
+def run_length_encode(vector: np.ndarray) -> RunLengthVector:
+    """Run-length encodes a dense vector."""
+    if len(vector) == 0:
+        return RunLengthVector(starts=np.zeros(shape=(0,), dtype=np.int64), values=vector[:0], length=0)
+    run_starts = np.append(0, np.where(vector[1:] != vector[:-1])[0] + 1).astype(np.int64)
+    return RunLengthVector(starts=run_starts, values=vector[run_starts], length=len(vector))
+
+
+def test_get_nearest_indexes():
+    time_index = pd.timedelta_range(start="0s", periods=50, freq="200ms")
+    times = pd.to_timedelta(["-1s", "0s", "0.1s", "0.099s", "0.3s", "3.33s", "9.8s", "9.9s", "20s"])
+    expected = list(time_index.get_indexer(times, method="nearest"))
+    assert list(get_nearest_indexes(time_index, times)) == expected
+
+    assert list(get_exact_indexes(time_index, time_index[[1, 7]])) == [1, 7]
+    with pytest.raises(KeyError):
+        get_exact_indexes(time_index, times[[2]])
+
+
+def test_rasterize_intervals():
+    rng = np.random.default_rng(0)
+    for n_intervals, max_length in ((0, 10), (10, 5), (10, 60), (30, 200)):
+        starts = rng.integers(-5, 500, size=n_intervals)
+        ends = starts + rng.integers(0, max_length, size=n_intervals)
+        values = rng.integers(1, 5, size=n_intervals).astype(np.uint8)
+        expected = np.zeros(shape=(500,), dtype=np.uint8)
+        for start, end, value in zip(starts, ends, values):
+            expected[max(start, 0):max(end, 0)] = value
+        assert np.array_equal(rasterize_intervals(500, starts, ends, values, fill_value=0), expected)
+        rle = rasterize_intervals(500, starts, ends, values, fill_value=0, run_length_encoded=True)
+        assert np.array_equal(rle.to_dense(), expected)
+        assert np.array_equal(rle.bincount(minlength=5, start=20, stop=480), np.bincount(expected[20:480], minlength=5))
+
+
+def test_rasterize_steps():
+    for positions, values in (([], []), ([0, 10, 30], [1, 0, 1]), ([5, 40, 20, 40], [1, 2, 3, 4])):
+        expected = np.full(shape=(50,), fill_value=7, dtype=np.int8)
+        for position, value in zip(positions, values):
+            expected[position:] = value
+        assert np.array_equal(rasterize_steps(50, positions, np.array(values, dtype=np.int8), initial_value=7), expected)
+        rle = rasterize_steps(50, positions, np.array(values, dtype=np.int8), initial_value=7, run_length_encoded=True)
+        assert np.array_equal(rle.to_dense(), expected)
+        assert np.array_equal(run_length_encode(expected).to_dense(), expected)
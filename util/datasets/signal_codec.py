@@ -0,0 +1,179 @@
+"""
+Compact storage format for (pre-processed) signals: int16 with per-channel scale & offset, split into chunks along the
+time axis. Each chunk is delta-encoded & optionally compressed on its own, so that a range of samples (e.g. a single
+window) can be decoded without touching the rest.
+"""
+import lzma
+import zlib
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple, Union
+
+import numpy as np
+import pytest
+
+
+_QUANTIZED_MAX = np.iinfo(np.int16).max  # Quantized values span -_QUANTIZED_MAX.._QUANTIZED_MAX
+_QUANTIZED_NAN = np.iinfo(np.int16).min  # Reserved for NaN values
+
+_COMPRESSORS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+@dataclass(frozen=True)
+class QuantizedSignalCodec:
+    """
+    Encodes 2-D float signal arrays (samples x channels) into int16 values with per-channel scale & offset, i.e. each
+    channel's value range is mapped onto 65535 steps. Decoded values are float32 & deviate by at most half a step
+    (plus float32 rounding) from the original ones; this is checked during encoding. NaNs are preserved.
+
+    :param compression: None, "zlib" (fast) or "lzma" (smaller, but slower).
+    :param compression_level: zlib level or lzma preset.
+    :param chunk_size: Number of samples per chunk. Smaller chunks make random access cheaper, but compress worse.
+    """
+    compression: Optional[str] = "zlib"
+    compression_level: int = 1
+    chunk_size: int = 8192
+
+    def __post_init__(self):
+        assert self.compression is None or self.compression in _COMPRESSORS, \
+            f"Unknown compression '{self.compression}', choose one of {list(_COMPRESSORS)} or None"
+        assert self.chunk_size >= 1
+
+    def encode(self, signals: np.ndarray, verify: bool = False) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Encodes a 2-D float array (samples x channels).
+
+        :param verify: If True, the payload is decoded again & checked against the signals (quantization error, NaN
+                       positions); a ValueError is raised on mismatch. Doubles the costs, so it is meant for tests.
+
+        :return: The encoded bytes & a JSON-serializable meta dictionary, which is needed for decoding.
+        """
+        assert signals.ndim == 2, "Signals must be 2-D (samples x channels)"
+        is_nan = np.isnan(signals)
+        assert not np.any(np.isinf(signals)), "Signals must not contain inf values"
+        with np.errstate(all="ignore"):
+            minimums = np.where(np.all(is_nan, axis=0), 0, np.nanmin(np.where(is_nan, np.inf, signals), axis=0))
+            maximums = np.where(np.all(is_nan, axis=0), 0, np.nanmax(np.where(is_nan, -np.inf, signals), axis=0))
+        offsets = (maximums.astype(np.float64) + minimums) / 2
+        scales = np.maximum((maximums.astype(np.float64) - minimums) / (2 * _QUANTIZED_MAX), np.finfo(np.float32).tiny)
+
+        quantized = np.rint((signals - offsets) / scales)
+        quantized = np.clip(np.where(is_nan, 0, quantized), -_QUANTIZED_MAX, _QUANTIZED_MAX).astype(np.int16)
+        quantized[is_nan] = _QUANTIZED_NAN
+
+        chunks, chunk_checksums = [], []
+        for start in range(0, len(quantized), self.chunk_size):
+            chunk = _delta_encode(quantized[start:start + self.chunk_size]).tobytes()
+            if self.compression is not None:
+                chunk = _COMPRESSORS[self.compression][0](chunk, self.compression_level)
+            chunks += [chunk]
+            chunk_checksums += [zlib.crc32(chunk)]
+        meta = {
+            "codec": asdict(self),
+            "shape": list(signals.shape),
+            "offsets": offsets.tolist(),
+            "scales": scales.tolist(),
+            "chunk_offsets": np.cumsum([0] + [len(c) for c in chunks]).tolist(),
+            "chunk_checksums": chunk_checksums,
+        }
+        payload = b"".join(chunks)
+
+        if verify:
+            decoded = decode_signals(payload, meta=meta)
+            max_abs_errors = np.nanmax(np.abs(np.where(is_nan, 0, decoded.astype(np.float64) - signals)), axis=0, initial=0)
+            tolerances = scales / 2 + np.max(np.abs([minimums, maximums]), axis=0) * np.finfo(np.float32).eps
+            if not np.all(max_abs_errors <= tolerances * 1.001):
+                raise ValueError(f"Quantization error ({max_abs_errors}) exceeds the expected one ({tolerances})")
+            if not np.array_equal(np.isnan(decoded), is_nan):
+                raise ValueError("NaN values did not survive encoding")
+        return payload, meta
+
+    def roundtrip(self, signals: np.ndarray) -> np.ndarray:
+        """Returns the signals as they come out after encoding & decoding."""
+        payload, meta = self.encode(signals)
+        return decode_signals(payload, meta=meta)
+
+
+def decode_signals(source: Union[bytes, Path], meta: Dict[str, Any], start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+    """
+    Decodes the samples start..stop (exclusive) of encoded signals. Only the chunks that overlap this range are read &
+    decompressed.
+
+    :param source: The encoded bytes, or a file that holds them. Of a file, only the necessary bytes are read.
+    :param meta: Meta dictionary, as returned by QuantizedSignalCodec.encode(...)
+    :return: float32 array (samples x channels)
+    """
+    n_samples, n_channels = meta["shape"]
+    stop = n_samples if stop is None else min(stop, n_samples)
+    start = max(0, start)
+    codec = meta["codec"]
+    chunk_size, chunk_offsets = codec["chunk_size"], meta["chunk_offsets"]
+    if stop <= start:
+        return np.empty(shape=(0, n_channels), dtype=np.float32)
+    first_chunk, last_chunk = start // chunk_size, (stop - 1) // chunk_size
+
+    if isinstance(source, Path):
+        with open(source, mode="rb") as file:
+            file.seek(chunk_offsets[first_chunk])
+            data = file.read(chunk_offsets[last_chunk + 1] - chunk_offsets[first_chunk])
+        base_offset = chunk_offsets[first_chunk]
+    else:
+        data, base_offset = source, 0
+
+    quantized = np.empty(shape=((last_chunk - first_chunk + 1) * chunk_size, n_channels), dtype=np.int16)
+    n_decoded = 0
+    for chunk_index in range(first_chunk, last_chunk + 1):
+        chunk = data[chunk_offsets[chunk_index] - base_offset:chunk_offsets[chunk_index + 1] - base_offset]
+        if zlib.crc32(chunk) != meta["chunk_checksums"][chunk_index]:
+            raise ValueError(f"Chunk {chunk_index} of the encoded signals is corrupt")
+        if codec["compression"] is not None:
+            chunk = _COMPRESSORS[codec["compression"]][1](chunk)
+        chunk_values = _delta_decode(np.frombuffer(chunk, dtype=np.int16).reshape(-1, n_channels))
+        quantized[n_decoded:n_decoded + len(chunk_values)] = chunk_values
+        n_decoded += len(chunk_values)
+    first_sample_ = first_chunk * chunk_size
+    quantized = quantized[start - first_sample_:stop - first_sample_]
+
+    signals = (quantized * np.array(meta["scales"]) + np.array(meta["offsets"])).astype(np.float32)
+    signals[quantized == _QUANTIZED_NAN] = np.nan
+    return signals
+
+
+def _delta_encode(quantized: np.ndarray) -> np.ndarray:
+    """Differences along time (int16 wrap-around), which makes slowly changing signals well compressible."""
+    deltas = quantized.copy()
+    deltas[1:] -= quantized[:-1]
+    return deltas
+
+
+def _delta_decode(deltas: np.ndarray) -> np.ndarray:
+    return np.cumsum(deltas, axis=0, dtype=np.int16)
+
+
+def test_quantized_signal_codec():
+    rng = np.random.default_rng(0)
+    signals = np.cumsum(rng.normal(size=(20_000, 4)), axis=0).astype(np.float32)
+    signals[:, 2] = 95.5  # Constant channel
+    signals[100:150, 1] = np.nan
+
+    for codec in (QuantizedSignalCodec(compression=None), QuantizedSignalCodec(chunk_size=1000),
+                  QuantizedSignalCodec(compression="lzma", chunk_size=3333)):
+        payload, meta = codec.encode(signals, verify=True)
+        decoded = decode_signals(payload, meta=meta)
+        assert decoded.dtype == np.float32 and decoded.shape == signals.shape
+        assert np.array_equal(np.isnan(decoded), np.isnan(signals))
+        value_ranges = np.nanmax(signals, axis=0) - np.nanmin(signals, axis=0)
+        assert np.all(np.nanmax(np.abs(decoded - signals), axis=0) <= value_ranges / 65534 + 1e-4)
+        assert np.array_equal(codec.roundtrip(signals), decoded, equal_nan=True)
+
+        # Random access, e.g. for single windows
+        for start, stop in ((0, 1), (999, 1001), (5000, 5601), (19_990, 25_000)):
+            assert np.array_equal(decode_signals(payload, meta=meta, start=start, stop=stop), decoded[start:stop], equal_nan=True)
+
+    with pytest.raises(ValueError):
+        corrupt_payload = bytearray(payload)
+        corrupt_payload[10] ^= 0xFF
+        decode_signals(bytes(corrupt_payload), meta=meta)
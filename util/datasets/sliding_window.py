@@ -3,16 +3,23 @@ import math
 from dataclasses import dataclass, fields
 from typing import Optional, Tuple, List, NamedTuple, Union, Iterable, Dict
 from pathlib import Path
-import pickle
-from enum import Enum
+from enum import Enum, IntFlag
 import functools
-from collections import Counter
 import logging
 
 import pandas as pd
 import numpy as np
+import pytest
+import scipy.ndimage
 
-from .physionet import read_physionet_dataset, RespiratoryEventType, RespiratoryEvent, SleepStageType
+from util.mathutil import get_rolling_robust_scales, PeakArrays
+from .physionet import read_physionet_dataset, RespiratoryEventType, RespiratoryEvent, SleepStageType, EventTable, \
+    EventKind, PhysioNetDataset
+from .rasterization import get_nearest_indexes, get_exact_indexes, rasterize_intervals, rasterize_steps, _to_nanoseconds
+from .dataset_cache import DatasetCache, CACHE_FOLDER_NAME, make_cache_key, fingerprint_files, \
+    physionet_dataset_to_cache_entry, physionet_dataset_from_cache_entry
+from .signal_codec import QuantizedSignalCodec
+from .peak_index import PeakIndex, LowpassPrefilter, detect_peak_arrays
 
 
 class GroundTruthClass(Enum):
@@ -23,6 +30,12 @@ class GroundTruthClass(Enum):
     Hypopnea = 4
 
 
+class SignalMask(IntFlag):
+    """Flags of signal positions that windows, the inference or the detector may skip."""
+    Artifact = 1  # Disconnected sensor or flat-line, in at least one of the _FLAT_LINE_SIGNAL_NAMES (or NaN/inf)
+    Wake = 2  # Wake stage, as per sleep stage annotations
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -34,9 +47,269 @@ RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS = {RespiratoryEventType.CentralApnea:
 assert len(RespiratoryEventType) == len(GroundTruthClass)-1, \
     f"There seems at least one class to be missing in either of the types {RespiratoryEventType.__name__} or {GroundTruthClass.__name__}"
 
+# Same translation, as lookup table:   RespiratoryEventType.value -> GroundTruthClass.value
+_GROUND_TRUTH_VALUE_BY_TYPE_CODE = np.zeros(shape=(max(t.value for t in RespiratoryEventType) + 1,), dtype=np.uint8)
+for _event_type, _gt_class in RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS.items():
+    _GROUND_TRUTH_VALUE_BY_TYPE_CODE[_event_type.value] = _gt_class.value
+
+
+# Signals that we make use of. All other channels of a PhysioNet dataset are not even read from disk
+_SIGNAL_NAMES = ("ABD", "CHEST", "AIRFLOW", "SaO2")
+
+# Version of our pre-processing. Increment it whenever a code change alters the pre-processed data, so that existing
+# cache entries are not used any more.
+_CACHE_CODE_VERSION = 2
+
+# Flat-line detection of the signal mask. A signal counts as flat wherever its value range stays within a tolerance
+# (relative to its inter-quartile range) for at least the given duration.
+_FLAT_LINE_SIGNAL_NAMES = ("ABD", "CHEST", "AIRFLOW")
+_FLAT_LINE_MIN_DURATION = pd.Timedelta("30s")
+_FLAT_LINE_RELATIVE_TOLERANCE = 1e-3
+
 
 WindowData = NamedTuple("WindowData", signals=pd.DataFrame, center_point=pd.Timedelta, ground_truth=Optional[pd.Series])
 
+# Array-native counterpart of WindowData. 'features' is a (C, W) view into the signals matrix, its rows ordered as
+# SlidingWindowDataset.signal_names; 'ground_truth' is a uint8 view holding GroundTruthClass values.
+WindowArrays = NamedTuple("WindowArrays", features=np.ndarray, center_point_index=int, ground_truth=Optional[np.ndarray])
+
+_StageCaches = NamedTuple("_StageCaches", cleaned=DatasetCache, downsampled=DatasetCache)
+
+
+class SlidingWindowRecord:
+    """
+    Pre-processed (downsampled) signals & labels of a single PhysioNet record. The record is independent of any window
+    geometry, so that several SlidingWindowDatasets with different window sizes, strides & GT vector widths can share
+    it without copying its data.
+    """
+    def __init__(self, dataset_folder: Path, downsample_frequency_hz: float, allow_caching: bool = True,
+                 cache_folder: Optional[Path] = None, signal_codec: Optional[QuantizedSignalCodec] = None):
+        """
+        :param dataset_folder: Folder of the PhysioNet dataset that we wish to load
+        :param downsample_frequency_hz: Frequency that the signals are downsampled to
+        :param allow_caching: If True, the pre-processed dataset is loaded from/stored to the cache.
+        :param cache_folder: Folder that holds the cache entries. If None, a sub-folder of the dataset folder is used.
+        :param signal_codec: If given, cached signals are stored in this (compact, but lossy) format instead of float32.
+                             The signals then equal their decoded counterparts, also when an entry is built.
+        """
+        if allow_caching is False:
+            assert cache_folder is None and signal_codec is None, "Illegal parameter combination!"
+        assert dataset_folder.exists() and dataset_folder.is_dir(), \
+            f"Given dataset folder '{dataset_folder.resolve()}' either not exists or is no folder."
+        self.dataset_folder: Path = dataset_folder
+        self.dataset_name: str = dataset_folder.name
+        self.downsample_frequency_hz = downsample_frequency_hz
+        self.signal_codec = signal_codec
+
+        # With caching, each pre-processing stage (cleaned -> downsampled) is cached on its own, keyed by the parameters
+        # it depends on. This way, e.g. a new downsample frequency reuses the cleaned signals.
+        stage_caches: Optional[_StageCaches] = None
+        if allow_caching:
+            if cache_folder is None:
+                cache_folder = self.dataset_folder.resolve() / CACHE_FOLDER_NAME
+            array_codecs = None if signal_codec is None else {"signals": signal_codec}
+            stage_caches = _StageCaches(cleaned=DatasetCache(cache_folder=cache_folder / "cleaned", max_entries=2,
+                                                             array_codecs=array_codecs),
+                                        downsampled=DatasetCache(cache_folder=cache_folder / "downsampled",
+                                                                 array_codecs=array_codecs))
+        # Peaks of our signals, detected once per signal & filter configuration. None, if caching is not allowed.
+        self.peak_index: Optional[PeakIndex] = None if cache_folder is None else PeakIndex(cache_folder=cache_folder / "peaks")
+
+        # Load the PhysioNet dataset from disk and apply some pre-processing
+        try:
+            if stage_caches is None:
+                ds = read_physionet_dataset(dataset_folder=dataset_folder, channels=_SIGNAL_NAMES, read_digital=True)
+                ds = ds.preprocess(target_frequency=downsample_frequency_hz)
+                ground_truth = None
+                if ds.event_table is not None:
+                    ground_truth = self._generate_ground_truth_vector(signals_time_index=ds.signals.index,
+                                                                      event_table=ds.event_table)
+                signal_mask = self._generate_signal_mask(signals=ds.signals, event_table=ds.event_table)
+            else:
+                ds, ground_truth, signal_mask = self._load_downsampled_dataset(stage_caches=stage_caches)
+            self._set_signals(ds.signals[list(_SIGNAL_NAMES)])
+            self.event_table: Optional[EventTable] = ds.event_table
+            self.respiratory_events = ds.respiratory_events
+            self.sleep_stage_events = ds.sleep_stage_events
+            del ds
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            raise RuntimeError(f"Error parsing/preprocessing PhysioNet dataset '{dataset_folder.name}'") from e
+
+        # GroundTruthClass value of each signal position (untrimmed). None, if there are no event annotations.
+        self._ground_truth_codes: Optional[np.ndarray] = ground_truth
+        # SignalMask flags of each signal position. Determined on the pre-processed signals, i.e. later changes of our
+        # signals (see set_signal) do not alter it.
+        self._signal_mask_codes: np.ndarray = signal_mask
+
+    def _set_signals(self, signals: pd.DataFrame):
+        """
+        Stores the signals as (C, N) float32 matrix, so that windows can be taken as views. The 'signals' DataFrame
+        shares its memory with that matrix.
+        """
+        self.signal_names: Tuple[str, ...] = tuple(signals.columns)
+        self._signals_mat: np.ndarray = np.ascontiguousarray(signals.values.T, dtype=np.float32)
+        if not self._signals_mat.flags.writeable:  # E.g. a copy-on-write view of the given DataFrame
+            self._signals_mat = self._signals_mat.copy()
+        self.signals = pd.DataFrame(data=self._signals_mat.T, index=signals.index, columns=signals.columns, copy=False)
+        self._update_non_finite_counts()
+        # Per-window statistics of our signals, keyed by (signal name, statistic, window geometry). They are computed
+        # on demand by the datasets that share this record, see SlidingWindowDataset.get_robust_scales()
+        self._window_statistics: Dict[tuple, np.ndarray] = {}
+
+    def set_signal(self, signal_name: str, values: np.ndarray):
+        """
+        Overwrites the values of one of our signals. Use this instead of assigning columns of 'signals', as the latter
+        is not reflected by get_window_arrays(). Note that all datasets sharing this record see the change.
+        """
+        assert signal_name in self.signal_names, f"Signal '{signal_name}' is not part of the dataset!"
+        assert len(values) == self._signals_mat.shape[1]
+        channel = self.signal_names.index(signal_name)
+        self._signals_mat[channel, :] = values
+        if not np.shares_memory(self.signals[signal_name].values, self._signals_mat):
+            self.signals[signal_name] = self._signals_mat[channel]
+        self._update_non_finite_counts()
+        self._window_statistics = {k: v for k, v in self._window_statistics.items() if k[0] != signal_name}
+
+    def _update_non_finite_counts(self):
+        """
+        Counts the signal positions holding NaN/inf values, cumulated over time. This way, windows can be checked
+        in O(1). If all values are finite (which is the usual case), no counts are kept at all.
+        """
+        is_non_finite = ~np.isfinite(self._signals_mat).all(axis=0)
+        self._n_non_finite_until: Optional[np.ndarray] = None
+        if np.any(is_non_finite):
+            self._n_non_finite_until = np.concatenate([[0], np.cumsum(is_non_finite)])
+
+    def __getstate__(self):
+        # Our signals DataFrame is a view on the signals matrix. In order to not double its memory when pickling (e.g.
+        # when passing records between processes), only the matrix is stored.
+        state = self.__dict__.copy()
+        state["signals"] = (self.signals.index, self.signals.columns)
+        return state
+
+    def __setstate__(self, state):
+        index, columns = state["signals"]
+        self.__dict__.update(state)
+        self.signals = pd.DataFrame(data=self._signals_mat.T, index=index, columns=columns, copy=False)
+
+    def has_ground_truth(self):
+        return self.respiratory_events is not None
+
+    @functools.cached_property
+    def awake_series(self) -> Optional[pd.Series]:
+        """
+        Returns an "awake" series, in case we have event annotations available. Otherwise, the result is None.
+
+        @return: Awake vector (1=awake, 0=asleep) as Series. The Series index corresponds to our signals index. None
+                 if there are no event annotations available.
+        """
+        if self.event_table is None:
+            return None
+        is_awake_mat = self._generate_awake_vector(signals_time_index=self.signals.index, event_table=self.event_table)
+        is_awake_series = pd.Series(data=is_awake_mat, index=self.signals.index, name="Is awake (ref. sleep stages)")
+        return is_awake_series
+
+    def get_signal_mask(self, flags: SignalMask = SignalMask.Artifact | SignalMask.Wake) -> np.ndarray:
+        """Boolean vector of our signal positions, True where any of the given SignalMask flags applies."""
+        return (self._signal_mask_codes & flags) != 0
+
+    def get_peak_arrays(self, signal_names: Iterable[str], filter_kernel_width: int,
+                        prefilter: Optional[LowpassPrefilter] = None, parallel: bool = False) -> List[PeakArrays]:
+        """
+        Peaks of some of our signals, see detect_peak_arrays(). They are taken from our peak index, wherever possible.
+        """
+        signal_names = list(signal_names)
+        assert all(n in self.signal_names for n in signal_names), f"At least one of {signal_names} is not part of the dataset!"
+        waveforms = [self._signals_mat[self.signal_names.index(n)] for n in signal_names]
+        if self.peak_index is None:
+            return detect_peak_arrays(waveforms, filter_kernel_width=filter_kernel_width, prefilter=prefilter, parallel=parallel)
+        return self.peak_index.get_peak_arrays(signal_names=signal_names, waveforms=waveforms,
+                                               filter_kernel_width=filter_kernel_width, prefilter=prefilter, parallel=parallel)
+
+    @staticmethod
+    def _generate_awake_vector(signals_time_index: pd.TimedeltaIndex, event_table: EventTable) -> np.ndarray:
+        sleep_stages = event_table.of_kind(EventKind.SleepStage)
+        start_indexes = get_exact_indexes(time_index=signals_time_index, times=sleep_stages.start_times)
+        is_awake = sleep_stages.type_mask(SleepStageType.Wakefulness).astype("int8")
+        return rasterize_steps(length=len(signals_time_index), positions=start_indexes, values=is_awake, initial_value=0)
+
+    @staticmethod
+    def _generate_signal_mask(signals: pd.DataFrame, event_table: Optional[EventTable]) -> np.ndarray:
+        """
+        Determines the SignalMask flags of all signal positions in one vectorized pass: wake stages (if there are
+        annotations) & artifacts. The latter are flat-lines (e.g. disconnected sensors, which pre-cleaning filters
+        down to ~0) & non-finite values.
+        """
+        mask = np.zeros(shape=(len(signals),), dtype=np.uint8)
+        if event_table is not None:
+            is_awake = SlidingWindowRecord._generate_awake_vector(signals_time_index=signals.index, event_table=event_table)
+            mask[is_awake != 0] |= np.uint8(SignalMask.Wake)
+
+        signals_mat = signals[[n for n in _FLAT_LINE_SIGNAL_NAMES if n in signals]].to_numpy(dtype=np.float64).T
+        is_non_finite = ~np.isfinite(signals_mat)
+        signals_mat = np.where(is_non_finite, 0, signals_mat)
+        flat_line_length = int(_FLAT_LINE_MIN_DURATION / signals.index.freq)
+        if 1 < flat_line_length <= len(signals) and len(signals_mat) != 0:
+            # Value range of the window centered at each position. Flat windows are then dilated to their full length.
+            value_ranges = scipy.ndimage.maximum_filter1d(signals_mat, size=flat_line_length, axis=1, mode="nearest") - \
+                scipy.ndimage.minimum_filter1d(signals_mat, size=flat_line_length, axis=1, mode="nearest")
+            quartiles = np.percentile(signals_mat, q=(75, 25), axis=1)
+            tolerances = (quartiles[0] - quartiles[1]) * _FLAT_LINE_RELATIVE_TOLERANCE
+            is_flat_window = np.any(value_ranges <= tolerances[:, np.newaxis], axis=0)
+            is_flat_window[:flat_line_length // 2] = False  # Windows that exceed our signals are not considered
+            is_flat_window[len(signals) - (flat_line_length - 1 - flat_line_length // 2):] = False
+            # Windows of even size reach one position further left than right; mirror that when dilating
+            is_flat = scipy.ndimage.maximum_filter1d(is_flat_window, size=flat_line_length, mode="constant", cval=False,
+                                                     origin=-1 if flat_line_length % 2 == 0 else 0)
+            mask[is_flat] |= np.uint8(SignalMask.Artifact)
+        mask[np.any(is_non_finite, axis=0)] |= np.uint8(SignalMask.Artifact)
+        return mask
+
+    @staticmethod
+    def _generate_ground_truth_vector(signals_time_index: pd.TimedeltaIndex, event_table: EventTable) -> np.ndarray:
+        respiratory_events = event_table.of_kind(EventKind.Respiratory)
+        start_indexes = get_nearest_indexes(time_index=signals_time_index, times=respiratory_events.start_times)
+        end_indexes = get_nearest_indexes(time_index=signals_time_index, times=respiratory_events.end_times)
+        return rasterize_intervals(length=len(signals_time_index), starts=start_indexes, ends=end_indexes,
+                                   values=_GROUND_TRUTH_VALUE_BY_TYPE_CODE[respiratory_events.type_codes],
+                                   fill_value=GroundTruthClass.NoEvent.value, dtype=np.uint8)
+
+    def _get_stage_cache_keys(self) -> Dict[str, str]:
+        """Each pre-processing stage is keyed by its predecessor's key & the parameters that the stage depends on."""
+        source_files = list(self.dataset_folder.glob(f"{self.dataset_folder.name}.*"))
+        cleaned_key = make_cache_key("cleaned", _SIGNAL_NAMES, fingerprint_files(source_files), _CACHE_CODE_VERSION,
+                                     self.signal_codec)
+        downsampled_key = make_cache_key("downsampled", cleaned_key, self.downsample_frequency_hz, _FLAT_LINE_SIGNAL_NAMES,
+                                         _FLAT_LINE_MIN_DURATION, _FLAT_LINE_RELATIVE_TOLERANCE)
+        return {"cleaned": cleaned_key, "downsampled": downsampled_key}
+
+    def _load_downsampled_dataset(self, stage_caches: _StageCaches) -> Tuple[PhysioNetDataset, Optional[np.ndarray], np.ndarray]:
+        """
+        Returns the downsampled dataset, its ground truth vector (None, if there are no annotations) & its signal mask
+        codes. Takes them (or the cleaned predecessor) from the cache, wherever possible. In case several processes need
+        the same stage at once, only one of them builds it.
+        """
+        keys = self._get_stage_cache_keys()
+
+        def _build_cleaned_entry():
+            ds = read_physionet_dataset(dataset_folder=self.dataset_folder, channels=_SIGNAL_NAMES, read_digital=True)
+            return physionet_dataset_to_cache_entry(ds.pre_clean())
+
+        def _build_downsampled_entry():
+            cleaned_entry = stage_caches.cleaned.get_or_build(key=keys["cleaned"], build_fn=_build_cleaned_entry)
+            downsampled_ds = physionet_dataset_from_cache_entry(*cleaned_entry).downsample(target_frequency=self.downsample_frequency_hz)
+            arrays, meta = physionet_dataset_to_cache_entry(downsampled_ds)
+            if downsampled_ds.event_table is not None:
+                arrays["ground_truth"] = self._generate_ground_truth_vector(signals_time_index=downsampled_ds.signals.index,
+                                                                            event_table=downsampled_ds.event_table)
+            arrays["signal_mask"] = self._generate_signal_mask(signals=downsampled_ds.signals, event_table=downsampled_ds.event_table)
+            return arrays, meta
+
+        arrays, meta = stage_caches.downsampled.get_or_build(key=keys["downsampled"], build_fn=_build_downsampled_entry)
+        return physionet_dataset_from_cache_entry(arrays, meta), arrays.get("ground_truth"), arrays["signal_mask"]
+
 
 class SlidingWindowDataset:
     """
@@ -46,6 +319,9 @@ class SlidingWindowDataset:
     - Piecewise (window-based) retrieval of dataset data. Reference hereby is the center point of to-be retrieved window
     - Generation of ground truth vector. When retrieving a window, the ground truth class is delivered alongside,
       referring to the center point.
+
+    Signals & labels are held by a SlidingWindowRecord, which several datasets of different window geometries can
+    share (see with_config()).
     """
     @dataclass
     class Config:
@@ -87,169 +363,253 @@ class SlidingWindowDataset:
                 "When passing 'ground_truth_vector_width' as int, it must be a positive odd integer!"
             self.ground_truth_vector_width__index_steps = gt_index_steps_
 
-    def __init__(self, config: Config, dataset_folder: Optional[Path], allow_caching: bool = True, cached_dataset_file: Optional[Path] = None):
+    def __init__(self, config: Config, dataset_folder: Optional[Path] = None, allow_caching: bool = True,
+                 cache_folder: Optional[Path] = None, record: Optional[SlidingWindowRecord] = None,
+                 signal_codec: Optional[QuantizedSignalCodec] = None):
+        """
+        :param config: Config of this dataset
+        :param dataset_folder: Folder of the PhysioNet dataset that we wish to load. Must be None if 'record' is given.
+        :param allow_caching: If True, the pre-processed dataset is loaded from/stored to the cache.
+        :param cache_folder: Folder that holds the cache entries. If None, a sub-folder of the dataset folder is used.
+        :param record: Already loaded record that this dataset shall provide windows of. Its downsample frequency must
+                       match the config. The record is shared, not copied.
+        :param signal_codec: Storage format of the cached signals, see SlidingWindowRecord.
+        """
         self.config = config
 
-        if allow_caching is False:
-            assert cached_dataset_file is None, "Illegal parameter combination!"
-
-        # Handle our path parameter logic
-        assert dataset_folder is not None or cached_dataset_file is not None, \
-            "At least one of both parameters 'dataset_folder' and 'cached_dataset_file' must contain a value!"
-        self.dataset_folder: Optional[Path] = dataset_folder
-        self.dataset_name: str = \
-            dataset_folder.name if dataset_folder is not None else f"{cached_dataset_file.parent.name}/{cached_dataset_file.stem}"
-        if cached_dataset_file is None:
-            cached_dataset_file = self.dataset_folder.resolve() / "preprocessed.pkl"
-
-        # Let's see if there is a cached version that we can load
-        if allow_caching:
-            success = self._try_read_cached_dataset(cached_dataset_file=cached_dataset_file)
-            if success:
-                logging.debug(f"{dataset_folder.name}: Using pre-cached dataset")
-                return
+        if record is None:
+            assert dataset_folder is not None, "Either 'dataset_folder' or 'record' must be given!"
+            record = SlidingWindowRecord(dataset_folder=dataset_folder,
+                                         downsample_frequency_hz=config.downsample_frequency_hz,
+                                         allow_caching=allow_caching, cache_folder=cache_folder,
+                                         signal_codec=signal_codec)
+        else:
+            assert dataset_folder is None and cache_folder is None and signal_codec is None, "Illegal parameter combination!"
+            assert record.downsample_frequency_hz == config.downsample_frequency_hz, \
+                f"Record '{record.dataset_name}' is downsampled to {record.downsample_frequency_hz} Hz, whereas the " \
+                f"config demands {config.downsample_frequency_hz} Hz!"
+        self.record: SlidingWindowRecord = record
 
-        assert dataset_folder is not None, \
-            "Since loading cached dataset file failed, we have to load from a dataset folder. But there is None!"
-        assert dataset_folder.exists() and dataset_folder.is_dir(), \
-            f"Given dataset folder '{dataset_folder.resolve()}' either not exists or is no folder."
+        # Some examinations & meta data
+        self._determine_center_points()
 
-        # Load the PhysioNet dataset from disk and apply some pre-processing
-        try:
-            ds = read_physionet_dataset(dataset_folder=dataset_folder)
-            ds = ds.pre_clean().downsample(target_frequency=config.downsample_frequency_hz)
-            self.signals = ds.signals[["ABD", "CHEST", "AIRFLOW", "SaO2"]].astype(np.float32)
-            self.respiratory_events = ds.respiratory_events
-            self.sleep_stage_events = ds.sleep_stage_events
-            del ds
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except BaseException as e:
-            raise RuntimeError(f"Error parsing/preprocessing PhysioNet dataset '{dataset_folder.name}'") from e
+    def with_config(self, config: Config) -> "SlidingWindowDataset":
+        """Returns a dataset with another window geometry, which shares our record (signals & labels)."""
+        return SlidingWindowDataset(config=config, record=self.record)
 
-        # Some examinations
-        assert self.signals.index[0] <= config.time_window_size < self.signals.index[-1], \
-            f"Chosen time_window_size '{config.time_window_size}' is too large for the given PhysioNet dataset!"
+    @property
+    def dataset_folder(self) -> Path:
+        return self.record.dataset_folder
 
-        # Determine some meta data
-        dist_ = int(max(self.config.time_window_size__index_steps/2, self.config.ground_truth_vector_width__index_steps/2))
-        dist_ = max(2, dist_)  # Must be at least 2 to produce reasonable values
-        self._valid_center_points: pd.TimedeltaIndex = self.signals.index[dist_:-dist_:self.config.time_window_stride__index_steps]
-        self._idx__signal_int_index: List[int] = list(range(len(self.signals))[dist_:-dist_:self.config.time_window_stride__index_steps])
-        assert len(self._valid_center_points) == len(self._idx__signal_int_index)
-
-        # In case there are respiratory event annotations, generate our GroundTruth vector
-        self.ground_truth_series: Optional[pd.Series] = None
-        if self.respiratory_events is not None:
-            gt_series = self._generate_ground_truth_series(signals_time_index=self.signals.index, respiratory_events=self.respiratory_events)
-            assert len(gt_series) == len(self.signals)
-            # Erase beginning/ending of our gt vector, length depending on our time-window-size & gt-vector-width
-            edge_cut_indexes_lr = dist_ - int(self.config.ground_truth_vector_width__index_steps/2) - 1
-            gt_series[:edge_cut_indexes_lr + 1] = np.nan
-            gt_series[-edge_cut_indexes_lr:] = np.nan
-            self.ground_truth_series = gt_series
-
-        # Serialize preprocessed dataset to disk
-        if allow_caching:
-            with open(file=cached_dataset_file, mode="wb") as file:
-                pickle.dump(obj=self, file=file)
+    @property
+    def dataset_name(self) -> str:
+        return self.record.dataset_name
 
-    @functools.cached_property
+    @property
+    def signals(self) -> pd.DataFrame:
+        return self.record.signals
+
+    @property
+    def signal_names(self) -> Tuple[str, ...]:
+        return self.record.signal_names
+
+    @property
+    def event_table(self) -> Optional[EventTable]:
+        return self.record.event_table
+
+    @property
+    def respiratory_events(self) -> Optional[List[RespiratoryEvent]]:
+        return self.record.respiratory_events
+
+    @property
+    def sleep_stage_events(self):
+        return self.record.sleep_stage_events
+
+    @property
     def awake_series(self) -> Optional[pd.Series]:
+        return self.record.awake_series
+
+    def get_signal_mask(self, flags: SignalMask = SignalMask.Artifact | SignalMask.Wake) -> np.ndarray:
+        return self.record.get_signal_mask(flags=flags)
+
+    @property
+    def peak_index(self) -> Optional[PeakIndex]:
+        return self.record.peak_index
+
+    def get_peak_arrays(self, signal_names: Iterable[str], filter_kernel_width: int,
+                        prefilter: Optional[LowpassPrefilter] = None, parallel: bool = False) -> List[PeakArrays]:
+        return self.record.get_peak_arrays(signal_names=signal_names, filter_kernel_width=filter_kernel_width,
+                                           prefilter=prefilter, parallel=parallel)
+
+    def get_robust_scales(self, signal_name: str) -> np.ndarray:
         """
-        Returns an "awake" series, in case we have event annotations available. Otherwise, the result is None.
+        Per window index: the divisor that normalize_robust(features, center=False, scale=True) applies to the window's
+        values of the given signal. Dividing the window (as float64) by it & casting to float32 gives exactly the
+        normalized window. All windows are computed at once via a rolling kernel; the result is kept by our record
+        until the signal gets overwritten.
+        """
+        center_points_ = self._idx__signal_int_index
+        key_ = (signal_name, "robust_scales", self.config.time_window_size__index_steps, center_points_.start,
+                center_points_.stop, center_points_.step)
+        scales = self.record._window_statistics.get(key_)
+        if scales is None:
+            window_starts = np.asarray(center_points_) - int(self.config.time_window_size__index_steps/2)
+            scales = get_rolling_robust_scales(self.record._signals_mat[self.signal_names.index(signal_name)],
+                                               window_starts, self.config.time_window_size__index_steps)
+            self.record._window_statistics[key_] = scales
+        return scales
+
+    def get_window_mask(self, flags: SignalMask = SignalMask.Artifact | SignalMask.Wake) -> np.ndarray:
+        """
+        Boolean vector of our window indexes, True where the window's ground truth range overlaps signal positions
+        with any of the given SignalMask flags. Such windows may be skipped, e.g. by training or inference.
+        """
+        n_masked_until = np.concatenate([[0], np.cumsum(self.get_signal_mask(flags=flags))])
+        center_point_indexes = np.asarray(self._idx__signal_int_index)
+        half_width_ = int(self.config.ground_truth_vector_width__index_steps/2)
+        return n_masked_until[center_point_indexes + half_width_ + 1] - n_masked_until[center_point_indexes - half_width_] > 0
 
-        @return: Awake vector (1=awake, 0=asleep) as Series. The Series index corresponds to our signals index. None
-                 if there are no event annotations available.
+    def set_signal(self, signal_name: str, values: np.ndarray):
+        self.record.set_signal(signal_name=signal_name, values=values)
+
+    def _get_ground_truth_valid_range(self) -> Tuple[int, int]:
+        """
+        Returns the range (start, stop) of our ground truth vector that our windows can reach. Its beginning/ending is
+        erased, length depending on our time-window-size & gt-vector-width.
+        """
+        n_samples_ = len(self.signals)
+        edge_cut_indexes_lr = self._center_point_margin - int(self.config.ground_truth_vector_width__index_steps/2) - 1
+        n_cut_begin_ = len(range(n_samples_)[:edge_cut_indexes_lr + 1])
+        n_cut_end_ = len(range(n_samples_)[-edge_cut_indexes_lr:])
+        return n_cut_begin_, max(n_cut_begin_, n_samples_ - n_cut_end_)
+
+    def _get_trimmed_ground_truth(self) -> np.ndarray:
+        valid_start_, valid_stop_ = self._get_ground_truth_valid_range()
+        gt_vector = np.full(shape=(len(self.signals),), fill_value=np.nan)
+        gt_vector[valid_start_:valid_stop_] = self.record._ground_truth_codes[valid_start_:valid_stop_]
+        return gt_vector
+
+    @functools.cached_property
+    def ground_truth_series(self) -> Optional[pd.Series]:
         """
-        if self.sleep_stage_events is None:
+        Ground truth vector of the whole record, trimmed to the positions that our windows can reach (NaN elsewhere).
+        None, if there are no event annotations.
+        """
+        if not self.has_ground_truth():
             return None
-        is_awake_mat = np.zeros(shape=(len(self.signals.index),), dtype="int8")
-        for event in self.sleep_stage_events:
-            start_idx = self.signals.index.get_loc(event.start)
-            value = 1 if event.sleep_stage_type == SleepStageType.Wakefulness else 0
-            is_awake_mat[start_idx:] = value
-        is_awake_series = pd.Series(data=is_awake_mat, index=self.signals.index, name="Is awake (ref. sleep stages)")
-        return is_awake_series
+        return pd.Series(data=self._get_trimmed_ground_truth(), index=self.signals.index)
 
-    @staticmethod
-    def _generate_ground_truth_series(signals_time_index: pd.TimedeltaIndex, respiratory_events: List[RespiratoryEvent]) -> pd.Series:
-        gt_vector = np.ndarray(shape=(len(signals_time_index),))
-        gt_vector[:] = GroundTruthClass.NoEvent.value
-        for event in respiratory_events:
-            start_idx = signals_time_index.get_loc(key=event.start, method="nearest")
-            end_idx = signals_time_index.get_loc(key=event.end, method="nearest")
-            assert event.event_type in RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS.keys(), \
-                f"{event.event_type.name} seems not present in above dictionary (and likely in GroundTruthClass)"
-            gt_class = RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS[event.event_type]
-            gt_vector[start_idx:end_idx] = gt_class.value
-
-        gt_series = pd.Series(data=gt_vector, index=signals_time_index, dtype="uint8")
-        return gt_series
+    def _determine_center_points(self):
+        """Determines the valid center points of our windows, based on config & signals."""
+        assert self.signals.index[0] <= self.config.time_window_size < self.signals.index[-1], \
+            f"Chosen time_window_size '{self.config.time_window_size}' is too large for the given PhysioNet dataset!"
+        dist_ = int(max(self.config.time_window_size__index_steps/2, self.config.ground_truth_vector_width__index_steps/2))
+        dist_ = max(2, dist_)  # Must be at least 2 to produce reasonable values
+        self._center_point_margin = dist_
+        self._idx__signal_int_index: range = range(len(self.signals))[dist_:-dist_:self.config.time_window_stride__index_steps]
+
+    def _get_features_slice(self, center_point_index: int) -> slice:
+        half_width_ = int(self.config.time_window_size__index_steps/2)
+        return slice(center_point_index - half_width_, center_point_index + half_width_ + 1)
+
+    def _get_ground_truth_slice(self, center_point_index: int) -> slice:
+        half_width_ = int(self.config.ground_truth_vector_width__index_steps/2)
+        return slice(center_point_index - half_width_, center_point_index + half_width_ + 1)
 
     @functools.cached_property
     def gt_class_occurrences(self) -> Dict[GroundTruthClass, int]:
         """Offers a distribution of ground truth classes."""
-        gt_series__no_nans = self.ground_truth_series[~np.isnan(self.ground_truth_series)]
-        counter = Counter(gt_series__no_nans)
+        valid_start_, valid_stop_ = self._get_ground_truth_valid_range()
+        counts = np.bincount(self.record._ground_truth_codes[valid_start_:valid_stop_], minlength=len(GroundTruthClass))
 
-        gt_class_occurrences: Dict[GroundTruthClass, int] = {klass: counter[klass.value] if klass.value in counter else 0 for klass in GroundTruthClass}
+        gt_class_occurrences: Dict[GroundTruthClass, int] = {klass: int(counts[klass.value]) for klass in GroundTruthClass}
         return gt_class_occurrences
 
     def has_ground_truth(self):
-        return self.respiratory_events is not None
+        return self.record.has_ground_truth()
 
-    def _try_read_cached_dataset(self, cached_dataset_file: Path) -> bool:
-        if not cached_dataset_file.is_file() or not cached_dataset_file.exists():
-            return False
-        try:
-            with open(file=cached_dataset_file, mode="rb") as file:
-                cached_dataset: SlidingWindowDataset = pickle.load(file)
-            # Make sure the cached config matches the given config. We intentionally don't compare the configs directly!
-            for field in fields(self.config):
-                assert getattr(self.config, field.name) == getattr(cached_dataset.config, field.name)
-            # Now, retrieve the cached data fields
-            self._valid_center_points = cached_dataset._valid_center_points
-            self._idx__signal_int_index = cached_dataset._idx__signal_int_index
-            self.ground_truth_series = cached_dataset.ground_truth_series
-            self.respiratory_events = cached_dataset.respiratory_events
-            self.sleep_stage_events = cached_dataset.sleep_stage_events
-            self.signals = cached_dataset.signals
-            del cached_dataset
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except BaseException:  # We intentionally catch everything here!
-            return False
-        return True
-
-    def __getitem__(self, idx: int) -> WindowData:
+    def get_window_arrays(self, idx: int) -> WindowArrays:
+        """
+        Array-native counterpart of __getitem__. Returns views into our signals matrix & ground truth vector, without
+        creating any pandas objects. The returned arrays must not be modified.
+        """
         assert -len(self) <= idx < len(self), "Index out of bounds"
         center_point_index = self._idx__signal_int_index[idx]
-        center_point_timedelta = self._valid_center_points[idx]
 
-        features = self.signals.iloc[center_point_index-int(self.config.time_window_size__index_steps/2):center_point_index+int(self.config.time_window_size__index_steps/2)+1]
-        assert len(features) == self.config.time_window_size__index_steps
-        assert not np.any(np.isnan(features.values)), f"Oops, there's something NaN! dataset_name='{self.dataset_name}', idx={idx}"
-        assert not np.any(np.isinf(features.values)), f"Oops, there's something inf! dataset_name='{self.dataset_name}', idx={idx}"
+        features_slice = self._get_features_slice(center_point_index)
+        features = self.record._signals_mat[:, features_slice]
+        assert features.shape[1] == self.config.time_window_size__index_steps
+        n_non_finite_until = self.record._n_non_finite_until
+        if n_non_finite_until is not None:
+            n_non_finite = n_non_finite_until[features_slice.stop] - n_non_finite_until[features_slice.start]
+            assert n_non_finite == 0, f"Oops, there's something NaN/inf! dataset_name='{self.dataset_name}', idx={idx}"
+
+        # By choice of our center point margin, the GT window never reaches the trimmed edges of the GT vector. Hence,
+        # we can slice the untrimmed vector of our record.
+        gt = None
+        if self.has_ground_truth():
+            gt = self.record._ground_truth_codes[self._get_ground_truth_slice(center_point_index)]
+            assert len(gt) == self.config.ground_truth_vector_width__index_steps
+        return WindowArrays(features=features, center_point_index=center_point_index, ground_truth=gt)
+
+    def __getitem__(self, idx: int) -> WindowData:
+        window_arrays = self.get_window_arrays(idx)
+        center_point_index = window_arrays.center_point_index
 
+        features = self.signals.iloc[self._get_features_slice(center_point_index)]
         gt_series = None
-        if self.has_ground_truth():
-            gt_numbers = self.ground_truth_series[center_point_index - int(self.config.ground_truth_vector_width__index_steps / 2):center_point_index + int(self.config.ground_truth_vector_width__index_steps / 2) + 1]
-            assert len(gt_numbers) == self.config.ground_truth_vector_width__index_steps
-            assert not np.any(np.isnan(gt_numbers))
-            gt_classes = [GroundTruthClass(int(g)) for g in gt_numbers]
-            gt_series = pd.Series(data=gt_classes, index=gt_numbers.index, name="Ground truth")
-        return WindowData(signals=features, center_point=center_point_timedelta, ground_truth=gt_series)
+        if window_arrays.ground_truth is not None:
+            gt_classes = [GroundTruthClass(g) for g in window_arrays.ground_truth.tolist()]
+            gt_series = pd.Series(data=gt_classes, index=self.signals.index[self._get_ground_truth_slice(center_point_index)],
+                                  name="Ground truth")
+        return WindowData(signals=features, center_point=self.signals.index[center_point_index], ground_truth=gt_series)
 
     def __len__(self):
-        return len(self._valid_center_points)
+        return len(self._idx__signal_int_index)
 
-    @functools.cached_property
+    @property
     def valid_center_points(self) -> pd.TimedeltaIndex:
         """
         Provides the range of valid center points. Center point refers to the middle of the configured time window.
         """
-        return copy.deepcopy(self._valid_center_points)
+        index_range_ = self._idx__signal_int_index
+        return self.signals.index[index_range_.start:index_range_.stop:index_range_.step]
+
+    def index_to_center_point(self, idx: Union[int, np.ndarray]) -> Union[pd.Timedelta, pd.TimedeltaIndex]:
+        """Returns the center points of the windows with the given indexes (single index or array of indexes)."""
+        signal_positions = self._get_signal_positions(idx)
+        return self.signals.index[signal_positions]
+
+    def _get_signal_positions(self, idx: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+        """Translates window indexes (negative ones allowed) into positions within our signals."""
+        idx = np.asarray(idx)
+        assert np.all((-len(self) <= idx) & (idx < len(self))), "Index out of bounds"
+        idx = np.where(idx < 0, idx + len(self), idx)
+        signal_positions = self._idx__signal_int_index.start + idx * self._idx__signal_int_index.step
+        return int(signal_positions) if signal_positions.ndim == 0 else signal_positions
+
+    def center_point_to_index(self, center_point: Union[pd.Timedelta, pd.TimedeltaIndex, np.ndarray]) -> Union[int, np.ndarray]:
+        """
+        Returns the indexes of the windows whose center points are nearest to the given times (single time or array of
+        times). Equivalent to valid_center_points.get_indexer(times, method="nearest"), but computed arithmetically in
+        O(1) per time, as our center points form a regular grid.
+        """
+        times = _to_nanoseconds(center_point)
+        signal_times = _to_nanoseconds(self.signals.index)
+        index_range_ = self._idx__signal_int_index
+        valid_start_, valid_end_ = signal_times[index_range_[0]], signal_times[index_range_[-1]]
+        assert np.all((valid_start_ <= times) & (times <= valid_end_)), \
+            f"Given center point(s) not in range of valid center points ({pd.Timedelta(valid_start_)}..{pd.Timedelta(valid_end_)})!"
+
+        # The grid spacing is derived from the actual time index, which may deviate from a perfectly regular grid by
+        # rounding of the sample period. Hence, the nearest neighbour is chosen among the estimate & its two neighbours.
+        # On ties, the later center point wins (as with get_indexer).
+        spacing_ = (valid_end_ - valid_start_) / max(1, len(self) - 1)
+        estimates = np.rint((times - valid_start_) / spacing_).astype(np.int64)
+        candidates = np.clip(estimates[..., np.newaxis] + np.array([1, 0, -1]), 0, len(self) - 1)
+        distances = np.abs(signal_times[index_range_.start + candidates * index_range_.step] - times[..., np.newaxis])
+        idx = np.take_along_axis(candidates, np.argmin(distances, axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+        return int(idx) if idx.ndim == 0 else idx
 
     def get(self, center_point: pd.Timedelta = None, raw_index: int = None) -> WindowData:
         """
@@ -262,16 +622,21 @@ class SlidingWindowDataset:
         assert (center_point is None and raw_index is not None) or (center_point is not None and raw_index is None), \
             "Exactly one of the given arguments must be None!"
         if center_point is not None:
-            valid_start_ = self._valid_center_points[0]
-            valid_end_ = self._valid_center_points[-1]
-            assert valid_start_ <= center_point <= valid_end_, \
-                f"Given center point {center_point} not in range of valid center points ({valid_start_}..{valid_end_})!"
-            idx = self._valid_center_points.get_loc(center_point, method="nearest")
+            idx = self.center_point_to_index(center_point)
             assert 0 <= idx < len(self)
         else:
             idx = raw_index
         return self[idx]
 
+    def get_ground_truth_time_range(self, idx: Union[int, np.ndarray]) -> Tuple[Union[pd.Timedelta, pd.TimedeltaIndex], Union[pd.Timedelta, pd.TimedeltaIndex]]:
+        """
+        Returns first & last time stamp that the ground truth vectors of the given windows (single index or array of
+        indexes) refer to, without retrieving the windows.
+        """
+        signal_positions = self._get_signal_positions(idx)
+        half_width_ = int(self.config.ground_truth_vector_width__index_steps/2)
+        return self.signals.index[signal_positions - half_width_], self.signals.index[signal_positions + half_width_]
+
 
 def test_sliding_window_dataset():
     from util.paths import DATA_PATH
@@ -313,3 +678,291 @@ def test_caching_speed():
     print()
     print(f"The whole process with n_runs={n_runs} took {overall_seconds * 1000:.1f}ms")
     print(f"A single run took {overall_seconds / n_runs * 1000:.2f}ms")
+
+
+def test_sliding_window_dataset_caching(tmp_path, monkeypatch):
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    other_frequency_config = SlidingWindowDataset.Config(downsample_frequency_hz=10, time_window_size=pd.Timedelta("1 minute"))
+    other_window_config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("1 minute"),
+                                                      time_window_stride=3, ground_truth_vector_width=5)
+
+    uncached_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    assert not (dataset_folder / CACHE_FOLDER_NAME).exists()
+    _ = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=True)
+
+    # From now on, the record must not be read from disk any more. All stages are either cached or derived from cache
+    def _read_physionet_dataset(*args, **kwargs):
+        raise AssertionError("Dataset must not be read")
+    monkeypatch.setattr(f"{__name__}.read_physionet_dataset", _read_physionet_dataset)
+    _ = SlidingWindowDataset(config=other_frequency_config, dataset_folder=dataset_folder, allow_caching=True)
+    other_window_dataset = SlidingWindowDataset(config=other_window_config, dataset_folder=dataset_folder, allow_caching=True)
+    n_stage_entries = {stage: len(DatasetCache(cache_folder=dataset_folder / CACHE_FOLDER_NAME / stage).info())
+                       for stage in _StageCaches._fields}
+    assert n_stage_entries == {"cleaned": 1, "downsampled": 2}
+    monkeypatch.undo()
+    expected_dataset = SlidingWindowDataset(config=other_window_config, dataset_folder=dataset_folder, allow_caching=False)
+    pd.testing.assert_series_equal(other_window_dataset.ground_truth_series, expected_dataset.ground_truth_series)
+
+    cached_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=True)
+    pd.testing.assert_frame_equal(cached_dataset.signals, uncached_dataset.signals)
+    pd.testing.assert_series_equal(cached_dataset.ground_truth_series, uncached_dataset.ground_truth_series)
+    assert cached_dataset.respiratory_events == uncached_dataset.respiratory_events
+    assert cached_dataset.sleep_stage_events == uncached_dataset.sleep_stage_events
+    assert list(cached_dataset.valid_center_points) == list(uncached_dataset.valid_center_points)
+    assert np.array_equal(cached_dataset.record._signal_mask_codes, uncached_dataset.record._signal_mask_codes)
+    for idx in (0, len(uncached_dataset) // 2, -1):
+        pd.testing.assert_frame_equal(cached_dataset[idx].signals, uncached_dataset[idx].signals)
+        pd.testing.assert_series_equal(cached_dataset[idx].ground_truth, uncached_dataset[idx].ground_truth)
+
+
+def test_window_arrays(tmp_path):
+    import pickle
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    assert isinstance(dataset._idx__signal_int_index, range)
+    assert np.shares_memory(dataset.signals.values, dataset.record._signals_mat)
+
+    for idx in (0, 1, len(dataset) // 2, -1):
+        window_data = dataset[idx]
+        window_arrays = dataset.get_window_arrays(idx)
+        assert window_arrays.features.shape == (len(dataset.signal_names), config.time_window_size__index_steps)
+        assert np.shares_memory(window_arrays.features, dataset.record._signals_mat)
+        assert np.array_equal(window_arrays.features, window_data.signals[list(dataset.signal_names)].values.T)
+        assert window_arrays.ground_truth.dtype == np.uint8
+        assert list(window_arrays.ground_truth) == [g.value for g in window_data.ground_truth]
+        assert window_data.center_point == dataset.valid_center_points[idx]
+
+    # Overwritten signals must be reflected by both access paths, also after passing the dataset between processes
+    dataset.set_signal("ABD", np.arange(len(dataset.signals), dtype=np.float32))
+    dataset = pickle.loads(pickle.dumps(dataset))
+    assert np.shares_memory(dataset.signals.values, dataset.record._signals_mat)
+    assert np.array_equal(dataset[3].signals["ABD"].values, dataset.get_window_arrays(3).features[0])
+
+    dataset.set_signal("CHEST", np.full(shape=(len(dataset.signals),), fill_value=np.nan))
+    with pytest.raises(AssertionError):
+        dataset.get_window_arrays(0)
+
+
+@pytest.mark.speed
+def test_window_arrays_speed(tmp_path):
+    from datetime import datetime
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         ground_truth_vector_width=11)
+    dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+
+    print()
+    for name, get_fn in (("__getitem__", dataset.__getitem__), ("get_window_arrays", dataset.get_window_arrays)):
+        started_at = datetime.now()
+        for idx in range(len(dataset)):
+            _ = get_fn(idx)
+        overall_seconds = (datetime.now() - started_at).total_seconds()
+        print(f"{name}: {overall_seconds / len(dataset) * 1_000_000:.1f}us per index")
+
+
+def test_shared_record(tmp_path):
+    import pickle
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    other_configs = [SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta(window_size),
+                                                 time_window_stride=stride, ground_truth_vector_width=gt_width)
+                     for window_size, stride, gt_width in (("1 minute", 3, 5), ("5 minutes", 1, 1), ("10 minutes", 7, 31))]
+
+    dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    views = [dataset.with_config(c) for c in other_configs]
+    for view, other_config in zip(views, other_configs):
+        assert view.record is dataset.record
+        expected = SlidingWindowDataset(config=other_config, dataset_folder=dataset_folder, allow_caching=False)
+        assert len(view) == len(expected)
+        pd.testing.assert_series_equal(view.ground_truth_series, expected.ground_truth_series)
+        assert view.gt_class_occurrences == expected.gt_class_occurrences
+        for idx in (0, len(view) // 2, -1):
+            pd.testing.assert_frame_equal(view[idx].signals, expected[idx].signals)
+            pd.testing.assert_series_equal(view[idx].ground_truth, expected[idx].ground_truth)
+
+    # Records must stay shared when the datasets are passed between processes
+    views_ = pickle.loads(pickle.dumps(views))
+    assert all(v.record is views_[0].record for v in views_)
+
+    with pytest.raises(AssertionError):
+        SlidingWindowDataset(config=SlidingWindowDataset.Config(downsample_frequency_hz=10, time_window_size=pd.Timedelta("1 minute")),
+                             record=dataset.record)
+
+
+def test_label_rasterization(tmp_path):
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    time_index = dataset.signals.index
+
+    # Compare against rasterizing the event lists one by one
+    expected_gt = np.full(shape=(len(time_index),), fill_value=GroundTruthClass.NoEvent.value, dtype=np.uint8)
+    for event in dataset.respiratory_events:
+        start_idx, end_idx = time_index.get_indexer([event.start, event.end], method="nearest")
+        expected_gt[start_idx:end_idx] = RESPIRATORY_EVENT_TYPE__GROUND_TRUTH_CLASS[event.event_type].value
+    assert np.array_equal(dataset.record._ground_truth_codes, expected_gt)
+
+    expected_awake = np.zeros(shape=(len(time_index),), dtype="int8")
+    for event in dataset.sleep_stage_events:
+        expected_awake[time_index.get_loc(event.start):] = 1 if event.sleep_stage_type == SleepStageType.Wakefulness else 0
+    assert np.array_equal(dataset.awake_series.values, expected_awake)
+
+    gt_series__no_nans = dataset.ground_truth_series[~np.isnan(dataset.ground_truth_series)]
+    assert dataset.gt_class_occurrences == {klass: int((gt_series__no_nans == klass.value).sum()) for klass in GroundTruthClass}
+
+
+def test_center_point_lookup(tmp_path):
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    for downsample_frequency_hz, stride in ((5, 5), (5, 1), (16, 3)):
+        config = SlidingWindowDataset.Config(downsample_frequency_hz=downsample_frequency_hz, time_window_stride=stride,
+                                             time_window_size=pd.Timedelta("1 minute"), ground_truth_vector_width=5)
+        dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+        valid_center_points = dataset.valid_center_points
+        rng = np.random.default_rng(0)
+        times = pd.TimedeltaIndex(valid_center_points[0] + (valid_center_points[-1] - valid_center_points[0]) * rng.random(size=2000))
+        times = times.append([valid_center_points[[0, 1, -1]], valid_center_points[:-1] + (valid_center_points[1] - valid_center_points[0]) / 2])
+
+        expected = valid_center_points.get_indexer(times, method="nearest")
+        assert np.array_equal(dataset.center_point_to_index(times), expected)
+
+        assert dataset.center_point_to_index(times[5]) == expected[5]
+        assert dataset.index_to_center_point(-1) == valid_center_points[-1]
+        assert list(dataset.index_to_center_point(expected[:50])) == list(valid_center_points[expected[:50]])
+        assert dataset.get(center_point=times[7]).center_point == valid_center_points[expected[7]]
+        gt_starts, gt_ends = dataset.get_ground_truth_time_range(np.array([0, 17, -1]))
+        for i, idx in enumerate((0, 17, -1)):
+            assert (gt_starts[i], gt_ends[i]) == (dataset[idx].ground_truth.index[0], dataset[idx].ground_truth.index[-1])
+        with pytest.raises(AssertionError):
+            dataset.center_point_to_index(valid_center_points[-1] + pd.Timedelta("1s"))
+
+
+def test_peak_index(tmp_path):
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"))
+    signal_names, prefilter = ("AIRFLOW", "CHEST", "ABD"), LowpassPrefilter(f_cutoff=0.1, f_sample=1)
+    uncached_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    assert uncached_dataset.peak_index is None
+    expected = uncached_dataset.get_peak_arrays(signal_names=signal_names, filter_kernel_width=3, prefilter=prefilter)
+
+    # Peaks are stored next to the pre-processed signals, & are loaded from there by later datasets of the same record
+    for _ in range(2):
+        cached_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=True)
+        assert cached_dataset.peak_index.cache_folder == dataset_folder.resolve() / CACHE_FOLDER_NAME / "peaks"
+        peaks_list = cached_dataset.get_peak_arrays(signal_names=signal_names, filter_kernel_width=3, prefilter=prefilter)
+        for peaks, expected_peaks in zip(peaks_list, expected):
+            assert all(np.array_equal(a, b) for a, b in zip(peaks, expected_peaks))
+    assert all(isinstance(a, np.memmap) for peaks in peaks_list for a in peaks)
+    assert len(cached_dataset.peak_index._cache.info()) == len(signal_names)
+
+    # Changed signals are not served outdated peaks
+    cached_dataset.set_signal("AIRFLOW", cached_dataset.signals["AIRFLOW"].values * 2)
+    peaks, = cached_dataset.get_peak_arrays(signal_names=["AIRFLOW"], filter_kernel_width=3, prefilter=prefilter)
+    assert not isinstance(peaks.starts, np.memmap)
+
+
+def test_signal_mask(tmp_path):
+    from .physionet.reader import _write_test_record
+
+    # Flat-lines (of at least _FLAT_LINE_MIN_DURATION) & non-finite values are artifacts
+    n_samples, flat_line_length = 2000, int(_FLAT_LINE_MIN_DURATION / pd.Timedelta("200ms"))
+    signals_mat = np.random.default_rng(0).normal(size=(n_samples, 3))
+    signals_mat[100:100 + flat_line_length, 0] = 0
+    signals_mat[500:500 + flat_line_length - 1, 1] = 3  # Too short
+    signals_mat[-flat_line_length:, 2] = 1
+    signals_mat[50, 0] = np.nan
+    signals = pd.DataFrame(data=signals_mat, index=pd.timedelta_range(start="0s", periods=n_samples, freq="200ms"),
+                           columns=_FLAT_LINE_SIGNAL_NAMES)
+    expected = np.zeros(shape=(n_samples,), dtype=bool)
+    expected[[50]] = expected[100:100 + flat_line_length] = expected[-flat_line_length:] = True
+    assert np.array_equal(SlidingWindowRecord._generate_signal_mask(signals=signals, event_table=None), expected * SignalMask.Artifact)
+
+    # Wake stages stem from the annotations. A window is masked if its ground truth range touches a masked position
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=1200)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+    assert np.array_equal(dataset.get_signal_mask(flags=SignalMask.Wake), dataset.awake_series.values != 0)
+    assert not np.any(dataset.get_signal_mask(flags=SignalMask.Artifact))
+    is_masked_window = dataset.get_window_mask(flags=SignalMask.Wake)
+    expected = [np.any(dataset.awake_series[dataset[i].ground_truth.index].values) for i in range(len(dataset))]
+    assert list(is_masked_window) == expected and 0 < np.sum(is_masked_window) < len(dataset)
+
+
+def test_signal_codec_storage(tmp_path):
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=3600)
+    config = SlidingWindowDataset.Config(downsample_frequency_hz=5, time_window_size=pd.Timedelta("2 minutes"),
+                                         time_window_stride=5, ground_truth_vector_width=11)
+    float_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, allow_caching=False)
+
+    # Quantized signals are close to the float32 ones; built & loaded datasets are equal
+    codec = QuantizedSignalCodec(compression="zlib", chunk_size=4096)
+    built_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, signal_codec=codec)
+    loaded_dataset = SlidingWindowDataset(config=config, dataset_folder=dataset_folder, signal_codec=codec)
+    assert np.array_equal(built_dataset.record._signals_mat, loaded_dataset.record._signals_mat)
+    value_ranges = np.ptp(float_dataset.record._signals_mat, axis=1)
+    max_abs_errors = np.max(np.abs(loaded_dataset.record._signals_mat - float_dataset.record._signals_mat), axis=1)
+    assert np.all(max_abs_errors <= value_ranges * 1e-4), f"Max abs errors {max_abs_errors}, value ranges {value_ranges}"
+    pd.testing.assert_series_equal(loaded_dataset.ground_truth_series, float_dataset.ground_truth_series)
+    assert len(loaded_dataset) == len(float_dataset)
+
+
+@pytest.mark.speed
+def test_signal_codec_storage__speed(tmp_path):
+    import pickle
+    from datetime import datetime
+    from .physionet.reader import _write_test_record
+
+    dataset_folder = _write_test_record(dataset_folder=tmp_path / "tr00-0001", duration_seconds=3600)
+
+    # Benchmark the storage formats on the (large) cleaned stage: pickle (as the former preprocessed.pkl), .npy & codecs
+    cleaned_ds = read_physionet_dataset(dataset_folder=dataset_folder, channels=_SIGNAL_NAMES, read_digital=True).pre_clean()
+    pickle_file = tmp_path / "cleaned.pkl"
+    with open(pickle_file, mode="wb") as file:
+        pickle.dump(cleaned_ds, file)
+    started_at = datetime.now()
+    with open(pickle_file, mode="rb") as file:
+        _ = pickle.load(file)
+    pickle_seconds = (datetime.now() - started_at).total_seconds()
+    print(f"\npickle: {pickle_file.stat().st_size / 1e6:.2f}MB, load {pickle_seconds * 1000:.1f}ms")
+
+    window_size = int(pd.Timedelta("2 minutes") / cleaned_ds.signals.index.freq)
+    arrays, meta = physionet_dataset_to_cache_entry(cleaned_ds)
+    for name, codec in (("npy float32", None), ("int16", QuantizedSignalCodec(compression=None)),
+                        ("int16 zlib", QuantizedSignalCodec(compression="zlib")),
+                        ("int16 lzma", QuantizedSignalCodec(compression="lzma"))):
+        cache = DatasetCache(cache_folder=tmp_path / "benchmark" / name.replace(" ", "_"),
+                             array_codecs=None if codec is None else {"signals": codec})
+        cache.store(key="key", arrays=arrays, meta=meta)
+        started_at = datetime.now()
+        _ = physionet_dataset_from_cache_entry(*cache.load(key="key"))
+        load_seconds = (datetime.now() - started_at).total_seconds()
+        starts = np.random.default_rng(0).integers(0, len(cleaned_ds.signals) - window_size, size=50)
+        started_at = datetime.now()
+        for start in starts:
+            window = cache.load_array_range(key="key", name="signals", start=start, stop=start + window_size)
+            assert window.shape == (window_size, len(_SIGNAL_NAMES))
+        window_seconds = (datetime.now() - started_at).total_seconds() / len(starts)
+        print(f"{name}: {cache.info()[0].n_bytes / 1e6:.2f}MB, load {load_seconds * 1000:.1f}ms, "
+              f"single window {window_seconds * 1000:.2f}ms")
@@ -11,6 +11,7 @@ import pytest
 import numba
 
 from util.datasets import RespiratoryEventType, RespiratoryEvent
+from util.datasets.rasterization import get_nearest_indexes, rasterize_intervals
 from .overlaps import get_overlaps
 
 
@@ -151,13 +152,10 @@ class SampleBasedConfusionMatrix(_ConfusionMatrixBase):
     """
     @staticmethod
     def _build_event_vector(time_index: pd.TimedeltaIndex, events: List[RespiratoryEvent]) -> np.ndarray:
-        vector = np.empty(shape=len(time_index), dtype=int)
-        vector[:] = NO_EVENT_INDEX
-        for event in events:
-            start_idx = time_index.get_loc(event.start, method="nearest")
-            end_idx = time_index.get_loc(event.end, method="nearest")
-            vector[start_idx:end_idx+1] = event.event_type.value
-        return vector
+        start_indexes = get_nearest_indexes(time_index=time_index, times=pd.to_timedelta([e.start for e in events]))
+        end_indexes = get_nearest_indexes(time_index=time_index, times=pd.to_timedelta([e.end for e in events]))
+        return rasterize_intervals(length=len(time_index), starts=start_indexes, ends=end_indexes + 1,
+                                   values=[e.event_type.value for e in events], fill_value=NO_EVENT_INDEX, dtype=int)
 
     @staticmethod
     @numba.jit(nopython=True)
@@ -1,9 +1,13 @@
-from typing import Union
+from typing import Union, Dict, Tuple, Optional, List
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import os
 
 import scipy.signal
 import numpy as np
 import pandas as pd
+import numba
+import pytest
 
 
 @lru_cache(maxsize=None)
@@ -45,6 +49,169 @@ def apply_butterworth_lowpass_filter(data: Union[np.ndarray, pd.Series], f_cutof
     return y
 
 
+# Approximate number of bytes sosfiltfilt allocates per filtered value (float64 padding, forward & backward pass)
+_SOSFILTFILT_BYTES_PER_VALUE = 20
+
+
+def apply_butterworth_bandpass_filter_bank(data: np.ndarray, channel_cutoffs: Dict[int, Tuple[float, float]],
+                                           f_sample: float, filter_order: int = 5, n_threads: Optional[int] = None,
+                                           max_work_bytes: int = 64 * 1024**2) -> np.ndarray:
+    """
+    Band-pass filters several channels of a 2-D array (samples x channels) in place. Channels that share the same
+    cutoff frequencies are grouped and filtered together in 2-D sosfiltfilt calls along axis 0. These calls are
+    independent of each other and run on a thread pool, since scipy releases the GIL while filtering.
+
+    The output equals calling apply_butterworth_bandpass_filter on each channel separately.
+
+    :param data: 2-D float array (samples x channels), which gets modified in place. Channels not mentioned in
+                 'channel_cutoffs' remain untouched.
+    :param channel_cutoffs: Maps column index -> (f_low_cutoff, f_high_cutoff)
+    :param n_threads: Number of filter threads. If None, up to one thread per CPU is used.
+    :param max_work_bytes: Limits the temporary memory of each sosfiltfilt call by filtering a group of channels in
+                           blocks. At least one channel is filtered per call. Note that each thread has its own block.
+    :return: The very same (filtered) array that was passed in as 'data'.
+    """
+    assert data.ndim == 2, "Filter bank expects 2-D data (samples x channels)"
+    assert all(0 <= c < data.shape[1] for c in channel_cutoffs), "Channel index out of range"
+
+    groups: Dict[Tuple[float, float], List[int]] = {}
+    for channel, cutoffs in channel_cutoffs.items():
+        groups.setdefault(tuple(cutoffs), []).append(channel)
+    block_size = max(1, max_work_bytes // max(1, data.shape[0] * _SOSFILTFILT_BYTES_PER_VALUE))
+    blocks = [(cutoffs, channels[i:i+block_size]) for cutoffs, channels in groups.items()
+              for i in range(0, len(channels), block_size)]
+
+    def _filter_block(cutoffs: Tuple[float, float], channels: List[int]):
+        sos_coeff = _get_butterworth_bandpass_coefficients(cutoffs[0], cutoffs[1], f_sample, filter_order=filter_order)
+        y = scipy.signal.sosfiltfilt(sos_coeff, data[:, channels], axis=0)
+        assert not np.isnan(y).any(), \
+            "Filter output contains at least one NaN. That's not desired. Try lowering filter-order parameter."
+        data[:, channels] = y
+
+    n_threads = min(len(blocks), n_threads or os.cpu_count() or 1)
+    if n_threads <= 1:
+        for cutoffs, channels in blocks:
+            _filter_block(cutoffs, channels)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(_filter_block, cutoffs, channels) for cutoffs, channels in blocks]
+            for future in futures:
+                future.result()
+    return data
+
+
+class CausalBandpassFilterBank:
+    """
+    Causal counterpart of apply_butterworth_bandpass_filter_bank, for data that arrives block by block (e.g. live
+    recordings). Channels are filtered by sosfilt in forward direction only; the filter states carry over from one
+    block to the next, so that the output does not depend on how the data is split into blocks.
+
+    Unlike sosfiltfilt, the output is not zero-phase: it lags behind the input & is attenuated by only one filter pass.
+    """
+    def __init__(self, n_channels: int, channel_cutoffs: Dict[int, Tuple[float, float]], f_sample: float,
+                 filter_order: int = 5):
+        """
+        :param n_channels: Number of channels (columns) of the blocks that are passed in.
+        :param channel_cutoffs: Maps column index -> (f_low_cutoff, f_high_cutoff). Other columns remain untouched.
+        """
+        assert all(0 <= c < n_channels for c in channel_cutoffs), "Channel index out of range"
+        self.n_channels = n_channels
+        self._groups: Dict[Tuple[float, float], List[int]] = {}
+        for channel, cutoffs in channel_cutoffs.items():
+            self._groups.setdefault(tuple(cutoffs), []).append(channel)
+        self._sos_coeffs = {cutoffs: _get_butterworth_bandpass_coefficients(cutoffs[0], cutoffs[1], f_sample, filter_order=filter_order)
+                            for cutoffs in self._groups}
+        self._states: Optional[Dict[Tuple[float, float], np.ndarray]] = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Filters a 2-D block (samples x channels) in place & returns it."""
+        assert block.ndim == 2 and block.shape[1] == self.n_channels, "Block must be 2-D (samples x channels)"
+        if len(block) == 0:
+            return block
+        if self._states is None:
+            # Start in steady state w.r.t. the very first sample, to avoid a huge transient in the beginning
+            self._states = {cutoffs: scipy.signal.sosfilt_zi(self._sos_coeffs[cutoffs])[:, :, np.newaxis] * block[0, channels]
+                            for cutoffs, channels in self._groups.items()}
+        for cutoffs, channels in self._groups.items():
+            y, self._states[cutoffs] = scipy.signal.sosfilt(self._sos_coeffs[cutoffs], block[:, channels], axis=0,
+                                                            zi=self._states[cutoffs])
+            assert not np.isnan(y).any(), \
+                "Filter output contains at least one NaN. That's not desired. Try lowering filter-order parameter."
+            block[:, channels] = y
+        return block
+
+
+class StreamingMeanDownsampler:
+    """
+    Block-wise counterpart of downsample_by_mean. Samples that do not complete a group are kept until the next block
+    arrives, so that the concatenated output equals downsample_by_mean of the concatenated input (except for a trailing
+    incomplete group, which is only output by flush()).
+    """
+    def __init__(self, downsampling_factor: int, n_channels: int):
+        assert downsampling_factor >= 1, "Downsampling factor must be a positive integer"
+        self.downsampling_factor = downsampling_factor
+        self._pending = np.empty(shape=(0, n_channels), dtype=np.float32)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Takes a 2-D block (samples x channels) & returns all groups that got complete by it."""
+        data = np.concatenate([self._pending, block]) if len(self._pending) != 0 else block
+        n_complete = len(data) // self.downsampling_factor * self.downsampling_factor
+        self._pending = data[n_complete:].copy()
+        if n_complete == 0:
+            return np.empty(shape=(0, data.shape[1]), dtype=data.dtype)
+        return downsample_by_mean(data[:n_complete], downsampling_factor=self.downsampling_factor)
+
+    def flush(self) -> np.ndarray:
+        """Returns the trailing incomplete group (if any), as downsample_by_mean does at the end of the data."""
+        y = self._pending[:0]
+        if len(self._pending) != 0:
+            y = downsample_by_mean(self._pending, downsampling_factor=self.downsampling_factor)
+        self._pending = self._pending[:0]
+        return y
+
+
+@numba.jit(nopython=True)
+def _downsample_by_mean_2d(data: np.ndarray, downsampling_factor: int) -> np.ndarray:
+    n_samples, n_channels = data.shape
+    n_groups = (n_samples + downsampling_factor - 1) // downsampling_factor
+    y = np.empty(shape=(n_groups, n_channels), dtype=data.dtype)
+    accumulator = np.empty(shape=(n_channels,), dtype=np.float64)
+    for group in range(n_groups):
+        start = group * downsampling_factor
+        end = min(n_samples, start + downsampling_factor)
+        accumulator[:] = 0.0
+        for i in range(start, end):
+            for c in range(n_channels):
+                accumulator[c] += data[i, c]
+        for c in range(n_channels):
+            y[group, c] = accumulator[c] / (end - start)
+    return y
+
+
+def downsample_by_mean(data: np.ndarray, downsampling_factor: int) -> np.ndarray:
+    """
+    Downsamples data (along axis 0) by an integer factor, by averaging each group of 'downsampling_factor' consecutive
+    samples. A trailing incomplete group is averaged as well. This equals what DataFrame.resample(...).mean() does on
+    a regular time index, just in a single pass & without the pandas overhead. Averaging is done in float64.
+
+    :param data: 1-D or 2-D array (samples x channels).
+    """
+    assert downsampling_factor >= 1, "Downsampling factor must be a positive integer"
+    assert data.ndim in (1, 2), "Only 1-D or 2-D data is supported"
+    y = _downsample_by_mean_2d(data.reshape(data.shape[0], -1), downsampling_factor)
+    return y.reshape((-1,) + data.shape[1:])
+
+
+def downsample_polyphase(data: np.ndarray, downsampling_factor: int) -> np.ndarray:
+    """
+    Downsamples data (along axis 0) by an integer factor, using a polyphase FIR decimator. Unlike averaging, this
+    applies a proper anti-aliasing low-pass filter beforehand. The output has the same length as for downsample_by_mean.
+    """
+    assert downsampling_factor >= 1, "Downsampling factor must be a positive integer"
+    y = scipy.signal.resample_poly(data, up=1, down=downsampling_factor, axis=0)
+    return y.astype(data.dtype, copy=False)
+
+
 def test_butterworth_bandpass_response():
     # The following code was inspired by   https://stackoverflow.com/a/12233959
     import matplotlib.pyplot as plt
@@ -94,3 +261,102 @@ def test_butterworth_bandpass_response():
     plt.legend(loc='upper left')
 
     plt.show()
+
+
+def test_downsample_by_mean():
+    index = pd.timedelta_range(start=0, periods=10_003, freq="5ms")
+    df = pd.DataFrame(data=np.random.default_rng(0).normal(size=(10_003, 3)).astype(np.float32), index=index)
+    expected = df.resample(rule="200ms").mean().values
+    y = downsample_by_mean(df.values, downsampling_factor=40)
+    assert y.dtype == np.float32 and y.shape == expected.shape
+    assert np.allclose(y, expected, rtol=0, atol=1e-6)
+
+    y = downsample_polyphase(df.values, downsampling_factor=40)
+    assert y.dtype == np.float32 and y.shape == expected.shape
+
+
+@pytest.mark.speed
+def test_downsample_by_mean__speed():
+    from datetime import datetime
+
+    index = pd.timedelta_range(start=0, periods=6_000_000, freq="5ms")
+    df = pd.DataFrame(data=np.random.default_rng(0).normal(size=(6_000_000, 4)).astype(np.float32), index=index)
+
+    started_at = datetime.now()
+    expected = df.resample(rule=f"{1/5*1_000_000}us").mean()
+    resample_seconds = (datetime.now() - started_at).total_seconds()
+
+    downsample_by_mean(df.values[:100], downsampling_factor=40)  # One initial run to JIT the code
+    started_at = datetime.now()
+    y = downsample_by_mean(df.values, downsampling_factor=40)
+    mean_seconds = (datetime.now() - started_at).total_seconds()
+    assert np.allclose(y, expected.values, rtol=0, atol=1e-6)
+
+    print()
+    print(f"DataFrame.resample().mean() took {resample_seconds * 1000:.1f}ms")
+    print(f"downsample_by_mean() took {mean_seconds * 1000:.1f}ms")
+
+
+def test_butterworth_bandpass_filter_bank():
+    data = np.random.default_rng(0).normal(size=(20_000, 5)).astype(np.float32)
+    channel_cutoffs = {0: (0.1, 15), 1: (0.3, 35), 2: (0.1, 15), 4: (0.03, 3)}
+    expected = data.copy()
+    for channel, (f_low, f_high) in channel_cutoffs.items():
+        expected[:, channel] = apply_butterworth_bandpass_filter(data[:, channel], f_low_cutoff=f_low,
+                                                                 f_high_cutoff=f_high, f_sample=200)
+
+    y = apply_butterworth_bandpass_filter_bank(data, channel_cutoffs=channel_cutoffs, f_sample=200)
+    assert y is data and y.dtype == np.float32
+    assert np.array_equal(y, expected)
+
+
+@pytest.mark.speed
+def test_butterworth_bandpass_filter_bank__speed():
+    from datetime import datetime
+
+    n_samples = 5_000_000
+    cutoffs = [(0.03, 3), (0.1, 15), (0.1, 15)] + [(0.3, 35)] * 7 + [(0.3, 70)]
+    data = np.random.default_rng(0).normal(size=(n_samples, len(cutoffs))).astype(np.float32)
+    df = pd.DataFrame(data=data.copy())
+
+    started_at = datetime.now()
+    for channel, (f_low, f_high) in enumerate(cutoffs):
+        df[channel] = apply_butterworth_bandpass_filter(df[channel], f_low_cutoff=f_low, f_high_cutoff=f_high,
+                                                        f_sample=200)
+    per_channel_seconds = (datetime.now() - started_at).total_seconds()
+
+    started_at = datetime.now()
+    apply_butterworth_bandpass_filter_bank(data, channel_cutoffs=dict(enumerate(cutoffs)), f_sample=200)
+    filter_bank_seconds = (datetime.now() - started_at).total_seconds()
+    assert np.array_equal(data, df.values.astype(np.float32))
+
+    print()
+    print(f"Per-channel filtering took {per_channel_seconds:.2f}s")
+    print(f"Filter bank took {filter_bank_seconds:.2f}s")
+
+
+def test_causal_bandpass_filter_bank():
+    data = np.random.default_rng(0).normal(size=(20_000, 3)).astype(np.float32)
+    channel_cutoffs = {0: (0.1, 15), 2: (0.03, 3)}
+    expected = CausalBandpassFilterBank(n_channels=3, channel_cutoffs=channel_cutoffs, f_sample=200).process(data.copy())
+    assert np.array_equal(expected[:, 1], data[:, 1])
+
+    # Block-wise filtering must not depend on the block boundaries
+    filter_bank = CausalBandpassFilterBank(n_channels=3, channel_cutoffs=channel_cutoffs, f_sample=200)
+    blocks = np.split(data.copy(), [1, 1000, 1001, 7777, 20_000])
+    y = np.concatenate([filter_bank.process(b) for b in blocks])
+    assert np.allclose(y, expected, atol=1e-5)
+
+    # Once settled, the causal filter lets the pass band through just like the zero-phase one
+    t = np.arange(200_000) / 200
+    sine = np.sin(2 * np.pi * 1 * t)[:, np.newaxis]
+    y = CausalBandpassFilterBank(n_channels=1, channel_cutoffs={0: (0.1, 15)}, f_sample=200).process(sine.copy())
+    assert np.isclose(np.abs(y[-20_000:]).max(), 1, atol=0.01)
+
+
+def test_streaming_mean_downsampler():
+    data = np.random.default_rng(0).normal(size=(10_003, 4)).astype(np.float32)
+    downsampler = StreamingMeanDownsampler(downsampling_factor=40, n_channels=4)
+    blocks = np.split(data, [3, 39, 40, 5000, 5001, 10_003])
+    y = np.concatenate([downsampler.process(b) for b in blocks] + [downsampler.flush()])
+    assert np.array_equal(y, downsample_by_mean(data, downsampling_factor=40))
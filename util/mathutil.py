@@ -5,6 +5,10 @@ from enum import Enum
 
 import numpy as np
 import numba
+import pytest
+from numba.core import types
+from numba.extending import overload
+from numba.np.numpy_support import as_dtype
 
 
 class PeakType(Enum):
@@ -21,88 +25,382 @@ Peak = NamedTuple("Peak", type=PeakType, extreme_value=float, start=int, end=int
 ZeroCross = NamedTuple("ZeroCross", type=ZeroCrossType, position=int)
 IntRange = NamedTuple("IntRange", start=int, end=int, length=int)
 
+# Struct-of-arrays counterpart of a list of peaks: element i of each array belongs to peak i. 'types' holds PeakType
+# values; 'extreme_values' has the dtype of the waveform that the peaks stem from.
+PeakArrays = NamedTuple("PeakArrays", types=np.ndarray, extreme_values=np.ndarray, starts=np.ndarray, ends=np.ndarray,
+                        centers=np.ndarray, lengths=np.ndarray)
+
+
+# Zero crosses of a filtered waveform, plus min/max waveform values of each stretch from one zero cross to the next.
+_ZeroCrossArrays = NamedTuple("_ZeroCrossArrays", positions=np.ndarray, is_positive=np.ndarray,
+                              stretch_minimums=np.ndarray, stretch_maximums=np.ndarray)
+
 
 @numba.jit(nopython=True)
-def get_peaks(waveform: np.ndarray, filter_kernel_width: int) -> List[Peak]:
+def get_peak_arrays(waveform: np.ndarray, filter_kernel_width: int) -> PeakArrays:
     """
-    Detects min/max peaks of a around-zero centered waveform.
+    Detects min/max peaks of a around-zero centered waveform. Costs are linear in the length of the waveform,
+    regardless of the filter kernel width.
 
     :param waveform: Input waveform. Must be centered around zero.
     :param filter_kernel_width: Width of the filter kernel. Most likely the number
                                 of samples that form one signal period.
-    :return: A list of the detected peaks.
+    :return: The detected peaks, as struct of arrays.
     """
-    # Convolve waveform with the filter kernel & cut the right and left overlaps
-    filter_kernel = np.ones(filter_kernel_width) / filter_kernel_width
-    filtered_waveform = np.convolve(waveform, filter_kernel)
-    filtered_waveform = filtered_waveform[int(filter_kernel_width/2) - 1:-math.ceil(filter_kernel_width/2)]
-    if len(filtered_waveform) != len(waveform):
+    if filter_kernel_width < 2:
         raise AssertionError(f"There is a length mismatch in filtered and original waveform. Needs some rework!")
-    filtered_waveform[filtered_waveform == -0.0] = 0.0
+    filtered_signs = np.empty(shape=(len(waveform),), dtype=np.int8)
+    _fill_filtered_signs(waveform, filter_kernel_width, filtered_signs, 0, len(waveform))
+    zero_crosses = _allocate_zero_cross_arrays(waveform)
+    n_crosses, n_crosses_pos, _, _, _ = _find_zero_crosses(waveform, filtered_signs, 0, len(waveform), zero_crosses)
+    return _zero_crosses_to_peak_arrays(waveform, zero_crosses, n_crosses, n_crosses_pos)
+
+
+@numba.jit(nopython=True)
+def get_multichannel_peak_arrays(waveforms: np.ndarray, filter_kernel_width: int, chunk_size: int = 2**15) -> List[PeakArrays]:
+    """
+    Parallel counterpart of get_peak_arrays(...) for several waveforms at once, e.g. the AIRFLOW/CHEST/ABD signals of
+    a record. Each waveform is split into chunks, which are processed concurrently (over all channels) by numba
+    threads. Results are identical to those of get_peak_arrays(...).
+
+    :param waveforms: Input waveforms (channels x samples). Each must be centered around zero.
+    :param filter_kernel_width: Width of the filter kernel. Most likely the number
+                                of samples that form one signal period.
+    :param chunk_size: Number of samples per chunk.
+    :return: The detected peaks of each channel, as struct of arrays.
+    """
+    if filter_kernel_width < 2:
+        raise AssertionError(f"There is a length mismatch in filtered and original waveform. Needs some rework!")
+    if chunk_size < 1:
+        raise AssertionError("Chunk size must be positive!")
+    n_channels, n_samples = waveforms.shape
+    n_chunks = max(1, -(-n_samples // chunk_size))
+    zero_crosses, chunk_heads = _find_chunked_zero_crosses(waveforms, filter_kernel_width, chunk_size, n_chunks)
+    n_chunk_crosses, n_chunk_crosses_pos, n_chunk_head_values, chunk_head_minimums, chunk_head_maximums = chunk_heads
+
+    # Stitch the chunks' zero crosses together: values in front of a chunk's first zero cross belong to the stretch
+    # that began in one of the preceding chunks. Then, create the peaks.
+    peaks_per_channel = []
+    for channel in range(n_channels):
+        channel_zero_crosses = _ZeroCrossArrays(positions=zero_crosses.positions[channel],
+                                                is_positive=zero_crosses.is_positive[channel],
+                                                stretch_minimums=zero_crosses.stretch_minimums[channel],
+                                                stretch_maximums=zero_crosses.stretch_maximums[channel])
+        n_crosses = 0
+        for chunk in range(n_chunks):
+            if n_crosses != 0 and n_chunk_head_values[channel, chunk] != 0:
+                channel_zero_crosses.stretch_minimums[n_crosses-1] = _nan_min(channel_zero_crosses.stretch_minimums[n_crosses-1],
+                                                                              chunk_head_minimums[channel, chunk])
+                channel_zero_crosses.stretch_maximums[n_crosses-1] = _nan_max(channel_zero_crosses.stretch_maximums[n_crosses-1],
+                                                                              chunk_head_maximums[channel, chunk])
+            chunk_start = chunk * chunk_size
+            for c in range(chunk_start, chunk_start + n_chunk_crosses[channel, chunk]):
+                channel_zero_crosses.positions[n_crosses] = channel_zero_crosses.positions[c]
+                channel_zero_crosses.is_positive[n_crosses] = channel_zero_crosses.is_positive[c]
+                channel_zero_crosses.stretch_minimums[n_crosses] = channel_zero_crosses.stretch_minimums[c]
+                channel_zero_crosses.stretch_maximums[n_crosses] = channel_zero_crosses.stretch_maximums[c]
+                n_crosses += 1
+        peaks_per_channel.append(_zero_crosses_to_peak_arrays(waveforms[channel], channel_zero_crosses, n_crosses,
+                                                              np.sum(n_chunk_crosses_pos[channel])))
+    return peaks_per_channel
+
+
+@numba.jit(nopython=True, parallel=True)
+def _find_chunked_zero_crosses(waveforms: np.ndarray, filter_kernel_width: int, chunk_size: int, n_chunks: int):
+    """
+    Determines filtered signs & zero crosses of all chunks (of all channels) concurrently. Filter windows simply reach
+    into the neighbouring chunks. Each chunk's zero crosses are stored at the chunk's offset.
+
+    :return: Zero crosses (channels x samples) & for each chunk (channels x chunks): number of zero crosses, number of
+             positive ones among them, as well as number & min/max value of the waveform values in front of the first
+             zero cross.
+    """
+    n_channels, n_samples = waveforms.shape
+    n_tasks = n_channels * n_chunks
+    filtered_signs = np.empty(shape=(n_channels, n_samples), dtype=np.int8)
+    for task in numba.prange(n_tasks):
+        _fill_filtered_signs(waveforms[task // n_chunks], filter_kernel_width, filtered_signs[task // n_chunks],
+                             (task % n_chunks) * chunk_size, min(n_samples, (task % n_chunks + 1) * chunk_size))
+
+    positions = np.empty(shape=(n_channels, n_samples), dtype=np.int64)
+    is_positive = np.empty(shape=(n_channels, n_samples), dtype=np.bool_)
+    stretch_minimums = np.empty(shape=(n_channels, n_samples), dtype=waveforms.dtype)
+    stretch_maximums = np.empty(shape=(n_channels, n_samples), dtype=waveforms.dtype)
+    n_chunk_crosses = np.zeros(shape=(n_channels, n_chunks), dtype=np.int64)
+    n_chunk_crosses_pos = np.zeros(shape=(n_channels, n_chunks), dtype=np.int64)
+    n_chunk_head_values = np.zeros(shape=(n_channels, n_chunks), dtype=np.int64)
+    chunk_head_minimums = np.zeros(shape=(n_channels, n_chunks), dtype=waveforms.dtype)
+    chunk_head_maximums = np.zeros(shape=(n_channels, n_chunks), dtype=waveforms.dtype)
+    for task in numba.prange(n_tasks):
+        channel, chunk = task // n_chunks, task % n_chunks
+        chunk_results = _find_zero_crosses(
+            waveforms[channel], filtered_signs[channel], chunk * chunk_size, min(n_samples, (chunk + 1) * chunk_size),
+            _ZeroCrossArrays(positions=positions[channel], is_positive=is_positive[channel],
+                             stretch_minimums=stretch_minimums[channel], stretch_maximums=stretch_maximums[channel]))
+        n_chunk_crosses[channel, chunk], n_chunk_crosses_pos[channel, chunk] = chunk_results[0], chunk_results[1]
+        n_chunk_head_values[channel, chunk] = chunk_results[2]
+        chunk_head_minimums[channel, chunk], chunk_head_maximums[channel, chunk] = chunk_results[3], chunk_results[4]
+    zero_crosses = _ZeroCrossArrays(positions=positions, is_positive=is_positive, stretch_minimums=stretch_minimums,
+                                    stretch_maximums=stretch_maximums)
+    return zero_crosses, (n_chunk_crosses, n_chunk_crosses_pos, n_chunk_head_values, chunk_head_minimums, chunk_head_maximums)
+
+
+@numba.jit(nopython=True)
+def _allocate_zero_cross_arrays(waveform: np.ndarray) -> _ZeroCrossArrays:
+    return _ZeroCrossArrays(positions=np.empty(shape=(len(waveform),), dtype=np.int64),
+                            is_positive=np.empty(shape=(len(waveform),), dtype=np.bool_),
+                            stretch_minimums=np.empty(shape=(len(waveform),), dtype=waveform.dtype),
+                            stretch_maximums=np.empty(shape=(len(waveform),), dtype=waveform.dtype))
+
+
+@numba.jit(nopython=True)
+def _find_zero_crosses(waveform: np.ndarray, filtered_signs: np.ndarray, start: int, stop: int,
+                       zero_crosses: _ZeroCrossArrays):
+    """
+    Sweeps once over signs & waveform at the positions start..stop (exclusive). Zero crosses are where the filtered
+    signs flip directly between -1 and +1; they are written to 'zero_crosses' from position 'start' on. For each
+    stretch in between two successive zero crosses, we keep track of the waveform's min/max values.
+
+    :return: Number of zero crosses, number of positive ones among them, as well as number & min/max value of the
+             waveform values in front of the first zero cross.
+    """
+    n_crosses, n_crosses_pos, n_head_values = 0, 0, 0
+    head_minimum = head_maximum = np.zeros(shape=(1,), dtype=waveform.dtype)[0]
+    for i in range(start, min(stop, len(filtered_signs) - 1)):
+        sign_flip = (filtered_signs[i], filtered_signs[i+1])
+        if sign_flip == (-1, 1) or sign_flip == (1, -1):
+            zero_crosses.positions[start + n_crosses] = i
+            zero_crosses.is_positive[start + n_crosses] = sign_flip[1] == 1
+            zero_crosses.stretch_minimums[start + n_crosses] = zero_crosses.stretch_maximums[start + n_crosses] = waveform[i]
+            n_crosses += 1
+            if sign_flip[1] == 1:
+                n_crosses_pos += 1
+        elif n_crosses != 0:
+            zero_crosses.stretch_minimums[start + n_crosses-1] = _nan_min(zero_crosses.stretch_minimums[start + n_crosses-1], waveform[i])
+            zero_crosses.stretch_maximums[start + n_crosses-1] = _nan_max(zero_crosses.stretch_maximums[start + n_crosses-1], waveform[i])
+        elif n_head_values == 0:
+            head_minimum = head_maximum = waveform[i]
+            n_head_values = 1
+        else:
+            head_minimum, head_maximum = _nan_min(head_minimum, waveform[i]), _nan_max(head_maximum, waveform[i])
+            n_head_values += 1
+    return n_crosses, n_crosses_pos, n_head_values, head_minimum, head_maximum
 
-    # Align our filtered waveform with the original signal
-    shift = int(-filter_kernel_width / 4)
-    if shift != 0:
-        filtered_waveform = np.roll(filtered_waveform, shift=shift)
-        filtered_waveform[shift:] = np.nan
 
-    zero_crosses_pos: np.ndarray = np.where(np.diff(np.sign(filtered_waveform)) > 1)[0]
-    zero_crosses_neg: np.ndarray = np.where(np.diff(np.sign(filtered_waveform)) < -1)[0]
-    n_zero_cross_difference = np.abs(len(zero_crosses_pos)-len(zero_crosses_neg))
+@numba.jit(nopython=True)
+def _zero_crosses_to_peak_arrays(waveform: np.ndarray, zero_crosses: _ZeroCrossArrays, n_crosses: int,
+                                 n_crosses_pos: int) -> PeakArrays:
+    n_crosses_neg = n_crosses - n_crosses_pos
+    n_zero_cross_difference = abs(n_crosses_pos - n_crosses_neg)
     if n_zero_cross_difference > 4:
         raise AssertionError("Discrepancy in numbers of detected pos/neg zero crosses is too large. Needs some rework!")
     elif n_zero_cross_difference > 1:
-        # As long as difference in zero-cross-number is small, we simply clamp the longer list
-        n_zero_crosses = min(len(zero_crosses_pos), len(zero_crosses_neg))
-        zero_crosses_pos = zero_crosses_pos[:n_zero_crosses]
-        zero_crosses_neg = zero_crosses_neg[:n_zero_crosses]
-
-    peaks: List[Peak] = []
-    if len(zero_crosses_pos) == 0 or len(zero_crosses_neg) == 0:
-        return peaks
-
-    # Merge our zero crosses into one list & do some sanity checks
-    zero_crosses: List[ZeroCross] = []
-    last_zero_cross_type: Optional[ZeroCrossType] = None
-    while len(zero_crosses_pos) != 0 or len(zero_crosses_neg) != 0:
-        position_pos = zero_crosses_pos[0] if len(zero_crosses_pos) != 0 else None
-        position_neg = zero_crosses_neg[0] if len(zero_crosses_neg) != 0 else None
-        if position_neg is None or (position_pos is not None and position_pos < position_neg):
-            if last_zero_cross_type is not None and last_zero_cross_type == ZeroCrossType.Positive:
-                pass  # We're facing consecutive positive zero crosses. That's insane, isn't it? ;-)
-                # raise AssertionError("Consecutive positive zero crosses of the same type are not supported!")
-            else:
-                zero_crosses.append(ZeroCross(type=ZeroCrossType.Positive, position=position_pos))
-            zero_crosses_pos = zero_crosses_pos[1:]
-            last_zero_cross_type = ZeroCrossType.Positive
+        # As long as difference in zero-cross-number is small, we simply drop the excess zero crosses at the end
+        n_crosses_pos = n_crosses_neg = min(n_crosses_pos, n_crosses_neg)
+
+    if n_crosses_pos == 0 or n_crosses_neg == 0:
+        return _allocate_peak_arrays(waveform, n_peaks=0)
+
+    # Merge our zero crosses into one sequence of alternating types. Out of consecutive zero crosses of the same type
+    # (which is insane, isn't it? ;-) ), only the first one is kept.
+    is_positive = zero_crosses.is_positive
+    merged_crosses = np.empty(shape=(n_crosses,), dtype=np.int64)
+    n_merged_crosses, n_visited_pos, n_visited_neg = 0, 0, 0
+    last_is_positive: Optional[bool] = None
+    for c in range(n_crosses):
+        if is_positive[c]:
+            n_visited_pos += 1
+            if n_visited_pos > n_crosses_pos:
+                continue
         else:
-            if last_zero_cross_type is not None and last_zero_cross_type == ZeroCrossType.Negative:
-                pass  # We're facing consecutive negative zero crosses. That's insane, isn't it? ;-)
-                # raise AssertionError("Consecutive negative zero crosses of the same type are not supported!")
-            else:
-                zero_crosses.append(ZeroCross(type=ZeroCrossType.Negative, position=position_neg))
-            zero_crosses_neg = zero_crosses_neg[1:]
-            last_zero_cross_type = ZeroCrossType.Negative
-
-    # Now, let's create the list of peaks
-    last_zero_cross: Optional[ZeroCross] = None
-    for zero_cross in zero_crosses:
-        if last_zero_cross is None:
-            last_zero_cross = zero_cross
-            continue
-        if zero_cross.type == ZeroCrossType.Positive:
-            extreme_value = np.min(waveform[last_zero_cross.position:zero_cross.position])
-            peak_type = PeakType.Minimum
+            n_visited_neg += 1
+            if n_visited_neg > n_crosses_neg:
+                continue
+        if last_is_positive is None or last_is_positive != is_positive[c]:
+            merged_crosses[n_merged_crosses] = c
+            n_merged_crosses += 1
+        last_is_positive = is_positive[c]
+
+    # Now, let's create the peaks. Each one spans from one zero cross to the next
+    peaks = _allocate_peak_arrays(waveform, n_peaks=max(0, n_merged_crosses - 1))
+    for p in range(n_merged_crosses - 1):
+        first_cross, last_cross = merged_crosses[p], merged_crosses[p+1]
+        if is_positive[last_cross]:
+            extreme_value = zero_crosses.stretch_minimums[first_cross]
+            for c in range(first_cross + 1, last_cross):
+                extreme_value = _nan_min(extreme_value, zero_crosses.stretch_minimums[c])
+            peaks.types[p] = PeakType.Minimum.value
         else:
-            extreme_value = np.max(waveform[last_zero_cross.position:zero_cross.position])
-            peak_type = PeakType.Maximum
-        start: int = last_zero_cross.position
-        end: int = zero_cross.position-1
-        peaks.append(Peak(type=peak_type, extreme_value=extreme_value, start=start, end=end, center=int(start+(end-start)/2), length=end-start+1))
-        last_zero_cross = zero_cross
+            extreme_value = zero_crosses.stretch_maximums[first_cross]
+            for c in range(first_cross + 1, last_cross):
+                extreme_value = _nan_max(extreme_value, zero_crosses.stretch_maximums[c])
+            peaks.types[p] = PeakType.Maximum.value
+        peaks.extreme_values[p] = extreme_value
+        start: int = zero_crosses.positions[first_cross]
+        end: int = zero_crosses.positions[last_cross]-1
+        peaks.starts[p] = start
+        peaks.ends[p] = end
+        peaks.centers[p] = int(start+(end-start)/2)
+        peaks.lengths[p] = end-start+1
     return peaks
 
 
+@numba.jit(nopython=True)
+def _nan_min(minimum, value):
+    """Running minimum, with the NaN & tie semantics of np.min: a NaN sticks, out of equal values the first one wins."""
+    if minimum != minimum or value != value:
+        return minimum if minimum != minimum else value
+    return value if value < minimum else minimum
+
+
+@numba.jit(nopython=True)
+def _nan_max(maximum, value):
+    """Running maximum, with the NaN & tie semantics of np.max."""
+    if maximum != maximum or value != value:
+        return maximum if maximum != maximum else value
+    return value if value > maximum else maximum
+
+
+@numba.jit(nopython=True)
+def _fill_filtered_signs(waveform: np.ndarray, filter_kernel_width: int, signs: np.ndarray, start: int, stop: int):
+    """
+    Writes the signs (-1/0/+1; 2 for NaN) of the waveform after filtering with a box kernel & aligning the result with
+    the original waveform into signs[start:stop]. Bit-identical to the signs of the np.convolve(...)-based reference
+    (see test), but at linear costs: the filtered values are obtained as moving sums, which get updated from one
+    position to the next & re-computed from scratch once per kernel width. Only where the rounding errors of the moving
+    sums (for which we keep a bound) might have flipped a sign, the filtered value is computed just as np.convolve(...)
+    does. Hence, any range of positions can be processed on its own.
+    """
+    n, width = len(waveform), filter_kernel_width
+    filter_kernel = np.ones(width) / width
+    if n < width:
+        # Short waveforms are not worth the effort; also, np.convolve(...) swaps its operands for them
+        filtered_waveform = np.convolve(waveform, filter_kernel)
+        for i in range(start, stop):
+            signs[i] = _get_sign(filtered_waveform[i + width//4 + width//2 - 1]) if i < n - width//4 else 2
+        return
+
+    # Position i of the aligned filtered waveform equals position i+offset of the (full) convolution result. The last
+    # 'width//4' positions (shifted in from the right) are NaN.
+    offset = width//4 + width//2 - 1
+    n_valid = n - width//4
+    eps_bound = 16 * (width + 1) * np.finfo(np.float64).eps
+    abs_bound = 16 * (width + 1) * width * np.finfo(np.float64).tiny
+    moving_sum, moving_abs_sum, n_updates = np.nan, np.nan, width
+    for i in range(start, stop):
+        if i >= n_valid:
+            signs[i] = 2
+            continue
+        full_index = i + offset
+        if full_index < width - 1 or full_index > n - 1:
+            # Partial overlap of kernel & waveform
+            signs[i] = _get_sign(_get_convolved_value(waveform, filter_kernel, full_index))
+            continue
+        window_start = full_index - width + 1
+        if n_updates >= width or not np.isfinite(moving_sum) or not np.isfinite(moving_abs_sum):
+            moving_sum, moving_abs_sum, n_updates = 0.0, 0.0, 0
+            for value in waveform[window_start:window_start + width]:
+                moving_sum += value
+                moving_abs_sum += abs(value)
+        else:
+            # 'moving_abs_sum' keeps growing since the last re-computation, which bounds all intermediate sums
+            new_value = waveform[window_start + width - 1]
+            moving_sum = (moving_sum + new_value) - waveform[window_start - 1]
+            moving_abs_sum += abs(new_value)
+            n_updates += 1
+        if moving_abs_sum == 0:
+            signs[i] = 0
+        elif np.isfinite(moving_sum) and abs(moving_sum) > eps_bound * moving_abs_sum + abs_bound:
+            signs[i] = 1 if moving_sum > 0 else -1
+        else:
+            signs[i] = _get_sign(_get_convolved_value(waveform, filter_kernel, full_index))
+
+
+@numba.jit(nopython=True)
+def _get_sign(value: float) -> int:
+    if value != value:
+        return 2
+    return 1 if value > 0 else (-1 if value < 0 else 0)
+
+
+@numba.jit(nopython=True)
+def _get_convolved_value(waveform: np.ndarray, filter_kernel: np.ndarray, full_index: int) -> float:
+    """Position 'full_index' of np.convolve(waveform, filter_kernel), computed the same way (len(waveform) >= kernel)."""
+    n, width = len(waveform), len(filter_kernel)
+    if full_index < width - 1:
+        return _inner_product(waveform[:full_index + 1], filter_kernel[::-1][-(full_index + 1):])
+    if full_index > n - 1:
+        n_overlap = n + width - 1 - full_index
+        return _inner_product(waveform[-n_overlap:], filter_kernel[::-1][:n_overlap])
+    return _inner_product(waveform[full_index - width + 1:full_index + 1], filter_kernel[::-1])
+
+
+def _inner_product(a: np.ndarray, b: np.ndarray) -> float:
+    return np.dot(a, b)
+
+
+@overload(_inner_product)
+def _inner_product__jit(a, b):
+    """Inner product the way numba's np.convolve(...) computes it: BLAS for floats, a plain loop otherwise."""
+    if isinstance(a.dtype, types.Float) and isinstance(b.dtype, types.Float):
+        dtype = np.promote_types(as_dtype(a.dtype), as_dtype(b.dtype))
+        return lambda a, b: np.dot(a.astype(dtype), b.astype(dtype))
+
+    def _inner_product__loop(a, b):
+        accumulated = 0
+        for i in range(len(a)):
+            accumulated = accumulated + a[i] * b[i]
+        return accumulated
+    return _inner_product__loop
+
+
+@numba.jit(nopython=True)
+def _allocate_peak_arrays(waveform: np.ndarray, n_peaks: int) -> PeakArrays:
+    return PeakArrays(types=np.empty(shape=(n_peaks,), dtype=np.int8),
+                      extreme_values=np.empty(shape=(n_peaks,), dtype=waveform.dtype),
+                      starts=np.empty(shape=(n_peaks,), dtype=np.int64), ends=np.empty(shape=(n_peaks,), dtype=np.int64),
+                      centers=np.empty(shape=(n_peaks,), dtype=np.int64), lengths=np.empty(shape=(n_peaks,), dtype=np.int64))
+
+
+@numba.jit(nopython=True)
+def get_peaks(waveform: np.ndarray, filter_kernel_width: int) -> List[Peak]:
+    """
+    Detects min/max peaks of a around-zero centered waveform. List view of get_peak_arrays(...), which is the better
+    choice for new code.
+
+    :param waveform: Input waveform. Must be centered around zero.
+    :param filter_kernel_width: Width of the filter kernel. Most likely the number
+                                of samples that form one signal period.
+    :return: A list of the detected peaks.
+    """
+    return peak_arrays_to_list(get_peak_arrays(waveform=waveform, filter_kernel_width=filter_kernel_width))
+
+
+@numba.jit(nopython=True)
+def peak_arrays_to_list(peaks: PeakArrays) -> List[Peak]:
+    peaks_list: List[Peak] = []
+    for i in range(len(peaks.starts)):
+        peak_type = PeakType.Minimum if peaks.types[i] == PeakType.Minimum.value else PeakType.Maximum
+        peaks_list.append(Peak(type=peak_type, extreme_value=peaks.extreme_values[i], start=peaks.starts[i],
+                               end=peaks.ends[i], center=peaks.centers[i], length=peaks.lengths[i]))
+    return peaks_list
+
+
+def peak_list_to_arrays(peaks: List[Peak]) -> PeakArrays:
+    """Counterpart of peak_arrays_to_list, e.g. for peaks that were assembled by hand."""
+    return PeakArrays(types=np.array([p.type.value for p in peaks], dtype=np.int8),
+                      extreme_values=np.array([p.extreme_value for p in peaks], dtype=np.float64),
+                      starts=np.array([p.start for p in peaks], dtype=np.int64),
+                      ends=np.array([p.end for p in peaks], dtype=np.int64),
+                      centers=np.array([p.center for p in peaks], dtype=np.int64),
+                      lengths=np.array([p.length for p in peaks], dtype=np.int64))
+
+
+def slice_peak_arrays(peaks: PeakArrays, start: Optional[int], stop: Optional[int]) -> PeakArrays:
+    """Returns the peaks start..stop (exclusive), with the semantics of Python slices (views, no copies)."""
+    return PeakArrays(*(a[start:stop] for a in peaks))
+
+
 @numba.jit(nopython=True)
 def cluster_1d(input_vector: np.ndarray, no_klass: int = 0, allowed_distance: int = 1, min_length: int = 5) -> List[IntRange]:
     klass_positions: np.ndarray = np.where(input_vector != no_klass)[0]
@@ -157,6 +455,78 @@ def normalize_robust(input: np.ndarray, center: bool = True, scale: bool = True)
     return data
 
 
+@numba.jit(nopython=True)
+def _sorted_insert(sorted_values: np.ndarray, n_values: int, value: float):
+    position = np.searchsorted(sorted_values[:n_values], value, side="right")
+    for i in range(n_values, position, -1):
+        sorted_values[i] = sorted_values[i-1]
+    sorted_values[position] = value
+
+
+@numba.jit(nopython=True)
+def _sorted_remove(sorted_values: np.ndarray, n_values: int, value: float):
+    position = np.searchsorted(sorted_values[:n_values], value, side="left")
+    for i in range(position, n_values-1):
+        sorted_values[i] = sorted_values[i+1]
+
+
+@numba.jit(nopython=True)
+def _sorted_quantile(sorted_values: np.ndarray, n_values: int, q: float) -> float:
+    """Same interpolation as np.quantile(...) within Numba, applied to already sorted values."""
+    if n_values == 1:
+        return sorted_values[0]
+    rank = 1 + (n_values - 1) * (q * 100 / 100.0)  # Numba takes that detour via percentiles; so do we, for equal rounding
+    f = math.floor(rank)
+    m = rank - f
+    return sorted_values[int(f - 1)] * (1 - m) + sorted_values[min(int(f), n_values - 1)] * m
+
+
+@numba.jit(nopython=True)
+def get_rolling_robust_scales(input: np.ndarray, window_starts: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    Determines, for many (overlapping) windows of an input signal at once, the divisor that normalize_robust(window,
+    center=False, scale=True) applies to each window. Hence, dividing a window (as float64) by its divisor & casting
+    the result to float32 gives exactly the output of normalize_robust.
+
+    Instead of sorting each window anew, the values of the current window are kept sorted & updated incrementally:
+    values that leave the window are removed, values that enter it are inserted.
+
+    @param input: Input signal.
+    @param window_starts: Start index of each window, in ascending order.
+    @param window_size: Number of samples of each window.
+    @return: Divisor (inter-quartile range, or 1 for "kaputt" windows) of each window.
+    """
+    values = input.astype(np.float32).astype(np.float64)
+    is_considered = np.abs(values) >= 1e-10  # Same filter as in normalize_robust
+    sorted_values = np.empty(shape=(window_size,), dtype=np.float64)
+    n_values = 0
+    current_start, current_stop = 0, 0
+    scales = np.ones(shape=(len(window_starts),), dtype=np.float64)
+    for w in range(len(window_starts)):
+        start, stop = window_starts[w], window_starts[w] + window_size
+        if start < current_start or start >= current_stop:
+            # No overlap with the previous window, hence start from scratch
+            window_values = values[start:stop][is_considered[start:stop]]
+            n_values = len(window_values)
+            sorted_values[:n_values] = np.sort(window_values)
+        else:
+            for i in range(current_start, start):
+                if is_considered[i]:
+                    _sorted_remove(sorted_values, n_values, values[i])
+                    n_values -= 1
+            for i in range(current_stop, stop):
+                if is_considered[i]:
+                    _sorted_insert(sorted_values, n_values, values[i])
+                    n_values += 1
+        current_start, current_stop = start, stop
+
+        if n_values != 0:
+            inter_quartile_range = _sorted_quantile(sorted_values, n_values, 0.75) - _sorted_quantile(sorted_values, n_values, 0.25)
+            if inter_quartile_range > 1e-4:
+                scales[w] = inter_quartile_range
+    return scales
+
+
 def test_normalize_robust():
     def inter_quartile_range(x): return np.quantile(x, 0.75) - np.quantile(x, 0.25)
 
@@ -262,6 +632,126 @@ def test_get_peaks__qualitative():
     pass
 
 
+def test_get_peak_arrays():
+    from .paths import UTIL_PATH
+
+    sample_signal = np.load(file=UTIL_PATH/"sample_airflow_signal_10hz.npy")
+    peak_arrays = get_peak_arrays(waveform=sample_signal, filter_kernel_width=5)
+    peaks = get_peaks(waveform=sample_signal, filter_kernel_width=5)
+    assert len(peaks) == len(peak_arrays.starts) > 10
+    assert peak_arrays.extreme_values.dtype == sample_signal.dtype
+    assert peak_arrays_to_list(peak_arrays) == peaks
+    assert peak_list_to_arrays(peaks).starts.tolist() == peak_arrays.starts.tolist()
+    assert peak_arrays_to_list(slice_peak_arrays(peak_arrays, 3, 7)) == peaks[3:7]
+    assert len(get_peak_arrays(waveform=np.zeros(shape=(100,)), filter_kernel_width=5).starts) == 0
+
+
+def test_get_filtered_signs():
+    @numba.jit(nopython=True)
+    def _get_filtered_signs__reference(waveform: np.ndarray, filter_kernel_width: int) -> np.ndarray:
+        filter_kernel = np.ones(filter_kernel_width) / filter_kernel_width
+        filtered_waveform = np.convolve(waveform, filter_kernel)
+        filtered_waveform = filtered_waveform[int(filter_kernel_width/2) - 1:-math.ceil(filter_kernel_width/2)]
+        shift = int(-filter_kernel_width / 4)
+        if shift != 0:
+            filtered_waveform = np.roll(filtered_waveform, shift=shift)
+            filtered_waveform[shift:] = np.nan
+        return np.sign(filtered_waveform)
+
+    rng = np.random.default_rng(0)
+    random_walk = np.cumsum(rng.normal(size=5000))
+    coarse_values = np.round(np.sin(np.arange(5000) / 7) * 2) / 2  # Lots of filtered values that are (almost) zero
+    coarse_values[[100, 3000]] = np.nan
+    for waveform in (random_walk - random_walk.mean(), coarse_values, coarse_values[:30], rng.integers(-3, 4, size=2000),
+                     rng.normal(size=3000).astype(np.float32) * 1e-30, np.zeros(shape=(500,))):
+        for filter_kernel_width in (2, 3, 5, 8, 50, 51):
+            reference = _get_filtered_signs__reference(waveform, filter_kernel_width)
+            reference[np.isnan(reference)] = 2
+            signs = np.empty(shape=(len(waveform),), dtype=np.int8)
+            _fill_filtered_signs(waveform, filter_kernel_width, signs, 0, len(waveform))
+            assert np.array_equal(signs, reference)
+            # Ranges of positions can be processed on their own, e.g. in parallel
+            chunked_signs = np.empty(shape=(len(waveform),), dtype=np.int8)
+            for chunk_start in range(0, len(waveform), 777):
+                _fill_filtered_signs(waveform, filter_kernel_width, chunked_signs, chunk_start, min(len(waveform), chunk_start + 777))
+            assert np.array_equal(chunked_signs, reference)
+
+
+@pytest.mark.speed
+def test_get_peak_arrays__linear_time_speed():
+    from datetime import datetime
+
+    # Synthetic full-night (8h @ 10Hz) breathing signal with some noise
+    rng = np.random.default_rng(0)
+    t = np.arange(8*60*60*10) / 10
+    waveform = (np.sin(2*np.pi*0.25*t) * (1 + 0.3*np.sin(2*np.pi*t/600)) + 0.1*rng.normal(size=len(t))).astype(np.float32)
+    get_peak_arrays(waveform=waveform[:1000], filter_kernel_width=5)  # One initial run to JIT the code
+
+    n_runs = 20
+    print()
+    for filter_kernel_width in (7, 50, 200):
+        started_at = datetime.now()
+        for n in range(n_runs):
+            result = get_peak_arrays(waveform=waveform, filter_kernel_width=filter_kernel_width)
+        overall_seconds = (datetime.now()-started_at).total_seconds()
+        # Minima and maxima alternate, at most one of each per breath. Kernels up to about one breath wide lose none.
+        n_breaths = len(waveform) / 10 * 0.25
+        assert np.all(result.types[1:] != result.types[:-1]) and np.all(np.diff(result.starts) > 0)
+        assert len(result.starts) <= 2*n_breaths + 1
+        if filter_kernel_width <= 50:
+            assert len(result.starts) >= 2*n_breaths - 10
+        print(f"filter_kernel_width={filter_kernel_width}: a single run over {len(waveform)} samples took "
+              f"{overall_seconds/n_runs*1000:.2f}ms ({len(result.starts)} peaks)")
+
+
+def test_get_multichannel_peak_arrays():
+    from .paths import UTIL_PATH
+
+    sample_signal = np.load(file=UTIL_PATH/"sample_airflow_signal_10hz.npy")
+    rng = np.random.default_rng(0)
+    waveforms = np.stack([sample_signal, np.roll(sample_signal, 123), sample_signal * rng.uniform(0.5, 2, size=len(sample_signal))])
+    waveforms[1, 500:520] = np.nan
+    for filter_kernel_width in (2, 5, 50):
+        # Chunks as small as a single sample split peaks & stretches in between zero crosses at all possible positions
+        for chunk_size in (1, 7, 100, 2**15):
+            peaks_per_channel = get_multichannel_peak_arrays(waveforms, filter_kernel_width=filter_kernel_width, chunk_size=chunk_size)
+            assert len(peaks_per_channel) == len(waveforms)
+            for waveform, peaks in zip(waveforms, peaks_per_channel):
+                reference = get_peak_arrays(waveform, filter_kernel_width=filter_kernel_width)
+                for array, reference_array in zip(peaks, reference):
+                    assert array.dtype == reference_array.dtype and np.array_equal(array, reference_array, equal_nan=True)
+
+
+@pytest.mark.speed
+def test_get_multichannel_peak_arrays__speed():
+    from datetime import datetime
+
+    # Synthetic full-night (8h @ 10Hz) AIRFLOW/CHEST/ABD signals
+    rng = np.random.default_rng(0)
+    t = np.arange(8*60*60*10) / 10
+    waveforms = np.stack([np.sin(2*np.pi*0.25*t + phase) + 0.1*rng.normal(size=len(t)) for phase in (0, 0.3, -0.3)]).astype(np.float32)
+    get_multichannel_peak_arrays(waveforms=waveforms[:, :1000].copy(), filter_kernel_width=7)  # One initial run to JIT the code
+    get_peak_arrays(waveform=waveforms[0, :1000], filter_kernel_width=7)
+
+    n_runs = 20
+    started_at = datetime.now()
+    for n in range(n_runs):
+        serial_results = [get_peak_arrays(waveform=waveform, filter_kernel_width=7) for waveform in waveforms]
+    serial_seconds = (datetime.now()-started_at).total_seconds()
+    started_at = datetime.now()
+    for n in range(n_runs):
+        parallel_results = get_multichannel_peak_arrays(waveforms=waveforms, filter_kernel_width=7)
+    parallel_seconds = (datetime.now()-started_at).total_seconds()
+    assert len(parallel_results) == len(serial_results)
+    for parallel_peaks, serial_peaks in zip(parallel_results, serial_results):
+        for array, serial_array in zip(parallel_peaks, serial_peaks):
+            assert array.dtype == serial_array.dtype and np.array_equal(array, serial_array, equal_nan=True)
+
+    print()
+    print(f"Serial: a single run over {waveforms.shape} samples took {serial_seconds/n_runs*1000:.2f}ms")
+    print(f"Parallel ({numba.get_num_threads()} threads): a single run took {parallel_seconds/n_runs*1000:.2f}ms")
+
+
 def test_get_peaks__jit_speed():
     from datetime import datetime
     from .paths import UTIL_PATH
@@ -297,3 +787,18 @@ def test_get_peaks__example_plot():
 
     df.plot(figsize=(15, 6), subplots=False)
     plt.show()
+
+
+def test_get_rolling_robust_scales():
+    rng = np.random.default_rng(0)
+    signal = (rng.normal(size=3000) * 50).astype(np.float32)
+    signal[1000:1400] = 0  # "kaputt" data
+    signal[2000:2100] = 7
+    signal[2500:2510] = np.round(signal[2500:2510])  # Ties
+    for window_size, stride in ((601, 5), (301, 1), (101, 150), (1501, 11)):
+        window_starts = np.arange(0, len(signal) - window_size + 1, stride)
+        scales = get_rolling_robust_scales(signal, window_starts, window_size)
+        for start, scale in zip(window_starts, scales):
+            window = signal[start:start + window_size]
+            expected = normalize_robust(window, center=False, scale=True)
+            assert np.array_equal((window.astype(np.float64) / scale).astype(np.float32), expected)